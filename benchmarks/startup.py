@@ -0,0 +1,102 @@
+'''
+Measures the startup time of each registered script: a fresh interpreter imports `omnifin` and resolves the script
+(everything that happens before the script itself runs), and reports whether pandas (and numpy) had to be imported
+for that. Then a cheap script is run end to end (`init-db` on a temporary database) to measure the whole path from
+starting the interpreter to a finished command.
+
+	python benchmarks/startup.py [--repeat 5] [--no-run] [script ...]
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import omnifig as fig
+import omnifin
+entry = fig.get_current_project().find_script({name!r})
+print(json.dumps({{'time': time.perf_counter() - start, 'pandas': 'pandas' in sys.modules,
+				  'numpy': 'numpy' in sys.modules, 'modules': len(sys.modules)}}))
+'''
+
+RUN_PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import omnifig as fig
+import omnifin
+fig.quick_run('init-db', conn={{'_type': 'sqlite'}}, db={db!r}, silent=True)
+print(json.dumps({{'time': time.perf_counter() - start, 'pandas': 'pandas' in sys.modules,
+				  'numpy': 'numpy' in sys.modules, 'modules': len(sys.modules)}}))
+'''
+
+
+
+def list_scripts() -> list[str]:
+	out = subprocess.run([sys.executable, '-c', 'import omnifig as fig, omnifin\n'
+							'for entry in fig.get_current_project().iterate_scripts(): print(entry.name)'],
+						 cwd=ROOT, capture_output=True, text=True, check=True)
+	return sorted(out.stdout.split())
+
+
+
+def _probe(code: str, repeat: int) -> list[dict]:
+	runs = []
+	for _ in range(repeat):
+		out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+		runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+	return runs
+
+
+
+def _summary(name: str, runs: list[dict]) -> dict:
+	return {'script': name, 'median': statistics.median(run['time'] for run in runs),
+			'best': min(run['time'] for run in runs), 'pandas': runs[0]['pandas'], 'numpy': runs[0]['numpy'],
+			'modules': runs[0]['modules']}
+
+
+
+def measure(name: str, repeat: int = 5) -> dict:
+	return _summary(name, _probe(PROBE.format(name=name), repeat))
+
+
+
+def measure_run(repeat: int = 5) -> dict:
+	'''Runs `init-db` on a new temporary database every time.'''
+	runs = []
+	for _ in range(repeat):
+		with tempfile.TemporaryDirectory() as root:
+			runs.extend(_probe(RUN_PROBE.format(db=str(Path(root) / 'omnifin.db')), 1))
+	return _summary('init-db (run)', runs)
+
+
+
+def report(result: dict):
+	print(f'{result["script"]:<20} {result["median"]:>7.3f}s {result["best"]:>7.3f}s {result["modules"]:>8}  '
+		  f'{"yes" if result["pandas"] else "no":<6}  {"yes" if result["numpy"] else "no"}')
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('scripts', nargs='*', help='scripts to measure (default: all registered scripts)')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--no-run', action='store_true', help='skip running init-db end to end')
+	args = parser.parse_args()
+
+	print(f'{"script":<20} {"median":>8} {"best":>8} {"modules":>8}  pandas  numpy')
+	for name in args.scripts or list_scripts():
+		report(measure(name, args.repeat))
+	if not args.no_run:
+		report(measure_run(args.repeat))
+
+
+
+if __name__ == '__main__':
+	main()
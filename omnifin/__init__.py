@@ -3,3 +3,8 @@ from . import datacls
 from . import loading
 from . import parsers
 from . import ops
+from . import ledger
+from . import balances
+from . import fx
+from . import portfolio
+from . import extraction
@@ -0,0 +1,99 @@
+from .imports import *
+
+from .datacls import Record, Account, Asset, Statement
+from .money import to_minor, from_minor, asset_scale
+
+
+
+def refresh_balances(conn: sqlite3.Connection = None) -> int:
+	'''
+	Recomputes the running balances of all (account, unit) pairs whose transactions changed, starting from the
+	earliest changed day (everything before is still valid). Returns the number of refreshed pairs.
+	'''
+	if conn is None:
+		conn = Record._conn
+	cursor = conn.cursor()
+	updates = cursor.execute('SELECT account, unit, since FROM balance_updates').fetchall()
+	for account, unit, since in updates:
+		params = {'account': account, 'unit': unit, 'since': since}
+		cursor.execute('DELETE FROM balances WHERE account = :account AND unit = :unit AND day >= :since '
+					   'AND delta = 0', params)
+		cursor.execute('''
+		UPDATE balances SET balance = running.total
+		FROM (
+			SELECT day, SUM(delta) OVER (ORDER BY day) + COALESCE((
+				SELECT balance FROM balances
+				WHERE account = :account AND unit = :unit AND day < :since ORDER BY day DESC LIMIT 1), 0) AS total
+			FROM balances WHERE account = :account AND unit = :unit AND day >= :since
+		) AS running
+		WHERE balances.account = :account AND balances.unit = :unit AND balances.day = running.day
+		''', params)
+	cursor.execute('DELETE FROM balance_updates')
+	return len(updates)
+
+
+
+def balance_at(account: Account | str, unit: Asset | str, date: datelike, *, conn: sqlite3.Connection = None,
+			   refresh: bool = True) -> Optional[int]:
+	'''
+	Balance (in minor units) of `account` in `unit` at the end of `date` according to the transactions
+	(None if there are no transactions up to then).
+	'''
+	if conn is None:
+		conn = Record._conn
+	if refresh:
+		refresh_balances(conn)
+	if not isinstance(account, Record):
+		account = Account.find(account)
+	if not isinstance(unit, Record):
+		unit = Asset.find(unit)
+	row = conn.execute('SELECT balance FROM balances WHERE account = ? AND unit = ? AND day <= ? '
+					   'ORDER BY day DESC LIMIT 1',
+					   (account.ID, unit.ID, date.strftime('%Y-%m-%d'))).fetchone()
+	return None if row is None else row[0]
+
+
+
+def reconcile_statements(statements: Iterable[Statement], *, conn: sqlite3.Connection = None) \
+		-> list[tuple[Statement, Optional[int], int]]:
+	'''
+	Compares every statement to the running balance of its account (each one is a single index lookup).
+	Returns the statements which don't match as (statement, balance in minor units, statement balance in minor units).
+	'''
+	if conn is None:
+		conn = Record._conn
+	refresh_balances(conn)
+	mismatches = []
+	for statement in statements:
+		unit = statement.unit
+		expected = to_minor(statement.balance, asset_scale(unit))
+		computed = balance_at(statement.account, unit, statement.date, conn=conn, refresh=False)
+		if (computed or 0) != expected:
+			mismatches.append((statement, computed, expected))
+	return mismatches
+
+
+
+@fig.script('reconcile')
+def reconcile(cfg: fig.Configuration):
+	conn = cfg.pull('conn')
+
+	accountname = cfg.pull('account', None)
+	statements = Statement.find_all() if accountname is None \
+		else Statement.find_all(account=Account.find(accountname))
+	statements = sorted(statements, key=lambda s: (s.account.name, s.date))
+
+	mismatches = reconcile_statements(statements, conn=conn)
+	conn.commit()
+
+	cfg.print(f'Checked {len(statements)} statements: {len(mismatches)} do not match the transactions.')
+	if len(mismatches):
+		tbl = []
+		for statement, computed, expected in mismatches:
+			scale = asset_scale(statement.unit)
+			tbl.append((statement.date.strftime("%d-%b%y"), colorize(statement.account.name, 'blue'),
+						colorize(statement.unit.name, 'green'), from_minor(expected, scale),
+						None if computed is None else from_minor(computed, scale),
+						from_minor((computed or 0) - expected, scale)))
+		cfg.print(tabulate(tbl, headers=['Date', 'Account', 'Unit', 'Statement', 'Transactions', 'Difference']))
+	return mismatches
@@ -1,4 +1,75 @@
 from .imports import *
+from .money import to_minor, DEFAULT_SCALE, CATEGORY_SCALES
+
+
+
+def add_missing_column(cursor: sqlite3.Cursor, table: str, column: str, decl: str):
+    """Add a column to an existing table (for databases created before the column was introduced)."""
+    existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+    if column not in existing:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+
+
+def fill_minor_units(cursor: sqlite3.Cursor, table: str):
+    """Compute the missing minor unit amounts of a table (for rows written before the columns were introduced)."""
+    scales = {ID: DEFAULT_SCALE if scale is None else scale for ID, scale in cursor.execute('SELECT id, scale FROM assets').fetchall()}
+    rows = cursor.execute(f'SELECT id, amount, unit, received_amount, received_unit FROM {table} '
+                          f'WHERE (amount_minor IS NULL AND amount IS NOT NULL) '
+                          f'OR (received_minor IS NULL AND received_amount IS NOT NULL)').fetchall()
+    cursor.executemany(f'UPDATE {table} SET amount_minor = ?, received_minor = ? WHERE id = ?',
+                       [(to_minor(amount, scales.get(unit, DEFAULT_SCALE)),
+                         to_minor(received, scales.get(received_unit, DEFAULT_SCALE)), ID)
+                        for ID, amount, unit, received, received_unit in rows])
+
+
+
+def rescale_minor_units(cursor: sqlite3.Cursor, table: str, scales: dict[int, int]):
+    """Recompute the minor unit amounts of all rows of a table in the assets whose scale changed (ID -> new scale)."""
+    marks = ', '.join('?' * len(scales))
+    rows = cursor.execute(f'SELECT id, amount, unit, amount_minor, received_amount, received_unit, received_minor '
+                          f'FROM {table} WHERE unit IN ({marks}) OR received_unit IN ({marks})',
+                          [*scales, *scales]).fetchall()
+    cursor.executemany(f'UPDATE {table} SET amount_minor = ?, received_minor = ? WHERE id = ?',
+                       [(to_minor(amount, scales[unit]) if unit in scales else minor,
+                         to_minor(received, scales[received_unit]) if received_unit in scales else received_minor, ID)
+                        for ID, amount, unit, minor, received, received_unit, received_minor in rows])
+
+
+
+# the two signed legs of a transaction row: (account, unit, amount in minor units)
+_BALANCE_LEGS = [
+    ('{row}.sender', '{row}.unit', '-{row}.amount_minor'),
+    ('{row}.receiver', 'COALESCE({row}.received_unit, {row}.unit)',
+     'COALESCE({row}.received_minor, {row}.amount_minor)'),
+]
+
+
+def _balance_trigger_body(row: str, sign: str = '') -> str:
+    """Statements adding (or subtracting, with `sign='-'`) the legs of the `row` to the daily balance deltas."""
+    lines = []
+    for account, unit, amount in _BALANCE_LEGS:
+        account, unit, amount = account.format(row=row), unit.format(row=row), amount.format(row=row)
+        lines.append(f"""
+        INSERT INTO balances (account, unit, day, delta) VALUES ({account}, {unit}, date({row}.dateof), {sign}({amount}))
+        ON CONFLICT (account, unit, day) DO UPDATE SET delta = delta + excluded.delta;""")
+        lines.append(f"""
+        INSERT INTO balance_updates (account, unit, since) VALUES ({account}, {unit}, date({row}.dateof))
+        ON CONFLICT (account, unit) DO UPDATE SET since = MIN(since, excluded.since);""")
+    return ''.join(lines)
+
+
+def rebuild_balances(cursor: sqlite3.Cursor):
+    """Recompute all daily balance deltas from the transactions (the running balances are refreshed lazily)."""
+    cursor.execute('DELETE FROM balances')
+    cursor.execute('DELETE FROM balance_updates')
+    legs = ' UNION ALL '.join(f'SELECT {account.format(row="t")} AS account, {unit.format(row="t")} AS unit, '
+                              f'date(t.dateof) AS day, {amount.format(row="t")} AS delta FROM transactions AS t'
+                              for account, unit, amount in _BALANCE_LEGS)
+    cursor.execute(f'INSERT INTO balances (account, unit, day, delta) '
+                   f'SELECT account, unit, day, SUM(delta) FROM ({legs}) GROUP BY account, unit, day')
+    cursor.execute('INSERT INTO balance_updates (account, unit, since) '
+                   'SELECT account, unit, MIN(day) FROM balances GROUP BY account, unit')
 
 
 
@@ -25,6 +96,7 @@ def init_db(conn: sqlite3.Connection):
         asset_type TEXT NOT NULL,
         description TEXT,
         report INTEGER NOT NULL,
+        scale INTEGER,
         FOREIGN KEY (report) REFERENCES reports(id)
     );
     """)
@@ -77,6 +149,9 @@ def init_db(conn: sqlite3.Connection):
         description TEXT,
         reference TEXT,
         report INTEGER NOT NULL,
+        fingerprint TEXT,
+        amount_minor INTEGER,
+        received_minor INTEGER,
         FOREIGN KEY (unit) REFERENCES assets(id),
         FOREIGN KEY (received_unit) REFERENCES assets(id),
         FOREIGN KEY (sender) REFERENCES accounts(id),
@@ -103,6 +178,9 @@ def init_db(conn: sqlite3.Connection):
         description TEXT,
         reference TEXT,
         report INTEGER NOT NULL,
+        fingerprint TEXT,
+        amount_minor INTEGER,
+        received_minor INTEGER,
         FOREIGN KEY (txn) REFERENCES transactions(id),
         FOREIGN KEY (unit) REFERENCES assets(id),
         FOREIGN KEY (received_unit) REFERENCES assets(id),
@@ -114,6 +192,24 @@ def init_db(conn: sqlite3.Connection):
     c.execute("""
     CREATE INDEX IF NOT EXISTS idx_transactions_dateof ON transactions(dateof);
     """)
+    # content fingerprints make re-importing overlapping exports idempotent
+    add_missing_column(c, 'transactions', 'fingerprint', 'TEXT')
+    add_missing_column(c, 'verifications', 'fingerprint', 'TEXT')
+    c.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_fingerprint ON transactions(fingerprint);
+    """)
+    c.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_verifications_fingerprint ON verifications(fingerprint);
+    """)
+    # exact amounts as integer minor units (the scale is per asset, by default 2 for cents)
+    add_missing_column(c, 'assets', 'scale', 'INTEGER')
+    for table in ['transactions', 'verifications']:
+        add_missing_column(c, table, 'amount_minor', 'INTEGER')
+        add_missing_column(c, table, 'received_minor', 'INTEGER')
+        fill_minor_units(c, table)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_verifications_match ON verifications(sender, receiver, amount_minor);
+    """)
     c.execute("""
     CREATE TABLE IF NOT EXISTS transaction_links (
         id1 INTEGER NOT NULL,
@@ -182,6 +278,184 @@ def init_db(conn: sqlite3.Connection):
         PRIMARY KEY(id, tag_id)
     );
     """)
+    # everything written by a report can be removed in bulk (see the `undo` script)
+    for table in ['statements', 'transactions', 'verifications', 'transaction_links', 'statement_links',
+                  'transaction_tags', 'statement_tags', 'verification_tags', 'account_tags']:
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_report ON {table}(report);')
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_transaction_links_id2 ON transaction_links(id2);
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_statement_links_id2 ON statement_links(id2);
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_verifications_txn ON verifications(txn);
+    """)
+    # daily net change per account and asset (in minor units) with the running balance up to that day,
+    # the deltas are kept up to date by triggers, while the running balances of all days since the earliest
+    # change (see `balance_updates`) are refreshed lazily (see `balances.refresh_balances`)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS balances (
+        account INTEGER NOT NULL,
+        unit INTEGER NOT NULL,
+        day DATE NOT NULL,
+        delta INTEGER NOT NULL DEFAULT 0,
+        balance INTEGER,
+        FOREIGN KEY (account) REFERENCES accounts(id),
+        FOREIGN KEY (unit) REFERENCES assets(id),
+        PRIMARY KEY(account, unit, day)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS balance_updates (
+        account INTEGER NOT NULL,
+        unit INTEGER NOT NULL,
+        since DATE NOT NULL,
+        PRIMARY KEY(account, unit)
+    );
+    """)
+    balances_missing = c.execute('SELECT name FROM sqlite_master WHERE name = ?',
+                                 ('trg_transactions_balances_insert',)).fetchone() is None
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_balances_insert AFTER INSERT ON transactions BEGIN
+        {_balance_trigger_body('NEW')}
+    END;
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_balances_delete AFTER DELETE ON transactions BEGIN
+        {_balance_trigger_body('OLD', '-')}
+    END;
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_balances_update
+    AFTER UPDATE OF dateof, sender, receiver, unit, received_unit, amount_minor, received_minor ON transactions BEGIN
+        {_balance_trigger_body('OLD', '-')}
+        {_balance_trigger_body('NEW')}
+    END;
+    """)
+    if balances_missing:
+        # databases created before the balances were maintained
+        rebuild_balances(c)
+    # assets created before categories had their own default scale (e.g. stocks rounded to cents)
+    scales = {}
+    for category, scale in CATEGORY_SCALES.items():
+        scales.update(c.execute('SELECT id, ? FROM assets WHERE scale IS NULL AND asset_type = ?',
+                                (scale, category)).fetchall())
+    if len(scales):
+        c.executemany('UPDATE assets SET scale = ? WHERE id = ?', [(scale, ID) for ID, scale in scales.items()])
+        for table in ['transactions', 'verifications']:
+            rescale_minor_units(c, table, scales)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fx_rates (
+        base INTEGER NOT NULL,
+        quote INTEGER NOT NULL,
+        day DATE NOT NULL,
+        rate REAL NOT NULL,
+        source TEXT NOT NULL,
+        PRIMARY KEY (base, quote, day),
+        FOREIGN KEY (base) REFERENCES assets(id),
+        FOREIGN KEY (quote) REFERENCES assets(id)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS positions (
+        account INTEGER NOT NULL,
+        asset INTEGER NOT NULL,
+        day DATE NOT NULL,
+        quantity REAL NOT NULL,
+        cost_minor INTEGER NOT NULL,
+        currency INTEGER,
+        lots INTEGER NOT NULL,
+        PRIMARY KEY (account, asset, day),
+        FOREIGN KEY (account) REFERENCES accounts(id),
+        FOREIGN KEY (asset) REFERENCES assets(id),
+        FOREIGN KEY (currency) REFERENCES assets(id)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS realized_gains (
+        method TEXT NOT NULL,
+        trade INTEGER NOT NULL,
+        lot INTEGER NOT NULL,
+        account INTEGER NOT NULL,
+        asset INTEGER NOT NULL,
+        currency INTEGER,
+        opened DATE NOT NULL,
+        closed DATE NOT NULL,
+        tax_year INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        basis_minor INTEGER NOT NULL,
+        proceeds_minor INTEGER NOT NULL,
+        gain_minor INTEGER NOT NULL,
+        PRIMARY KEY (method, trade, lot),
+        FOREIGN KEY (account) REFERENCES accounts(id),
+        FOREIGN KEY (asset) REFERENCES assets(id),
+        FOREIGN KEY (currency) REFERENCES assets(id)
+    );
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_realized_gains_year ON realized_gains(method, tax_year);
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_realized_gains_asset ON realized_gains(method, asset);
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS realized_gains_state (
+        method TEXT NOT NULL,
+        asset INTEGER NOT NULL,
+        signature TEXT NOT NULL,
+        PRIMARY KEY (method, asset)
+    );
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS merchants (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        descriptor_hash INTEGER NOT NULL,
+        descriptor TEXT NOT NULL,
+        merchant TEXT,
+        city TEXT,
+        country TEXT,
+        category TEXT,
+        location TEXT,
+        mcc TEXT,
+        online INTEGER,
+        account INTEGER,
+        report INTEGER NOT NULL,
+        FOREIGN KEY (account) REFERENCES accounts(id),
+        FOREIGN KEY (report) REFERENCES reports(id)
+    );
+    """)
+    # merchants learned from the statements of an account only apply to that account (and keep their location as is)
+    scoped = 'account' in {row[1] for row in c.execute('PRAGMA table_info(merchants)').fetchall()}
+    add_missing_column(c, 'merchants', 'location', 'TEXT')
+    add_missing_column(c, 'merchants', 'account', 'INTEGER REFERENCES accounts(id)')
+    if not scoped:
+        # entries learned by earlier imports belong to the account of their report
+        c.execute('UPDATE merchants SET account = (SELECT associated_account FROM reports '
+                  'WHERE reports.id = merchants.report)')
+    # the merchant category code and whether the merchant is online used to be stored as the category
+    flagged = 'online' in {row[1] for row in c.execute('PRAGMA table_info(merchants)').fetchall()}
+    add_missing_column(c, 'merchants', 'mcc', 'TEXT')
+    add_missing_column(c, 'merchants', 'online', 'INTEGER')
+    if not flagged:
+        c.execute("UPDATE merchants SET online = (category = 'online'), category = NULL "
+                  "WHERE category IN ('online', 'inperson')")
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_merchants_hash ON merchants(descriptor_hash);
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sources (
+        report INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        account TEXT,
+        content_hash TEXT NOT NULL,
+        parser_hash TEXT NOT NULL,
+        FOREIGN KEY (report) REFERENCES reports(id)
+    );
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sources_path ON sources(path, account);
+    """)
     c.execute("""
     CREATE TABLE IF NOT EXISTS transaction_revisions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+from importlib.util import find_spec
+import hashlib
+import inspect
+import json
+import sys
+
+from .imports import *
+
+from .misc import get_path, table_rows
+from .parsers import Parser
+from .datacls import Record, Asset, Account, Tag, Transaction, Verification, Reportable, Tagged, Linkable
+
+
+# parquet needs pyarrow, otherwise the frames are pickled
+FORMAT = 'parquet' if find_spec('pyarrow') is not None else 'pickle'
+
+# part of every key, so increasing it invalidates all cached outputs (e.g. when the way they are stored changes)
+CACHE_VERSION = 1
+
+RECORD_TYPES = {'transaction': Transaction, 'verification': Verification}
+CONCEPT_TYPES = {'asset': Asset, 'account': Account, 'tag': Tag}
+RECORD_KEYS = ('date', 'location', 'sender', 'amount', 'unit', 'receiver', 'received_amount', 'received_unit',
+			   'description', 'reference')
+SUB_KEYS = {'sender', 'unit', 'receiver', 'received_unit'}
+
+
+
+def file_digest(path: Path) -> str:
+	'''Hash of the contents of the file.'''
+	with open(path, 'rb') as f:
+		return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+
+def _used_modules(module) -> dict[str, Any]:
+	'''Modules of this package which `module` imports from (e.g. `misc` for the amount formats).'''
+	package = __name__.rpartition('.')[0]
+	used = {}
+	for value in vars(module).values():
+		name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+		if isinstance(name, str) and name.startswith(f'{package}.') and name in sys.modules:
+			used[name] = sys.modules[name]
+	return used
+
+
+
+def parser_digest(parser: Parser | Type[Parser], settings: fig.Configuration = None) -> str:
+	'''
+	Hash of everything that determines the output of the parser besides the file: its class, the source code of
+	all parser classes it is based on and of the modules of this package they use (so changes to a parser or its
+	helpers invalidate its results), its config and the `CACHE_VERSION`.
+	'''
+	digest = hashlib.sha256(f'version {CACHE_VERSION}'.encode('utf-8'))
+	modules = {}
+	for cls in (parser if isinstance(parser, type) else type(parser)).__mro__:
+		if issubclass(cls, Parser):
+			digest.update(f'{cls.__module__}.{cls.__qualname__}'.encode('utf-8'))
+			module = sys.modules[cls.__module__]
+			modules[module.__name__] = module
+			modules.update(_used_modules(module))
+	for name in sorted(modules):
+		source = inspect.getsourcefile(modules[name])
+		if source is not None:
+			digest.update(Path(source).read_bytes())
+	if settings is not None:
+		digest.update(json.dumps(settings.to_python(), sort_keys=True, default=str).encode('utf-8'))
+	return digest.hexdigest()
+
+
+
+def _sub_name(value) -> Optional[str]:
+	if value is None or isinstance(value, str):
+		return value
+	if isinstance(value, Record):
+		# unresolved placeholders keep the name that was looked up
+		return value.name
+	raise TypeError(f'Can not cache reference: {value!r}')
+
+
+
+@dataclass
+class ParsedStatement:
+	'''Everything a parser produced for one file (after `Parser.finish`), before any of it is written.'''
+	concepts: list[Record]
+	records: list[Reportable]
+	tags: dict[str, list[Tagged]]
+	links: dict[str, list[list[Linkable]]]
+
+
+	def to_frames(self) -> dict[str, pd.DataFrame]:
+		'''
+		The output as tables (tags and links refer to the records by position). Sub-records are stored by name, so
+		they are resolved again when the records are written.
+		'''
+		kinds = {cls: kind for kind, cls in RECORD_TYPES.items()}
+		positions = {id(record): i for i, record in enumerate(self.records)}
+
+		rows = []
+		for record in self.records:
+			if type(record) not in kinds:
+				raise TypeError(f'Can not cache record: {record!r}')
+			row = {'kind': kinds[type(record)]}
+			for key in RECORD_KEYS:
+				value = getattr(record, f'_{key}', None) if key in SUB_KEYS else getattr(record, key)
+				row[key] = _sub_name(value) if key in SUB_KEYS else value
+			# dates are stored as text to keep dates and datetimes apart
+			row['date'] = None if row['date'] is None else row['date'].isoformat()
+			rows.append(row)
+
+		concepts = [{'kind': kind, 'content': json.dumps({key: getattr(concept, key)
+														 for key in concept._content_keys})}
+					for concept in self.concepts
+					for kind, cls in CONCEPT_TYPES.items() if type(concept) is cls]
+		if len(concepts) != len(self.concepts):
+			raise TypeError(f'Can not cache concepts: {self.concepts!r}')
+
+		def position(record: Reportable) -> int:
+			if id(record) not in positions:
+				raise TypeError(f'Can not cache reference to a record that is not part of the output: {record!r}')
+			return positions[id(record)]
+
+		tags = [(tag, position(record)) for tag, records in self.tags.items() for record in records]
+		links = [(category, i, position(record)) for category, groups in self.links.items()
+				 for i, group in enumerate(groups) for record in group]
+
+		return {
+			'records': pd.DataFrame(rows, columns=['kind', *RECORD_KEYS]),
+			'concepts': pd.DataFrame(concepts, columns=['kind', 'content']),
+			'tags': pd.DataFrame(tags, columns=['tag', 'record']),
+			'links': pd.DataFrame(links, columns=['category', 'group', 'record']),
+		}
+
+
+	@classmethod
+	def from_frames(cls, frames: dict[str, pd.DataFrame]) -> 'ParsedStatement':
+		records = []
+		for row in table_rows(frames['records']):
+			kind, date = row.pop('kind'), row.pop('date')
+			record = RECORD_TYPES[kind](**row)
+			if date is not None:
+				record.date = datetime.fromisoformat(date) if 'T' in date else datelike.fromisoformat(date)
+			records.append(record)
+
+		concepts = [CONCEPT_TYPES[kind](**json.loads(content))
+					for kind, content in zip(frames['concepts']['kind'], frames['concepts']['content'])]
+
+		tags = {}
+		for tag, position in zip(frames['tags']['tag'], frames['tags']['record'].tolist()):
+			tags.setdefault(tag, []).append(records[position])
+
+		links = {}
+		groups = {}
+		for category, group, position in zip(frames['links']['category'], frames['links']['group'].tolist(),
+											 frames['links']['record'].tolist()):
+			if (category, group) not in groups:
+				groups[category, group] = []
+				links.setdefault(category, []).append(groups[category, group])
+			groups[category, group].append(records[position])
+
+		return cls(concepts, records, tags, links)
+
+
+
+class ParseCache:
+	'''
+	Stores the parsed output of statement files as tables (Parquet if available) under `root`, keyed by the contents
+	of the file, the parser (class, source and config) and the account, so unchanged files don't have to be parsed
+	again (e.g. when rebuilding the database with `full-reset`).
+
+	The output is stored before known merchants fill in missing locations, which happens after loading it (so that
+	changes to the merchants apply to cached outputs too).
+	'''
+	def __init__(self, root: Path | str, *, format: str = FORMAT):
+		self.root = Path(root)
+		self.format = format
+
+
+	@staticmethod
+	def key(content_hash: str, parser_hash: str, account: str = None) -> str:
+		'''Key of a file (see `file_digest`) parsed by a parser (see `parser_digest`) for an account.'''
+		return hashlib.sha256('\n'.join([content_hash, parser_hash, str(account)]).encode('utf-8')).hexdigest()
+
+
+	def _path(self, key: str, name: str) -> Path:
+		return self.root / key / f'{name}.{"parquet" if self.format == "parquet" else "pkl"}'
+
+
+	def load(self, key: str) -> Optional[ParsedStatement]:
+		'''Returns the cached output (or None if there is none).'''
+		names = ['records', 'concepts', 'tags', 'links']
+		if not all(self._path(key, name).exists() for name in names):
+			return None
+		read = pd.read_parquet if self.format == 'parquet' else pd.read_pickle
+		return ParsedStatement.from_frames({name: read(self._path(key, name)) for name in names})
+
+
+	def save(self, key: str, parsed: ParsedStatement) -> bool:
+		'''Stores the output, returns False if it can't be cached (e.g. unsupported record types).'''
+		try:
+			frames = parsed.to_frames()
+		except TypeError:
+			return False
+		(self.root / key).mkdir(parents=True, exist_ok=True)
+		# records last, since they mark the entry as complete
+		for name in ['concepts', 'tags', 'links', 'records']:
+			path = self._path(key, name)
+			tmp = path.with_suffix('.tmp')
+			if self.format == 'parquet':
+				frames[name].to_parquet(tmp, index=False)
+			else:
+				frames[name].to_pickle(tmp)
+			tmp.replace(path)
+		return True
+
+
+
+def create_parse_cache(cfg: fig.Configuration) -> Optional[ParseCache]:
+	'''The cache in the directory `parse-cache` (if set).'''
+	root = get_path(cfg, path_key='parse-cache', root_key='root')
+	if root is not None:
+		return ParseCache(root)
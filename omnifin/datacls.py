@@ -1,7 +1,10 @@
-import humanize
+import hashlib
+import inspect
+import threading
 
 from .imports import *
 from .errors import ConnectionNotSet, NoRecordFound
+from .money import Money, to_minor, asset_scale, CATEGORY_SCALES
 
 
 
@@ -38,6 +41,13 @@ class RecordBase:
 		RecordBase._conn = conn
 
 
+	# optional in-memory index of concepts used by `find` instead of querying the table (see `Resolver`)
+	_resolver: 'Resolver' = None
+	@classmethod
+	def set_resolver(cls, resolver: Optional['Resolver']):
+		RecordBase._resolver = resolver
+
+
 	# def __new__(cls, *args, **kwargs):
 	# 	if cls._conn is not None:
 	# 		return cls.find(*args, **kwargs)
@@ -62,6 +72,29 @@ class RecordBase:
 	# list of attributes to use for writing to the table
 	_content_keys = None
 
+	# optional unique column - inserting a row that conflicts on it is silently skipped
+	_unique_key = None
+
+	# content values (by attribute) as they were last loaded from or written to the table
+	_loaded: dict[str, Any] = None
+
+	# content attributes that were set since the record was loaded (None if never loaded)
+	_dirty: set[str] = None
+
+	# (previous, new) values of the columns written by the last `update` (see `changes`)
+	last_changes: dict[str, tuple[Any, Any]] = None
+
+
+	def __setattr__(self, key, value):
+		super().__setattr__(key, value)
+		if self._dirty is not None and key in self._content_keys:
+			self._dirty.add(key)
+
+
+	@property
+	def dirty(self) -> bool:
+		return self._dirty is None or len(self._dirty) > 0
+
 
 	def _table_row_data(self, raw: dict = None):
 		raw = raw or {}
@@ -70,6 +103,48 @@ class RecordBase:
 		return items
 
 
+	def _column_value(self, key: str):
+		# avoids looking up sub-records that are only referenced by ID
+		if isinstance(inspect.getattr_static(self, key, None), sub):
+			value = getattr(self, f'_{key}', None)
+			if isinstance(value, str):
+				value = getattr(self, key)
+		else:
+			value = getattr(self, key)
+		return value.ID if isinstance(value, Record) else value
+
+
+	def _mark_clean(self):
+		self._loaded = {key: self._column_value(key) for key in self._content_keys}
+		self._dirty = set()
+
+
+	def changes(self) -> dict[str, tuple[Any, Any]]:
+		'''Returns the (previous, new) values of all attributes that differ from the table row.'''
+		if not self.dirty:
+			return {}
+		loaded = self._loaded or {}
+		keys = self._content_keys if self._dirty is None else [key for key in self._content_keys if key in self._dirty]
+		changes = {}
+		for key in keys:
+			value = self._column_value(key)
+			if key not in loaded or loaded[key] != value:
+				changes[key] = loaded.get(key), value
+		return changes
+
+
+	def _update_values(self, changes: dict[str, tuple[Any, Any]]):
+		return {self._table_keys.get(key, key): new for key, (old, new) in changes.items()}
+
+
+	def _apply_changes(self, changes: dict[str, tuple[Any, Any]], cursor: sqlite3.Cursor):
+		values = self._update_values(changes)
+		key_info = ", ".join(f"{key} = ?" for key in values.keys())
+		cmd = f'UPDATE {self._table_name} SET {key_info} WHERE {self._id_key} = ?'
+		cursor.execute(cmd, (*list(values.values()), self.ID))
+		self._mark_clean()
+
+
 	def write(self, *, cursor=None, force=False):
 		if cursor is None:
 			cursor = self._conn.cursor()
@@ -78,22 +153,31 @@ class RecordBase:
 		if not self.exists or force:
 			items = self._table_row_data()
 			cmd = f'INSERT INTO {self._table_name} ({", ".join(items.keys())}) VALUES ({", ".join("?"*len(items))})'
+			if self._unique_key is not None:
+				cmd += f' ON CONFLICT ({self._unique_key}) DO NOTHING'
 			cursor.execute(cmd, tuple(items.values()))
+			if cursor.rowcount == 0:
+				return
+			self._mark_clean()
 			return cursor.lastrowid
 
 
 	def update(self, *, cursor=None):
+		'''
+		Writes only the columns that changed since the record was loaded and returns the ID
+		(the changes are kept in `last_changes`).
+		'''
 		if cursor is None:
 			cursor = self._conn.cursor()
 		if cursor is None:
 			raise ValueError('No connection provided')
 		if not self.exists:
 			return self.write(cursor=cursor)
-		items = self._table_row_data()
-		key_info = ", ".join(f"{key} = ?" for key in items.keys())
-		cmd = f'UPDATE {self._table_name} SET {key_info} WHERE {self._id_key} = ?'
-		cursor.execute(cmd, (*list(items.values()), self.ID))
-		return cursor.lastrowid
+		changes = self.changes()
+		if len(changes):
+			self._apply_changes(changes, cursor)
+		self.last_changes = changes
+		return self.ID
 
 
 	def _volatile(self):
@@ -121,6 +205,11 @@ class RecordBase:
 			except ValueError:
 				pass
 		assert isinstance(query, int) or cls._query_key is not None, f'Invalid query: {query!r}'
+		if cls._resolver is not None and cls._resolver.tracks(cls):
+			record = cls._resolver.lookup(cls, query)
+			if record is None:
+				raise NoRecordFound(f'No {cls.__name__} found for {query!r}')
+			return record
 		if cls._conn is None:
 			raise ConnectionNotSet()
 		for key in [cls._id_key] if cls._query_key is None else [cls._query_key, cls._id_key]:
@@ -128,7 +217,7 @@ class RecordBase:
 				command = f'SELECT * FROM {cls._table_name} WHERE {cls._table_keys.get(key, key)} = ?'
 				raw = cls._conn.execute(command, (value,)).fetchone()
 				if raw is not None:
-					return cls._from_row(*raw)
+					return cls._load_row(raw)
 		raise NoRecordFound(f'No {cls.__name__} found for {query!r}')
 
 
@@ -137,6 +226,13 @@ class RecordBase:
 		return cls(*data, ID=ID)
 
 
+	@classmethod
+	def _load_row(cls, row: tuple):
+		record = cls._from_row(*row)
+		record._mark_clean()
+		return record
+
+
 	@classmethod
 	def find_all(cls, **props):
 		props = {k: v.ID if isinstance(v, Record) else v for k, v in props.items()}
@@ -150,7 +246,7 @@ class RecordBase:
 			out = cls._conn.execute(f'SELECT * FROM {cls._table_name}').fetchall()
 
 		for row in out:
-			yield cls._from_row(*row)
+			yield cls._load_row(row)
 
 
 
@@ -171,6 +267,8 @@ class Record(RecordBase):
 		ID = super().write(cursor=cursor, force=force)
 		if ID is not None and self.ID is None:
 			self.ID = ID
+			if self._resolver is not None:
+				self._resolver.add(self)
 		return ID
 
 
@@ -234,12 +332,22 @@ class Reportable(RecordBase):
 	report: Report = sub(Report)
 
 
+	# optional table logging every change made by `update` (see `write_revisions`)
+	_revision_table_name = None
+
+
 	def _table_row_data(self, raw: dict = None):
 		items = super()._table_row_data(raw)
 		items['report'] = self.report.ID
 		return items
 
 
+	def _update_values(self, changes: dict[str, tuple[Any, Any]]):
+		values = super()._update_values(changes)
+		values['report'] = self.report.ID
+		return values
+
+
 	def write(self, report: Report, *, cursor=None, force=False):
 		if self.exists:
 			return self.update(report, cursor=cursor)
@@ -248,10 +356,296 @@ class Reportable(RecordBase):
 
 
 	def update(self, report: Report, *, cursor=None):
-		if self.exists:
+		if not self.exists:
+			return self.write(report, cursor=cursor)
+		if cursor is None:
+			cursor = self._conn.cursor()
+		changes = self.changes()
+		if len(changes):
 			self.report = report
-			return super().update(cursor=cursor)
-		return self.write(report, cursor=cursor)
+			self._apply_changes(changes, cursor)
+			self.write_revisions(report, [(self, changes)], cursor=cursor)
+		self.last_changes = changes
+		return self.ID
+
+
+	@staticmethod
+	def _revision_value(value):
+		if value is None:
+			return
+		if isinstance(value, datetime):
+			return value.strftime('%Y-%m-%d' if value.time() == datetime.min.time() else '%Y-%m-%d %H:%M:%S')
+		return str(value)
+
+
+	@classmethod
+	def write_revisions(cls, report: Report, changes: Iterable[tuple['Reportable', dict[str, tuple[Any, Any]]]],
+						*, cursor=None):
+		if cls._revision_table_name is None:
+			return
+		if cursor is None:
+			cursor = cls._conn.cursor()
+		rows = [(rec.ID, key, cls._revision_value(old), cls._revision_value(new), report.ID)
+				for rec, diff in changes for key, (old, new) in diff.items()]
+		cursor.executemany(f'INSERT INTO {cls._revision_table_name} '
+						   f'(ref_id, property, previous_value, new_value, report) VALUES (?, ?, ?, ?, ?)', rows)
+
+
+	@classmethod
+	def write_all(cls, report: Report, records: Iterable['Reportable'], *, cursor=None):
+		written = []
+		for rec in records:
+			rec.write(report, cursor=cursor)
+			written.append(rec)
+		return written
+
+
+	@classmethod
+	def update_all(cls, report: Report, records: Iterable['Reportable'], *, cursor=None):
+		'''
+		Updates the changed columns of all given records in bulk (grouped by which columns changed)
+		and logs the revisions. Returns the records that actually changed.
+		'''
+		if cursor is None:
+			cursor = cls._conn.cursor()
+		groups: dict[tuple[str, ...], list[tuple[Reportable, dict[str, tuple[Any, Any]]]]] = {}
+		for rec in records:
+			if not rec.exists:
+				rec.write(report, cursor=cursor)
+				continue
+			changes = rec.changes()
+			if len(changes):
+				rec.report = report
+				groups.setdefault(tuple(changes.keys()), []).append((rec, changes))
+
+		changed = []
+		for group in groups.values():
+			values = [rec._update_values(diff) for rec, diff in group]
+			columns = list(values[0].keys())
+			key_info = ", ".join(f"{key} = ?" for key in columns)
+			cursor.executemany(f'UPDATE {cls._table_name} SET {key_info} WHERE {cls._id_key} = ?',
+							   [(*[vals[col] for col in columns], rec.ID) for vals, (rec, _) in zip(values, group)])
+			for rec, diff in group:
+				rec._mark_clean()
+				rec.last_changes = diff
+			changed.extend(group)
+
+		cls.write_revisions(report, changed, cursor=cursor)
+		return [rec for rec, _ in changed]
+
+
+
+@dataclass
+class Fingerprinted(Reportable):
+	'''
+	Records with a deterministic content fingerprint, so that re-importing overlapping exports
+	skips rows that are already in the database instead of duplicating them.
+	'''
+	def __init__(self, *, fingerprint: str = None, **kwargs):
+		super().__init__(**kwargs)
+		self.fingerprint = fingerprint
+
+
+	fingerprint: str = None
+
+	# attributes identifying the same real-world event across imports
+	_fingerprint_keys = None
+	_unique_key = 'fingerprint'
+
+	# max number of parameters per query when looking up fingerprints
+	_fingerprint_chunk = 500
+
+
+	@staticmethod
+	def _fingerprint_value(value):
+		if value is None:
+			return ''
+		if isinstance(value, RecordBase):
+			return str(getattr(value, 'name', value.ID))
+		if isinstance(value, datetime):
+			return value.strftime('%Y-%m-%d' if value.time() == datetime.min.time() else '%Y-%m-%d %H:%M:%S')
+		if isinstance(value, datelike):
+			return value.strftime('%Y-%m-%d')
+		if isinstance(value, (int, float)):
+			return repr(float(value))
+		return str(value).strip()
+
+
+	def fingerprint_key(self) -> str:
+		return '|'.join(self._fingerprint_value(getattr(self, key)) for key in self._fingerprint_keys)
+
+
+	def compute_fingerprint(self, occurrence: int = 0) -> str:
+		'''
+		Identical rows within one import (e.g. two coffees on the same day) are told apart by their
+		`occurrence` index, so that they are not collapsed into one.
+		'''
+		key = self.fingerprint_key()
+		if occurrence:
+			key = f'{key}|{occurrence}'
+		return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+	def _table_row_data(self, raw: dict = None):
+		items = super()._table_row_data(raw)
+		items['fingerprint'] = self.fingerprint
+		return items
+
+
+	def write(self, report: Report, *, cursor=None, force=False):
+		if not self.exists and self.fingerprint is None:
+			self.fingerprint = self.compute_fingerprint()
+		return super().write(report, cursor=cursor, force=force)
+
+
+	@classmethod
+	def write_all(cls, report: Report, records: Iterable['Fingerprinted'], *, cursor=None,
+				  seen: Counter = None):
+		'''
+		Inserts all new records in bulk, skipping those whose fingerprint is already in the table.
+
+		`seen` counts the fingerprint keys of the current import (pass the same counter when writing
+		an import in several batches). Returns the records that were actually written.
+		'''
+		if cursor is None:
+			cursor = cls._conn.cursor()
+		if seen is None:
+			seen = Counter()
+		assert report.exists, 'Report not written to database'
+
+		written = []
+		todo = []
+		for rec in records:
+			if rec.exists:
+				rec.write(report, cursor=cursor)
+				written.append(rec)
+				continue
+			if rec.fingerprint is None:
+				key = rec.fingerprint_key()
+				rec.fingerprint = rec.compute_fingerprint(seen[key])
+				seen[key] += 1
+			rec.report = report
+			todo.append(rec)
+		if not len(todo):
+			return written
+
+		rows = [rec._table_row_data() for rec in todo]
+		keys = list(rows[0].keys())
+		cmd = (f'INSERT INTO {cls._table_name} ({", ".join(keys)}) VALUES ({", ".join("?"*len(keys))}) '
+			   f'ON CONFLICT ({cls._unique_key}) DO NOTHING')
+		cursor.executemany(cmd, [tuple(row[key] for key in keys) for row in rows])
+
+		ids = {}
+		for i in range(0, len(todo), cls._fingerprint_chunk):
+			chunk = [rec.fingerprint for rec in todo[i:i + cls._fingerprint_chunk]]
+			query = (f'SELECT fingerprint, {cls._id_key} FROM {cls._table_name} '
+					 f'WHERE report = ? AND fingerprint IN ({", ".join("?"*len(chunk))})')
+			ids.update(cursor.execute(query, (report.ID, *chunk)).fetchall())
+
+		for rec in todo:
+			ID = ids.get(rec.fingerprint)
+			if ID is not None:
+				rec.ID = ID
+				rec._mark_clean()
+				written.append(rec)
+		return written
+
+
+	@classmethod
+	def fill_fingerprints(cls, *, cursor=None) -> int:
+		'''
+		Computes the missing fingerprints of rows written before fingerprints were introduced, so that importing
+		their statements again skips them. Identical rows are numbered in the order they were written (like within
+		one import), skipping fingerprints that are already taken. Returns the number of filled rows.
+		'''
+		if cursor is None:
+			cursor = cls._conn.cursor()
+		rows = cursor.execute(f'SELECT * FROM {cls._table_name} WHERE fingerprint IS NULL '
+							  f'ORDER BY {cls._id_key}').fetchall()
+		if not len(rows):
+			return 0
+		taken = {fingerprint for fingerprint, in cursor.execute(f'SELECT fingerprint FROM {cls._table_name} '
+																f'WHERE fingerprint IS NOT NULL')}
+		seen = Counter()
+		updates = []
+		for row in rows:
+			rec = cls._load_row(row)
+			key = rec.fingerprint_key()
+			while (fingerprint := rec.compute_fingerprint(seen[key])) in taken:
+				seen[key] += 1
+			seen[key] += 1
+			taken.add(fingerprint)
+			updates.append((fingerprint, rec.ID))
+		cursor.executemany(f'UPDATE {cls._table_name} SET fingerprint = ? WHERE {cls._id_key} = ?', updates)
+		return len(updates)
+
+
+
+@dataclass
+class Monetary(Reportable):
+	'''
+	Records with an amount (and optionally a received amount) which are also stored exactly as integer minor units
+	of their asset (e.g. cents), so that they can be matched, summed and indexed exactly.
+	'''
+	# as stored in the table (updated whenever the record is written)
+	amount_minor: int = None
+	received_minor: int = None
+
+	# amount attribute -> (minor units attribute, unit attribute)
+	_minor_keys = {'amount': ('amount_minor', 'unit'), 'received_amount': ('received_minor', 'received_unit')}
+
+
+	def _compute_minor(self, key: str) -> Optional[int]:
+		amount = getattr(self, key)
+		if amount is None:
+			return None
+		minor_key, unit_key = self._minor_keys[key]
+		return to_minor(amount, asset_scale(getattr(self, unit_key)))
+
+
+	def minor_amount(self, key: str = 'amount') -> Optional[int]:
+		'''Exact amount in minor units (as stored, unless the record changed since it was loaded).'''
+		minor = getattr(self, self._minor_keys[key][0])
+		if minor is None or self.dirty:
+			minor = self._compute_minor(key)
+		return minor
+
+
+	def _money(self, key: str) -> Optional[Money]:
+		minor = self.minor_amount(key)
+		if minor is None:
+			return None
+		unit = getattr(self, self._minor_keys[key][1])
+		return Money(minor, getattr(unit, 'name', unit), asset_scale(unit))
+
+
+	@property
+	def money(self) -> Optional[Money]:
+		return self._money('amount')
+
+
+	@property
+	def received_money(self) -> Optional[Money]:
+		return self._money('received_amount')
+
+
+	def _table_row_data(self, raw: dict = None):
+		items = super()._table_row_data(raw)
+		for key, (minor_key, _) in self._minor_keys.items():
+			minor = self._compute_minor(key)
+			setattr(self, minor_key, minor)
+			items[minor_key] = minor
+		return items
+
+
+	def _update_values(self, changes: dict[str, tuple[Any, Any]]):
+		values = super()._update_values(changes)
+		for key, (minor_key, unit_key) in self._minor_keys.items():
+			if key in changes or unit_key in changes:
+				minor = self._compute_minor(key)
+				setattr(self, minor_key, minor)
+				values[minor_key] = minor
+		return values
 
 
 
@@ -289,26 +683,31 @@ class Shortcutable(Concept):
 
 @dataclass
 class Asset(Shortcutable, Record):
-	def __init__(self, name: str = None, *, category: str = None, description: str = None, **kwargs):
+	def __init__(self, name: str = None, *, category: str = None, description: str = None, scale: int = None,
+				 **kwargs):
 		super().__init__(**kwargs)
 		self.name = name
 		self.category = category
 		self.description = description
+		self.scale = CATEGORY_SCALES.get(category) if scale is None else scale
 
 
 	name: str = None
 	category: str = None
 	description: str = None
+	# decimal places of the minor unit (e.g. 2 for cents), defaults to `money.CATEGORY_SCALES` for the category or
+	# `money.DEFAULT_SCALE`
+	scale: int = None
 
 	_table_name = 'assets'
 	_query_key = 'name'
-	_content_keys = 'name', 'category', 'description'
+	_content_keys = 'name', 'category', 'description', 'scale'
 	_table_keys = {'ID': 'id', 'name': 'asset_name', 'category': 'asset_type'}
 
 
 	@classmethod
-	def _from_row(cls, ID, name, category, description, report):
-		return cls(ID=ID, name=name, category=category, description=description, report=report)
+	def _from_row(cls, ID, name, category, description, report, scale=None):
+		return cls(ID=ID, name=name, category=category, description=description, scale=scale, report=report)
 
 
 	def __str__(self):
@@ -527,6 +926,7 @@ class Statement(Linkable, Tagged):
 
 	_table_name = 'statements'
 	_tag_table_name = 'statement_tags'
+	_revision_table_name = 'statement_revisions'
 	_content_keys = 'date', 'account', 'balance', 'unit', 'description'
 	_table_keys = {'ID': 'id', 'date': 'dateof'}
 
@@ -589,7 +989,7 @@ Statement._link_type = StatementLink
 
 
 @dataclass
-class Transaction(Linkable, Tagged):
+class Transaction(Fingerprinted, Monetary, Linkable, Tagged):
 	date: datelike = None
 	location: str = None
 	sender: Account = sub(Account)
@@ -604,22 +1004,25 @@ class Transaction(Linkable, Tagged):
 
 	_table_name = 'transactions'
 	_tag_table_name = 'transaction_tags'
+	_revision_table_name = 'transaction_revisions'
 	_content_keys = ('date', 'location', 'sender', 'amount', 'unit',
 					 'receiver', 'received_amount', 'received_unit',
 					 'description', 'reference')
 	_table_keys = {'ID': 'id', 'date': 'dateof'}
+	_fingerprint_keys = 'sender', 'receiver', 'date', 'amount', 'unit', 'reference'
 
 
 	@classmethod
 	def _from_row(cls, ID, date, location, sender, amount, unit, receiver, received_amount, received_unit,
-				  description, reference, report):
+				  description, reference, report, fingerprint=None, amount_minor=None, received_minor=None):
 		try:
 			date = datetime.strptime(date, '%Y-%m-%d')
 		except ValueError:
 			date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
 		return cls(ID=ID, date=date, location=location, sender=sender, amount=amount, unit=unit,
 				   receiver=receiver, received_amount=received_amount, received_unit=received_unit,
-				   description=description, reference=reference, report=report)
+				   description=description, reference=reference, report=report, fingerprint=fingerprint,
+				   amount_minor=amount_minor, received_minor=received_minor)
 
 
 	def __str__(self):
@@ -674,7 +1077,7 @@ Transaction._link_type = TransactionLink
 
 
 @dataclass
-class Verification(Reportable, Tagged):
+class Verification(Fingerprinted, Monetary, Tagged):
 	txn: Transaction = None
 	date: datelike = None
 	location: str = None
@@ -694,18 +1097,20 @@ class Verification(Reportable, Tagged):
 					 'receiver', 'received_amount', 'received_unit',
 					 'description', 'reference')
 	_table_keys = {'ID': 'id', 'date': 'dateof'}
+	_fingerprint_keys = 'sender', 'receiver', 'date', 'amount', 'unit', 'reference'
 
 
 	@classmethod
 	def _from_row(cls, ID, txn, date, location, sender, amount, unit, receiver, received_amount, received_unit,
-				  description, reference, report):
+				  description, reference, report, fingerprint=None, amount_minor=None, received_minor=None):
 		try:
 			date = datetime.strptime(date, '%Y-%m-%d')
 		except ValueError:
 			date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
 		return cls(ID=ID, txn=txn, date=date, location=location, sender=sender, amount=amount, unit=unit,
 				   receiver=receiver, received_amount=received_amount, received_unit=received_unit,
-				   description=description, reference=reference, report=report)
+				   description=description, reference=reference, report=report, fingerprint=fingerprint,
+				   amount_minor=amount_minor, received_minor=received_minor)
 
 
 	def __str__(self):
@@ -731,3 +1136,86 @@ class Verification(Reportable, Tagged):
 		# return str(self)
 
 
+
+class Resolver:
+	'''
+	In-memory index of all concepts (accounts, assets and tags by default) by ID and by name.
+
+	While it is set (see `RecordBase.set_resolver`), `find` for these types is a dict lookup instead of up to six
+	queries. Newly written records are added automatically. `find` and `resolve` record any misses instead of
+	raising, so they can all be reported together at the end.
+	'''
+	def __init__(self, *record_types: Type[Record]):
+		if not len(record_types):
+			record_types = Account, Asset, Tag
+		self.ids: dict[Type[Record], dict[int, Record]] = {typ: {} for typ in record_types}
+		self.names: dict[Type[Record], dict[str, Record]] = {typ: {} for typ in record_types}
+		self.missing: dict[Type[Record], Counter] = {}
+		# misses can be recorded by the parser and a background writer at the same time
+		self._lock = threading.Lock()
+
+
+	def load(self):
+		for typ in self.ids:
+			for record in typ.find_all():
+				self.add(record)
+		return self
+
+
+	def __enter__(self):
+		RecordBase.set_resolver(self)
+		return self
+
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		RecordBase.set_resolver(None)
+
+
+	def tracks(self, cls: Type[Record]):
+		return cls in self.ids
+
+
+	def add(self, record: Record):
+		typ = type(record)
+		if typ in self.ids and record.exists:
+			self.ids[typ][record.ID] = record
+			# same as the table lookup, the first record with a name wins
+			self.names[typ].setdefault(getattr(record, typ._query_key), record)
+
+
+	def lookup(self, cls: Type[Record], query: str | int) -> Optional[Record]:
+		'''Same lookup order as `RecordBase.find` (but without shortcuts), returns None if nothing matches.'''
+		names = self.names[cls]
+		if isinstance(query, int):
+			return names.get(str(query), self.ids[cls].get(query))
+		for value in [query, query.lower(), query.upper()]:
+			if value in names:
+				return names[value]
+
+
+	def find(self, cls: Type[Record], query: str | int, uses: int = 1) -> Optional[Record]:
+		'''Like `cls.find` (including shortcuts), except that misses are recorded and None is returned.'''
+		try:
+			return cls.find(query)
+		except NoRecordFound:
+			with self._lock:
+				self.missing.setdefault(cls, Counter())[query] += uses
+
+
+	def resolve(self, record: RecordBase) -> bool:
+		'''Replaces all names of sub-records of `record` by the records, returns False if any are missing.'''
+		resolved = True
+		for key in record._content_keys:
+			attr = inspect.getattr_static(record, key, None)
+			if isinstance(attr, sub) and self.tracks(attr.record_type):
+				value = getattr(record, f'_{key}', None)
+				if isinstance(value, (int, str)):
+					value = self.find(attr.record_type, value)
+					if value is None:
+						resolved = False
+					else:
+						setattr(record, f'_{key}', value)
+				elif isinstance(value, Record) and not value.exists:
+					# placeholder for a miss that was already recorded
+					resolved = False
+		return resolved
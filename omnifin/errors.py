@@ -13,6 +13,25 @@ class NoRecordFound(Exception):
 
 
 
+class AmountFormatError(ValueError):
+	def __init__(self, values: 'pd.Series', name: str = None):
+		self.values = values
+		self.rows = values.index.tolist()
+		info = '' if name is None else f' in {name!r}'
+		examples = ', '.join(f'{row}: {val!r}' for row, val in values.head(5).items())
+		super().__init__(f'Could not convert {len(values)} amounts{info} (rows {self.rows}), e.g. {examples}')
+
+
+
+class UnresolvedConcepts(NoRecordFound):
+	def __init__(self, missing: dict[type, 'Counter']):
+		self.missing = missing
+		info = '; '.join(f'{typ.__name__}: {", ".join(f"{query!r} ({num})" for query, num in queries.most_common())}'
+						 for typ, queries in missing.items())
+		super().__init__(f'Could not find {sum(map(len, missing.values()))} concepts (number of uses): {info}')
+
+
+
 
 
 
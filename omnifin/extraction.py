@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+
+from .imports import *
+
+from .writing import create_report
+from .merchants import Merchant, MerchantCache, normalize_descriptor, online_flag
+
+
+TEMPLATE = '''Extract information from each of these descriptions in exactly the given format:
+
+original,MCC,merchant,city,state,online
+
+Input:
+"WWW.1AND1.COM CHESTERBROOK PA"
+"QFC #5860 REDMOND WA"
+"TST* Oasis Tea Zone - ChiSeattle WA"
+"WWW COSTCO COM 800-955-2292 WA"
+"SPIRIT AIRL 4870357674242800-7727117 FLNAME:  DEPART:"
+"LATE FEE - FEB PAYMENT PAST DUE"
+"Netflix 1 8445052993 CA"
+Output:
+"WWW.1AND1.COM CHESTERBROOK PA","4816","WWW.1AND1.COM","Chesterbrook","Pennsylvania","online"
+"QFC #5860 REDMOND WA","5411","QFC #5860","Redmond","Washington","inperson"
+"TST* Oasis Tea Zone - ChiSeattle WA","5814","TST* Oasis Tea Zone - Chi","Seattle","Washington","inperson"
+"WWW COSTCO COM 800-955-2292 WA","5310","WWW COSTCO COM","","Washington","online"
+"SPIRIT AIRL 4870357674242800-7727117 FLNAME:  DEPART:","3003","SPIRIT AIRL","","","online"
+"LATE FEE - FEB PAYMENT PAST DUE","6012","LATE FEE - FEB PAYMENT PAST DUE","","","online"
+"Netflix 1 8445052993 CA","4899","Netflix","","California","online"
+
+Input:
+{prompts}
+Output:'''
+
+
+
+class ExtractionBackend(fig.Configurable):
+	'''Resolves a batch of descriptors (e.g. by prompting a language model with `TEMPLATE`).'''
+	def __init__(self, template: str = None):
+		self.template = TEMPLATE if template is None else template
+
+
+	def build_prompt(self, descriptors: list[str]) -> str:
+		return self.template.format(prompts='\n'.join(f'"{descriptor}"' for descriptor in descriptors))
+
+
+	def complete(self, prompt: str, descriptors: list[str]) -> Optional[str]:
+		'''Returns the response to the prompt (or None if it is not available yet).'''
+		raise NotImplementedError
+
+
+	@staticmethod
+	def parse_response(text: str, descriptors: list[str]) -> dict[str, Merchant]:
+		'''Reads the CSV lines of a response (in the format of `TEMPLATE`), ignoring anything that wasn't asked.'''
+		asked = {normalize_descriptor(descriptor): descriptor for descriptor in descriptors}
+		results = {}
+		for row in csv.reader(line.strip() for line in text.splitlines() if line.strip()):
+			if len(row) != 6 or normalize_descriptor(row[0]) not in asked:
+				continue
+			_, mcc, merchant, city, state, online = (cell.strip() for cell in row)
+			results[asked[normalize_descriptor(row[0])]] = Merchant(merchant or None, city or None, state or None,
+																	mcc=mcc or None, online=online_flag(online))
+		return results
+
+
+	def extract(self, descriptors: list[str]) -> dict[str, Merchant]:
+		response = self.complete(self.build_prompt(descriptors), descriptors)
+		return {} if response is None else self.parse_response(response, descriptors)
+
+
+
+@fig.component('extraction/stub')
+class StubBackend(ExtractionBackend):
+	'''
+	Offline backend which answers with a simple heuristic (the last word is the state if it has two letters, and the
+	word before it the city), e.g. to test the pipeline.
+	'''
+	def complete(self, prompt: str, descriptors: list[str]) -> str:
+		out = io.StringIO()
+		writer = csv.writer(out, quoting=csv.QUOTE_ALL)
+		for descriptor in descriptors:
+			words = descriptor.split()
+			state = city = ''
+			if len(words) > 1 and len(words[-1]) == 2 and words[-1].isalpha():
+				state = words.pop()
+				if len(words) > 1 and words[-1].isalpha():
+					city = words.pop().title()
+			online = 'online' if 'WWW' in descriptor.upper() or '.COM' in descriptor.upper() else 'inperson'
+			writer.writerow([descriptor, '', ' '.join(words), city, state, online])
+		return out.getvalue()
+
+
+
+@fig.component('extraction/file')
+class FileBackend(ExtractionBackend):
+	'''
+	Writes each prompt to `root` and reads the response from a CSV file of the same name once it has been saved
+	there (e.g. pasted from a chat interface). Batches without a response stay pending.
+	'''
+	def __init__(self, root: str, **kwargs):
+		super().__init__(**kwargs)
+		self.root = Path(root)
+
+
+	def complete(self, prompt: str, descriptors: list[str]) -> Optional[str]:
+		self.root.mkdir(parents=True, exist_ok=True)
+		name = hashlib.sha1('\n'.join(descriptors).encode('utf-8')).hexdigest()[:12]
+		response = self.root / f'prompt-{name}.csv'
+		if response.exists():
+			return response.read_text(encoding='utf-8')
+		(self.root / f'prompt-{name}.txt').write_text(prompt, encoding='utf-8')
+
+
+
+def extract_merchants(descriptors: Iterable[str], backend: ExtractionBackend, cache: MerchantCache, *,
+					  batch_size: int = 50, concurrency: int = 4, pbar: bool = False) \
+		-> tuple[dict[str, Merchant], list[str]]:
+	'''
+	Resolves all descriptors which aren't in the cache yet: duplicates and known descriptors are dropped, the rest
+	is sent to the backend in batches of `batch_size` (at most `concurrency` at a time), and the results are stored
+	in the cache (so they are never sent again).
+
+	Returns the new results and the descriptors which are still unresolved.
+	'''
+	todo = [descriptor for descriptor in dict.fromkeys(map(normalize_descriptor, descriptors))
+			if len(descriptor) and cache.lookup(descriptor) is None]
+	batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+	results = {}
+	with ThreadPoolExecutor(max(1, concurrency)) as pool:
+		# the database is only used from this thread
+		for batch in tqdm(pool.map(backend.extract, batches), total=len(batches), disable=not pbar):
+			for descriptor, merchant in batch.items():
+				cache.store(descriptor, merchant)
+				results[descriptor] = merchant
+	return results, [descriptor for descriptor in todo if descriptor not in results]
+
+
+
+@fig.script('extract-merchants')
+def extract_merchants_script(cfg: fig.Configuration):
+	'''Resolves the merchants of all transactions without a location (that aren't known yet).'''
+	conn = cfg.pull('conn')
+	backend: ExtractionBackend = cfg.pull('backend')
+
+	report = create_report(cfg)
+	report.write()
+
+	descriptors = [row[0] for row in conn.execute('SELECT DISTINCT description FROM transactions '
+												  'WHERE location IS NULL AND description IS NOT NULL')]
+	cache = MerchantCache(conn, report=report)
+	results, pending = extract_merchants(descriptors, backend, cache, batch_size=cfg.pull('batch-size', 50),
+										 concurrency=cfg.pull('concurrency', 4), pbar=cfg.pull('pbar', True))
+	conn.commit()
+
+	cfg.print(f'Resolved {len(results)} new descriptors ({len(pending)} still pending).')
+	return results, pending
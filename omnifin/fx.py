@@ -0,0 +1,144 @@
+from __future__ import annotations
+from .imports import *
+
+from .misc import get_path
+from .datacls import Record
+
+
+# category of the assets that have exchange rates
+CURRENCY = 'currency'
+
+# source of the rates implied by conversions (see `harvest_rates`)
+HARVESTED = 'transactions'
+
+
+
+def harvest_rates(conn: sqlite3.Connection = None) -> int:
+	'''
+	Stores the exchange rates implied by all conversions (transactions which send one currency and receive another)
+	as daily rates (weighted by the converted amounts), replacing all rates harvested before (so rates of undone or
+	changed transactions don't linger). Imported rates are never overwritten. Trades of other assets (e.g. buying
+	stocks) are not conversions, so only assets of the category `currency` are used.
+
+	Returns the number of stored rates.
+	'''
+	if conn is None:
+		conn = Record._conn
+	conn.execute('DELETE FROM fx_rates WHERE source = ?', (HARVESTED,))
+	cursor = conn.execute('''
+	INSERT INTO fx_rates (base, quote, day, rate, source)
+	SELECT unit, received_unit, date(dateof), SUM(received_amount) / SUM(amount), :source
+	FROM transactions
+	WHERE received_unit IS NOT NULL AND received_unit != unit AND amount > 0 AND received_amount > 0
+	AND unit IN (SELECT id FROM assets WHERE asset_type = :category)
+	AND received_unit IN (SELECT id FROM assets WHERE asset_type = :category)
+	GROUP BY unit, received_unit, date(dateof)
+	ON CONFLICT (base, quote, day) DO NOTHING
+	''', {'category': CURRENCY, 'source': HARVESTED})
+	return cursor.rowcount
+
+
+
+def import_rates(rates: pd.DataFrame | Path | str, conn: sqlite3.Connection = None, *, source: str = 'import') \
+		-> int:
+	'''
+	Stores rates from a table (or CSV file) with the columns `date`, `base`, `quote` and `rate`
+	(number of `quote` units per `base` unit), replacing any existing rates of the same day.
+	Rates of unknown assets are skipped.
+
+	Returns the number of stored rates.
+	'''
+	if conn is None:
+		conn = Record._conn
+	if not isinstance(rates, pd.DataFrame):
+		rates = pd.read_csv(rates, usecols=['date', 'base', 'quote', 'rate'], dtype={'base': str, 'quote': str})
+	assets = dict(conn.execute('SELECT asset_name, id FROM assets').fetchall())
+
+	base, quote = rates['base'].map(assets), rates['quote'].map(assets)
+	known = base.notna() & quote.notna()
+	days = pd.to_datetime(rates['date'][known]).dt.strftime('%Y-%m-%d')
+	rows = zip(base[known].astype(int).tolist(), quote[known].astype(int).tolist(), days.tolist(),
+			   rates['rate'][known].astype(float).tolist())
+	cursor = conn.executemany('INSERT INTO fx_rates (base, quote, day, rate, source) VALUES (?, ?, ?, ?, ?) '
+							  'ON CONFLICT (base, quote, day) DO UPDATE SET rate = excluded.rate, '
+							  'source = excluded.source',
+							  [(*row, source) for row in rows])
+	return cursor.rowcount
+
+
+
+def load_rates(conn: sqlite3.Connection = None, *, inverse: bool = True) -> pd.DataFrame:
+	'''
+	All stored rates as a table with the columns `date`, `base`, `quote` (asset names) and `rate`.
+	Unless `inverse` is False, the inverse rates are included as well (where no direct rate exists for that day).
+	'''
+	if conn is None:
+		conn = Record._conn
+	rates = pd.read_sql_query('''
+	SELECT fx_rates.day AS date, bases.asset_name AS base, quotes.asset_name AS quote, fx_rates.rate AS rate
+	FROM fx_rates
+	JOIN assets AS bases ON bases.id = fx_rates.base
+	JOIN assets AS quotes ON quotes.id = fx_rates.quote
+	''', conn)
+	rates['date'] = pd.to_datetime(rates['date'])
+	if inverse:
+		flipped = rates.rename(columns={'base': 'quote', 'quote': 'base'})
+		flipped['rate'] = 1. / flipped['rate']
+		rates = pd.concat([rates, flipped[rates.columns]], ignore_index=True)
+		rates = rates.drop_duplicates(['date', 'base', 'quote'], keep='first')
+	return rates.sort_values('date', ignore_index=True)
+
+
+
+def convert(frame: pd.DataFrame, to: str = 'usd', *, rates: pd.DataFrame = None, conn: sqlite3.Connection = None,
+			amount_key: str | Iterable[str] = 'amount', unit_key: str = 'unit', date_key: Optional[str] = 'date',
+			direction: str = 'backward', tolerance: pd.Timedelta = None) -> pd.DataFrame:
+	'''
+	Converts the amounts of all rows to `to` using the most recent rate (at the date of the row, or the latest rate
+	if `date_key` is None) with a single as-of merge instead of looking up each row.
+	For each amount column, a column `{amount_key}_{to}` is added to (a copy of) the frame.
+	Rows without a known rate are converted to NaN. Asset names are matched case-insensitively (like `Asset.find`).
+
+	`rates` (see `load_rates`) are loaded from the database if not provided.
+	'''
+	if rates is None:
+		rates = load_rates(conn)
+	amount_keys = [amount_key] if isinstance(amount_key, str) else list(amount_key)
+
+	target = to.lower()
+	units = frame[unit_key].astype(str).str.lower().to_numpy()
+	rates = rates[rates['quote'].str.lower() == target].sort_values('date', kind='stable')
+	rates = rates.assign(base=rates['base'].str.lower())
+	if date_key is None:
+		factors = rates.groupby('base')['rate'].last().reindex(units).to_numpy()
+	else:
+		keys = pd.DataFrame({'_date': pd.to_datetime(frame[date_key]).to_numpy(), '_unit': units,
+							 '_row': np.arange(len(frame))}).sort_values('_date', kind='stable')
+		table = rates[['date', 'base', 'rate']].rename(columns={'date': '_date', 'base': '_unit'})
+		table = table.astype({'_unit': keys['_unit'].dtype})
+		merged = pd.merge_asof(keys, table, on='_date', by='_unit', direction=direction, tolerance=tolerance)
+		factors = merged.sort_values('_row')['rate'].to_numpy()
+	factors = np.where(units == target, 1., factors.astype(float))
+
+	frame = frame.copy()
+	for key in amount_keys:
+		frame[f'{key}_{to}'] = frame[key].to_numpy(dtype=float) * factors
+	return frame
+
+
+
+@fig.script('fx')
+def update_rates(cfg: fig.Configuration):
+	'''Collects the exchange rates implied by conversions and (optionally) imports rates from a CSV file.'''
+	conn = cfg.pull('conn')
+
+	num = harvest_rates(conn)
+	cfg.print(f'Harvested {num} rates from conversions.')
+
+	path = get_path(cfg, path_key='path', root_key='root')
+	if path is not None:
+		num = import_rates(path, conn)
+		cfg.print(f'Imported {num} rates from {path}.')
+
+	conn.commit()
+	return load_rates(conn, inverse=False)
@@ -1,18 +1,51 @@
-from typing import Optional, Union, Type, TypeVar, Any, Callable, Iterable, Mapping, Sequence, Tuple, List, Dict
+from typing import Optional, Union, Type, TypeVar, Any, Callable, Iterable, Iterator, Mapping, Sequence, Tuple, List, Dict
 
 from dataclasses import dataclass, fields, asdict
 from tabulate import tabulate
 from tqdm import tqdm
 from pathlib import Path
 from datetime import datetime, date as datelike
-from dateutil import parser
 from collections import Counter
 
 import io
-from tqdm import tqdm
-import humanize
+import importlib
 from omnibelt import load_csv, load_json, save_json, save_yaml, load_csv_rows, load_yaml, colorize
 import omnifig as fig
 
-import pandas as pd
 import sqlite3
+
+
+
+class LazyModule:
+	'''
+	Placeholder for a module which is only imported once one of its attributes is used, so that heavy dependencies
+	(e.g. pandas) don't slow down every script that never needs them.
+	'''
+	def __init__(self, name: str):
+		self.__dict__['_name'] = name
+		self.__dict__['_module'] = None
+
+
+	def _load(self):
+		if self._module is None:
+			self.__dict__['_module'] = importlib.import_module(self._name)
+		return self._module
+
+
+	def __getattr__(self, item):
+		return getattr(self._load(), item)
+
+
+	def __dir__(self):
+		return dir(self._load())
+
+
+	def __repr__(self):
+		return f'<lazy module {self._name!r}{"" if self._module is None else " (loaded)"}>'
+
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+humanize = LazyModule('humanize')
+parser = LazyModule('dateutil.parser')
@@ -0,0 +1,162 @@
+from __future__ import annotations
+from .imports import *
+
+from .misc import get_path
+from .datacls import Record, Account
+from .money import DEFAULT_SCALE
+from . import fx
+
+
+# every transaction is split into two signed legs: the sender pays the amount, the receiver gets the received
+# amount (or the amount, if nothing else was received)
+LEGS = '''
+SELECT id, dateof, sender AS account, receiver AS counterparty, unit, -amount_minor AS minor
+FROM transactions
+UNION ALL
+SELECT id, dateof, receiver AS account, sender AS counterparty, COALESCE(received_unit, unit) AS unit,
+	COALESCE(received_minor, amount_minor) AS minor
+FROM transactions
+'''
+
+
+# name -> (SQL expression over the legs to group by, optional join to look up the name of the grouped ID)
+DIMENSIONS = {
+	'account': ('legs.account', 'accounts.account_name'),
+	'counterparty': ('legs.counterparty', 'counterparties.account_name'),
+	'unit': ('legs.unit', 'assets.asset_name'),
+	'day': ('date(legs.dateof)', None),
+	'month': ("strftime('%Y-%m', legs.dateof)", None),
+	'quarter': ("strftime('%Y', legs.dateof) || '-Q' || ((CAST(strftime('%m', legs.dateof) AS INTEGER) + 2) / 3)",
+				None),
+	'year': ("strftime('%Y', legs.dateof)", None),
+	'tag': ('transaction_tags.tag_id', 'tags.tag_name'),
+}
+
+# joins (in the outer query) to look up the names
+_NAME_JOINS = {
+	'account': 'LEFT JOIN accounts ON accounts.id = totals.account',
+	'counterparty': 'LEFT JOIN accounts AS counterparties ON counterparties.id = totals.counterparty',
+	'unit': 'LEFT JOIN assets ON assets.id = totals.unit',
+	'tag': 'LEFT JOIN tags ON tags.id = totals.tag',
+}
+
+
+# name -> SQL aggregate over the signed minor units of the legs
+METRICS = {
+	'inflow': 'SUM(CASE WHEN legs.minor > 0 THEN legs.minor ELSE 0 END)',
+	'outflow': 'SUM(CASE WHEN legs.minor < 0 THEN -legs.minor ELSE 0 END)',
+	'net': 'SUM(legs.minor)',
+	'count': 'COUNT(DISTINCT legs.id)',
+}
+
+# metrics which are not amounts (so they are not scaled)
+COUNTS = {'count'}
+
+
+
+def compile_aggregate(by: Iterable[str], metrics: Iterable[str], *, start: datelike = None, end: datelike = None,
+					  accounts: Iterable[Account | str] = None) -> tuple[str, list]:
+	'''Returns the query (and its parameters) computing the given metrics grouped by the given dimensions.'''
+	by, metrics = list(by), list(metrics)
+	unknown = [key for key in by if key not in DIMENSIONS] + [key for key in metrics if key not in METRICS]
+	if len(unknown):
+		raise ValueError(f'Unknown dimensions/metrics: {unknown}')
+	if 'unit' not in by:
+		# amounts of different assets can't be added up
+		by.append('unit')
+
+	joins = []
+	if 'tag' in by:
+		joins.append('LEFT JOIN transaction_tags ON transaction_tags.id = legs.id')
+
+	conditions, params = [], []
+	if start is not None:
+		conditions.append('legs.dateof >= ?')
+		params.append(start.strftime('%Y-%m-%d'))
+	if end is not None:
+		conditions.append('legs.dateof < ?')
+		params.append(end.strftime('%Y-%m-%d'))
+	if accounts is not None:
+		accounts = [Account.find(account).ID for account in accounts]
+		conditions.append(f'legs.account IN ({", ".join("?" * len(accounts))})')
+		params.extend(accounts)
+	elif 'account' not in by:
+		# both legs of every transaction would cancel out, so only one's own accounts count
+		conditions.append("legs.account NOT IN (SELECT id FROM accounts WHERE account_owner = 'external')")
+
+	# aggregate by IDs first and only look up the names of the (much fewer) groups afterwards
+	columns = [f'{DIMENSIONS[key][0]} AS {key}' for key in by]
+	columns.extend(f'{METRICS[key]} AS {key}' for key in metrics)
+	inner = (f'SELECT {", ".join(columns)} FROM ({LEGS}) AS legs {" ".join(joins)}'
+			 f'{" WHERE " + " AND ".join(conditions) if len(conditions) else ""} '
+			 f'GROUP BY {", ".join(key for key in by)}')
+
+	names = [f'{DIMENSIONS[key][1] or "totals." + key} AS {key}' for key in by]
+	query = (f'SELECT {", ".join(names)}, assets.scale AS _scale, {", ".join(f"totals.{key}" for key in metrics)} '
+			 f'FROM ({inner}) AS totals {" ".join(_NAME_JOINS[key] for key in by if key in _NAME_JOINS)} '
+			 f'ORDER BY {", ".join(str(i + 1) for i in range(len(by)))}')
+	return query, params
+
+
+
+def aggregate(by: Iterable[str] = ('account', 'month', 'unit'), metrics: Iterable[str] = ('inflow', 'outflow', 'net'),
+			  *, conn: sqlite3.Connection = None, exact: bool = False, **filters) -> pd.DataFrame:
+	'''
+	Computes the metrics (any of `METRICS`) of all transactions grouped by the dimensions (any of `DIMENSIONS`)
+	in the database, where each transaction counts as outflow for the sender and inflow for the receiver.
+	Unless the results are split by `account` (or limited to some `accounts`), only the legs of accounts that are not
+	owned externally are included, e.g. grouping by `tag` gives the money spent on and received for each tag
+	(transfers between one's own accounts still cancel out).
+
+	Results are always grouped by unit as well. Amounts are converted from minor units unless `exact` is set.
+	`filters` are passed to `compile_aggregate` (`start`, `end` and `accounts`).
+	'''
+	if conn is None:
+		conn = Record._conn
+	query, params = compile_aggregate(by, metrics, **filters)
+	frame = pd.read_sql_query(query, conn, params=params)
+
+	scales = frame.pop('_scale').fillna(DEFAULT_SCALE).astype(int)
+	if not exact:
+		for key in metrics:
+			if key not in COUNTS:
+				frame[key] = frame[key] / 10.0 ** scales
+	return frame
+
+
+
+@fig.script('aggregate')
+def aggregate_script(cfg: fig.Configuration):
+	conn = cfg.pull('conn')
+
+	by = cfg.pull('by', ['account', 'month', 'unit'])
+	if isinstance(by, str):
+		by = by.split(',')
+	metrics = cfg.pull('metrics', ['inflow', 'outflow', 'net'])
+	if isinstance(metrics, str):
+		metrics = metrics.split(',')
+
+	start = cfg.pull('start', None)
+	end = cfg.pull('end', None)
+	accounts = cfg.pull('accounts', None)
+	if isinstance(accounts, str):
+		accounts = accounts.split(',')
+
+	frame = aggregate(by, metrics, conn=conn, accounts=accounts,
+					  start=None if start is None else parser.parse(start),
+					  end=None if end is None else parser.parse(end))
+
+	to = cfg.pull('to', None)
+	if to is not None:
+		# value every group in a single currency (at the start of its period or with the latest rate)
+		dates = [key for key in ('day', 'month', 'year') if key in frame.columns]
+		frame = fx.convert(frame, to, conn=conn, amount_key=[key for key in metrics if key not in COUNTS],
+						   date_key=dates[0] if len(dates) else None)
+
+	path = get_path(cfg, path_key='out', root_key='root')
+	if path is not None:
+		frame.to_csv(path, index=False)
+		cfg.print(f'Saved {len(frame)} rows to {path}')
+	else:
+		cfg.print(tabulate(frame, headers='keys', showindex=False, floatfmt='.2f'))
+	return frame
@@ -0,0 +1,256 @@
+from difflib import SequenceMatcher
+from collections import OrderedDict
+import hashlib
+
+from .imports import *
+
+from .misc import get_path, format_location, table_rows
+from .datacls import Record, Report, Account, Transaction, Verification
+from .writing import create_report
+
+
+
+def normalize_descriptor(raw: str) -> str:
+	'''Collapses all whitespace (so that descriptors only differing in spacing are identical).'''
+	return ' '.join(raw.split())
+
+
+
+def similarity(a: str, b: str) -> int:
+	'''Similarity of two strings as a percentage (same as `fuzz.ratio` without python-Levenshtein).'''
+	return round(100 * SequenceMatcher(None, a, b, autojunk=False).ratio())
+
+
+
+class MerchantMatcher:
+	'''
+	Finds the most similar of a fixed set of known descriptors (e.g. merchant locations) for any query.
+
+	Instead of scoring a query against every key, an inverted index of character n-grams selects the few keys sharing
+	the most n-grams with the query (and skips any whose length alone rules out reaching the threshold), and only
+	those are scored. Results are cached, since the same descriptors come up again and again.
+	'''
+	def __init__(self, keys: Iterable[str], *, n: int = 3, candidates: int = 20, threshold: int = 0):
+		self.n = n
+		self.candidates = candidates
+		self.threshold = threshold
+		self.keys = list(dict.fromkeys(keys))
+		self.index: dict[str, list[int]] = {}
+		self.sizes: list[int] = []
+		for i, key in enumerate(self.keys):
+			grams = self._grams(key)
+			self.sizes.append(len(grams))
+			for gram in grams:
+				self.index.setdefault(gram, []).append(i)
+		self.exact = {key: i for i, key in enumerate(self.keys)}
+		self.cache: dict[str, tuple[Optional[str], int]] = {}
+
+
+	def _grams(self, text: str) -> set[str]:
+		padded = f'{" " * (self.n - 1)}{text}{" " * (self.n - 1)}'
+		return {padded[i:i + self.n] for i in range(len(padded) - self.n + 1)}
+
+
+	def blocked(self, query: str) -> list[str]:
+		'''Keys which could match the query (by the fraction of shared n-grams, best first).'''
+		grams = self._grams(query)
+		shared = Counter()
+		for gram in grams:
+			for i in self.index.get(gram, ()):
+				shared[i] += 1
+		size = len(query)
+		overlaps = []
+		for i, count in shared.items():
+			# the ratio can be at most 2 * min(len) / (sum of lengths) (and the score is rounded)
+			if round(200 * min(size, len(self.keys[i])) / (size + len(self.keys[i]))) >= self.threshold:
+				overlaps.append((2 * count / (len(grams) + self.sizes[i]), i))
+		overlaps.sort(reverse=True)
+		return [self.keys[i] for _, i in overlaps[:self.candidates]]
+
+
+	def match(self, query: str) -> tuple[Optional[str], int]:
+		'''Returns the best matching key and its score (None and 0 if no key is similar at all).'''
+		if query in self.exact:
+			return query, 100
+		if query not in self.cache:
+			best, score = None, 0
+			for key in self.blocked(query):
+				value = similarity(key, query)
+				if value > score:
+					best, score = key, value
+			self.cache[query] = best, score
+		return self.cache[query]
+
+
+
+def descriptor_hash(raw: str) -> int:
+	'''Stable 64-bit hash of the normalized descriptor (to index the raw strings compactly).'''
+	digest = hashlib.blake2b(normalize_descriptor(raw).encode('utf-8'), digest_size=8).digest()
+	return int.from_bytes(digest, 'big', signed=True)
+
+
+
+def online_flag(value: Optional[str]) -> Optional[bool]:
+	'''Reads whether a merchant is "online" or "inperson" (as in the old enrichment solutions).'''
+	if value is None or not len(value.strip()):
+		return None
+	return value.strip().lower() == 'online'
+
+
+
+@dataclass(frozen=True)
+class Merchant:
+	merchant: str = None
+	city: str = None
+	country: str = None
+	category: str = None
+	# location exactly as it appeared in a statement (for merchants learned while importing)
+	original: str = None
+	# merchant category code (e.g. "5411" for grocery stores)
+	mcc: str = None
+	# whether the merchant sells online (or only in person)
+	online: bool = None
+
+	@staticmethod
+	def _field(value: Optional[str]) -> Optional[str]:
+		# commas separate the fields of a location (e.g. "Washington, D.C." becomes "Washington D.C.")
+		return None if value is None else ' '.join(value.replace(',', ' ').split())
+
+	@property
+	def location(self) -> str:
+		if self.original is not None:
+			return self.original
+		return format_location(city=self._field(self.city), location=self._field(self.country),
+							   cat='online' if self.online else self._field(self.category))
+
+	@classmethod
+	def from_location(cls, location: str, merchant: str = None):
+		'''Inverse of `location` (see `format_location`), which keeps the location as it is.'''
+		city, country, category = (location.split(',') + ['', ''])[:3]
+		if category == 'online':
+			return cls(merchant, city or None, country or None, original=location, online=True)
+		return cls(merchant, city or None, country or None, category or None, original=location)
+
+
+
+class MerchantCache:
+	'''
+	Maps raw merchant descriptors to the normalized merchant using the `merchants` table (looked up by the hash of the
+	descriptor) with an in-process LRU cache (including misses), so each distinct descriptor is looked up at most
+	once per process and only has to be resolved once ever.
+
+	Merchants saved explicitly (e.g. by the `merchants` or `extract-merchants` scripts) apply to every account.
+	While it is active (as a context manager), parsers fill in missing locations from it, and if `account` is set,
+	the locations of new descriptors are remembered under `report` for that account only (descriptors like "Rent"
+	mean something different for every account). Explicit merchants take precedence over learned ones.
+	'''
+	active: 'MerchantCache' = None
+
+	def __init__(self, conn: sqlite3.Connection = None, *, report: Report = None, account: Account = None,
+				 size: int = 4096):
+		self.conn = Record._conn if conn is None else conn
+		self.report = report
+		self.account = account.ID if isinstance(account, Record) else account
+		self.size = size
+		self.cache: OrderedDict[str, Optional[Merchant]] = OrderedDict()
+
+
+	def __enter__(self):
+		MerchantCache.active = self
+		return self
+
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		MerchantCache.active = None
+
+
+	def _remember(self, descriptor: str, merchant: Optional[Merchant]):
+		self.cache[descriptor] = merchant
+		self.cache.move_to_end(descriptor)
+		if len(self.cache) > self.size:
+			self.cache.popitem(last=False)
+
+
+	def lookup(self, raw: str) -> Optional[Merchant]:
+		descriptor = normalize_descriptor(raw)
+		if descriptor in self.cache:
+			self.cache.move_to_end(descriptor)
+			return self.cache[descriptor]
+		row = self.conn.execute('SELECT merchant, city, country, category, location, mcc, online FROM merchants '
+								'WHERE descriptor_hash = ? AND descriptor = ? AND (account IS NULL OR account IS ?) '
+								'ORDER BY account IS NOT NULL LIMIT 1',
+								(descriptor_hash(descriptor), descriptor, self.account)).fetchone()
+		merchant = None if row is None else Merchant(*row[:-1], online=None if row[-1] is None else bool(row[-1]))
+		self._remember(descriptor, merchant)
+		return merchant
+
+
+	def store(self, raw: str, merchant: Merchant, report: Report = None, *, overwrite: bool = True,
+			  learned: bool = False) -> bool:
+		'''
+		Saves the merchant of a descriptor (unless it is already known and `overwrite` is False) for all accounts,
+		or only for `account` if it was `learned` from its statements.
+		'''
+		descriptor = normalize_descriptor(raw)
+		report = self.report if report is None else report
+		account = self.account if learned else None
+		if not overwrite and self.lookup(descriptor) is not None:
+			return False
+		values = (merchant.merchant, merchant.city, merchant.country, merchant.category, merchant.original,
+				  merchant.mcc, merchant.online, report.ID if isinstance(report, Record) else report,
+				  descriptor_hash(descriptor), descriptor, account)
+		# only the hash is indexed, so the upsert is done by hand
+		updated = self.conn.execute('UPDATE merchants SET merchant = ?, city = ?, country = ?, category = ?, '
+									'location = ?, mcc = ?, online = ?, report = ? '
+									'WHERE descriptor_hash = ? AND descriptor = ? AND account IS ?', values).rowcount
+		if not updated:
+			self.conn.execute('INSERT INTO merchants (merchant, city, country, category, location, mcc, online, '
+							  'report, descriptor_hash, descriptor, account) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+							  values)
+		self._remember(descriptor, merchant)
+		return True
+
+
+	def apply(self, record: Transaction | Verification):
+		'''Fills in the location of the record if its descriptor is known, or remembers it (for `account`) otherwise.'''
+		if record.description is None:
+			return
+		if record.location is None:
+			merchant = self.lookup(record.description)
+			if merchant is not None:
+				record.location = merchant.location
+		elif self.report is not None and self.account is not None and self.lookup(record.description) is None:
+			self.store(record.description, Merchant.from_location(record.location), learned=True)
+
+
+
+@fig.script('merchants')
+def import_merchants(cfg: fig.Configuration):
+	'''Saves resolved merchant descriptors (e.g. the location solutions of the old enrichment scripts).'''
+	conn = cfg.pull('conn')
+	report = create_report(cfg)
+	report.write()
+
+	path = get_path(cfg, path_key='path', root_key='root')
+	frame = pd.read_csv(path, dtype=str).replace({np.nan: None})
+	keys = {
+		'descriptor': cfg.pull('descriptor-key', 'Raw'),
+		'merchant': cfg.pull('merchant-key', 'Merchant'),
+		'city': cfg.pull('city-key', 'City'),
+		'country': cfg.pull('country-key', 'State'),
+		'category': cfg.pull('category-key', 'Category'),
+		'mcc': cfg.pull('mcc-key', 'MCC'),
+		# "online" or "inperson"
+		'online': cfg.pull('online-key', 'Type'),
+	}
+	overwrite = cfg.pull('overwrite', False)
+
+	cache = MerchantCache(conn, report=report)
+	stored = 0
+	for row in table_rows(frame):
+		info = {key: row.get(col) for key, col in keys.items() if key != 'descriptor'}
+		info = Merchant(**{**info, 'online': online_flag(info['online'])})
+		stored += cache.store(row[keys['descriptor']], info, overwrite=overwrite)
+	conn.commit()
+	cfg.print(f'Saved {stored} merchants (from {len(frame)} rows in {path}).')
+	return stored
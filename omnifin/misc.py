@@ -1,7 +1,14 @@
+from __future__ import annotations
 from pathlib import Path
+from contextlib import contextmanager
+import io, mmap, os
 import sqlite3, json
+from typing import Callable, Iterable, Iterator
 from omnibelt import load_json, save_json, load_csv_rows, load_yaml
 import omnifig as fig
+from .imports import np, pd
+
+from .errors import AmountFormatError
 
 def format_regular_amount(val: str):
 	assert val is not None
@@ -23,6 +30,70 @@ def format_european_amount(amount: str) -> float:
 	return amount
 
 
+
+def table_rows(frame: pd.DataFrame) -> list[dict]:
+	'''Same as the rows from `load_csv_rows` (missing values are None).'''
+	return [{key: None if val != val else val for key, val in row.items()} for row in frame.to_dict(orient='records')]
+
+
+
+def string_cells(col: pd.Series) -> pd.Series:
+	'''Returns only the string cells of `col` (all others are NaN).'''
+	try:
+		lengths = col.str.len()
+	except AttributeError:
+		return pd.Series(None, index=col.index, dtype=object)
+	return col.where(lengths.notna())
+
+
+_plain_number = r'[+-]?(\d+\.?\d*|\.\d+)'
+
+
+def _convert_amounts(col: pd.Series, text: pd.Series, fallback: Callable, errors: str) -> pd.Series:
+	amounts = pd.to_numeric(col.where(text.isna()), errors='coerce').astype(float)
+	plain = text.str.fullmatch(_plain_number).fillna(False).astype(bool)
+	# same conversion as `float` (so the values are exactly the same as with the scalar functions)
+	amounts[plain] = np.asarray(text[plain], dtype=object).astype(float)
+
+	# only cells that are not plain numbers are converted one by one
+	failed = col.notna() & text.isna() & amounts.isna()
+	for row, val in col[text.notna() & ~plain].items():
+		try:
+			amounts.loc[row] = fallback(val)
+		except ValueError:
+			failed.loc[row] = True
+
+	if errors == 'raise' and failed.any():
+		raise AmountFormatError(col[failed], name=col.name)
+	return amounts
+
+
+def format_regular_amounts(col: pd.Series, *, errors: str = 'raise') -> pd.Series:
+	'''
+	Vectorized `format_regular_amount` (empty cells stay NaN). With `errors='raise'` all cells that can't be converted
+	are reported together, with `errors='coerce'` they are NaN.
+	'''
+	if pd.api.types.is_numeric_dtype(col):
+		return col.astype(float)
+	text = string_cells(col).str.strip().str.replace(',', '', regex=False)
+	return _convert_amounts(col, text, format_regular_amount, errors)
+
+
+def format_european_amounts(col: pd.Series, *, thousands: str = None, errors: str = 'raise') -> pd.Series:
+	'''Vectorized `format_european_amount` (see `format_regular_amounts`), optionally removing `thousands` first.'''
+	if pd.api.types.is_numeric_dtype(col):
+		return col.astype(float)
+	text = string_cells(col).str.strip()
+	fallback = format_european_amount
+	if thousands is not None:
+		text = text.str.replace(thousands, '', regex=False)
+		fallback = lambda val: format_european_amount(val.replace(thousands, '') if isinstance(val, str) else val)
+	for char in ['\xa0', '\ufffd']:
+		text = text.str.replace(char, '', regex=False)
+	text = text.str.replace(',', '.', regex=False)
+	return _convert_amounts(col, text, fallback, errors)
+
+
 def load_item_file(path):
 	suffix = path.suffix.lower()
 	if suffix == '.csv':
@@ -37,6 +108,146 @@ def load_item_file(path):
 	raise FileNotFoundError(f'Unknown file type: {path}')
 
 
+def csv_dtypes(path: Path, chunksize: int = 10000) -> dict[str, object]:
+	'''
+	The dtypes pandas infers for the columns of the whole csv file, found in a single pass over chunks (so only one
+	chunk is in memory at a time). Columns that are integers in some chunks and floats (e.g. missing values) in others
+	are floats, any other mix is kept as objects.
+	'''
+	dtypes = {}
+	with pd.read_csv(path, chunksize=chunksize) as chunks:
+		for chunk in chunks:
+			for col, dtype in chunk.dtypes.items():
+				if col not in dtypes or dtypes[col] == dtype:
+					dtypes[col] = dtype
+				elif {dtypes[col].kind, dtype.kind} <= {'i', 'f'}:
+					dtypes[col] = np.dtype('float64')
+				else:
+					dtypes[col] = np.dtype(object)
+	return dtypes
+
+
+
+def iter_csv_rows(path: Path, chunksize: int = 10000) -> Iterator[dict]:
+	'''Same rows as `load_csv_rows` (including the inferred types), but reading the file in chunks.'''
+	dtypes = csv_dtypes(path, chunksize)
+	with pd.read_csv(path, chunksize=chunksize, dtype=dtypes) as chunks:
+		for chunk in chunks:
+			for _, row in chunk.iterrows():
+				data = row.to_dict()
+				for k, v in data.items():
+					if v != v:
+						data[k] = None
+				yield data
+
+
+def iter_item_file(path, chunksize: int = 10000):
+	suffix = path.suffix.lower()
+	if suffix == '.jsonl':
+		with path.open('r') as f:
+			for line in f:
+				if len(line.strip()):
+					yield json.loads(line)
+	elif suffix == '.csv':
+		yield from iter_csv_rows(path, chunksize)
+	else:
+		yield from load_item_file(path)
+
+
+
+
+@contextmanager
+def map_file(path: Path):
+	'''Memory-maps the file (read-only), so it can be scanned without reading it into memory first.'''
+	with open(path, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			# empty files can't be mapped
+			yield b''
+			return
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+			yield buffer
+
+
+
+def line_spans(buffer: bytes | mmap.mmap) -> Iterator[tuple[int, int]]:
+	'''Yields the (start, end) byte offsets of every line in the buffer (excluding the newline).'''
+	start, size = 0, len(buffer)
+	while start < size:
+		end = buffer.find(b'\n', start)
+		if end < 0:
+			end = size
+		yield start, end
+		start = end + 1
+
+
+
+def line_head(buffer: bytes | mmap.mmap, start: int, end: int, size: int, *, ignore: bytes = b'"') -> bytes:
+	'''The first `size` bytes of the line (ignoring all `ignore` characters), e.g. to check prefixes of quoted lines.'''
+	window = size
+	while True:
+		head = buffer[start:min(end, start + window)].replace(ignore, b'')
+		if len(head) >= size or start + window >= end:
+			return head[:size]
+		window *= 2
+
+
+
+class LineSpans(io.RawIOBase):
+	'''
+	Read-only binary file of selected lines of a buffer (e.g. from `map_file`) joined by newlines (after an optional
+	`header` line). The lines are copied straight from the buffer into the reader's buffer, so they can be parsed
+	(e.g. with `pd.read_csv`) without building an intermediate string of all lines first.
+	'''
+	def __init__(self, buffer: bytes | mmap.mmap, spans: Iterable[tuple[int, int]], header: str | bytes = None):
+		super().__init__()
+		self._view = memoryview(buffer)
+		if isinstance(header, str):
+			header = header.encode('utf-8')
+		self._chunks = self._iter_chunks(spans, header)
+		self._pending = b''
+		self._offset = 0
+
+
+	def _iter_chunks(self, spans: Iterable[tuple[int, int]], header: bytes = None):
+		# views of the lines are only created as they are read (rather than one object per line up front)
+		first = header is None
+		if not first:
+			yield header
+		for start, end in spans:
+			if not first:
+				yield b'\n'
+			first = False
+			yield self._view[start:end]
+
+
+	def readable(self) -> bool:
+		return True
+
+
+	def readinto(self, b) -> int:
+		with memoryview(b) as view, view.cast('B') as out:
+			filled = 0
+			while filled < len(out):
+				if self._offset == len(self._pending):
+					self._pending, self._offset = next(self._chunks, None), 0
+					if self._pending is None:
+						self._pending = b''
+						break
+				num = min(len(self._pending) - self._offset, len(out) - filled)
+				out[filled:filled + num] = self._pending[self._offset:self._offset + num]
+				filled += num
+				self._offset += num
+			return filled
+
+
+	def close(self):
+		# the views have to be released before the underlying map can be closed
+		self._chunks.close()
+		self._pending = b''
+		self._view.release()
+		super().close()
+
+
 
 def get_path(cfg: fig.Configuration,
 			 path_key='path', root_key='root',
@@ -105,7 +316,8 @@ def load_db(path: Path | None = None):
 		db_root.mkdir(exist_ok=True, parents=True)
 		path = db_root / 'omnifin.db'
 
-	conn = sqlite3.connect(path)
+	# imports may write from a background thread (see `RecordWriter`), which then is the only one using the connection
+	conn = sqlite3.connect(path, check_same_thread=False)
 	return conn
 
 
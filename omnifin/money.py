@@ -0,0 +1,129 @@
+from decimal import Decimal, ROUND_HALF_UP
+import numbers
+
+from .imports import *
+
+
+# number of decimal places of assets without an explicit scale (e.g. cents)
+DEFAULT_SCALE = 2
+
+# default scale of new assets by category (shares can be fractional, e.g. from reinvested dividends)
+CATEGORY_SCALES = {'stock': 8}
+
+
+
+def asset_scale(asset: Any) -> int:
+	'''Number of decimal places used to store amounts of `asset` as integers.'''
+	scale = getattr(asset, 'scale', None)
+	return DEFAULT_SCALE if scale is None else scale
+
+
+
+def to_minor(amount: float | str | Decimal | None, scale: int = DEFAULT_SCALE) -> Optional[int]:
+	'''Converts an amount to integer minor units (e.g. 12.34 -> 1234), rounding half up to the scale.'''
+	if amount is None:
+		return None
+	if isinstance(amount, numbers.Integral):
+		amount = int(amount)
+	elif isinstance(amount, numbers.Real):
+		# the shortest repr is the decimal value that was parsed (so 0.1 is 10 and not 10.000000000000000555),
+		# numpy scalars (e.g. from frames) are converted first
+		amount = repr(float(amount))
+	return int(Decimal(amount).scaleb(scale).to_integral_value(ROUND_HALF_UP))
+
+
+
+def from_minor(minor: int | None, scale: int = DEFAULT_SCALE) -> Optional[Decimal]:
+	if minor is None:
+		return None
+	return Decimal(minor).scaleb(-scale)
+
+
+
+@dataclass(frozen=True)
+class Money:
+	'''
+	Exact amount of an asset, stored as an integer number of minor units (so that comparing, hashing and summing
+	are all integer operations).
+	'''
+	minor: int
+	unit: str
+	scale: int = DEFAULT_SCALE
+
+
+	@classmethod
+	def from_amount(cls, amount: float | str | Decimal, unit: Any, scale: int = None):
+		if scale is None:
+			scale = asset_scale(unit)
+		return cls(to_minor(amount, scale), getattr(unit, 'name', unit), scale)
+
+
+	@property
+	def decimal(self) -> Decimal:
+		return from_minor(self.minor, self.scale)
+
+
+	@property
+	def amount(self) -> float:
+		return float(self.decimal)
+
+
+	def _check(self, other: 'Money'):
+		if not isinstance(other, Money):
+			raise TypeError(f'Expected Money, got {other!r}')
+		if other.unit != self.unit or other.scale != self.scale:
+			raise ValueError(f'Incompatible units: {self.unit} (scale {self.scale}) and '
+							 f'{other.unit} (scale {other.scale})')
+
+
+	def __add__(self, other: 'Money'):
+		self._check(other)
+		return Money(self.minor + other.minor, self.unit, self.scale)
+
+
+	def __radd__(self, other):
+		# so that `sum` works without a start value
+		if isinstance(other, int) and other == 0:
+			return self
+		return self.__add__(other)
+
+
+	def __sub__(self, other: 'Money'):
+		self._check(other)
+		return Money(self.minor - other.minor, self.unit, self.scale)
+
+
+	def __neg__(self):
+		return Money(-self.minor, self.unit, self.scale)
+
+
+	def __abs__(self):
+		return Money(abs(self.minor), self.unit, self.scale)
+
+
+	def __bool__(self):
+		return self.minor != 0
+
+
+	def __lt__(self, other: 'Money'):
+		self._check(other)
+		return self.minor < other.minor
+
+
+	def __le__(self, other: 'Money'):
+		self._check(other)
+		return self.minor <= other.minor
+
+
+	def __gt__(self, other: 'Money'):
+		self._check(other)
+		return self.minor > other.minor
+
+
+	def __ge__(self, other: 'Money'):
+		self._check(other)
+		return self.minor >= other.minor
+
+
+	def __str__(self):
+		return f'{self.decimal:.{self.scale}f} {self.unit}'
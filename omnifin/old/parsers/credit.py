@@ -4,7 +4,6 @@ from tqdm import tqdm
 from pathlib import Path
 import omnifig as fig
 import pandas as pd
-from fuzzywuzzy import fuzz
 from datetime import datetime
 from dateutil import parser
 
@@ -13,6 +12,7 @@ from ..scripts import get_manager, get_world, setup_report
 from ..identification import World
 from ..datcls import Report, Account, Transaction, Tag, Record
 from ..parsing import Parser, Processor, ParseError
+from ...merchants import MerchantMatcher
 
 
 
@@ -177,7 +177,7 @@ def usbank_locs(cfg: fig.Configuration):
 
 	solutions = [row.to_dict() for _, row in df.iterrows()]
 	options = {' '.join(w.strip() for w in sol['Details'].split()): sol for sol in solutions}
-	keys = list(options.keys())
+	matcher = MerchantMatcher(options.keys(), threshold=98)
 
 	itr = iter(todo)
 	pbar = cfg.pull('pbar', True, silent=True)
@@ -200,8 +200,7 @@ def usbank_locs(cfg: fig.Configuration):
 			entry['online'] = loc['Type'] == 'online'
 
 		else:
-			best = max(keys, key=lambda k: fuzz.ratio(k, key))
-			score = fuzz.ratio(best, key)
+			best, score = matcher.match(key)
 			if score < 98:
 				failed.append(entry)
 			else:
@@ -319,7 +318,7 @@ def costco_locs(cfg: fig.Configuration):
 
 	solutions = [row.to_dict() for _, row in df.iterrows()]
 	options = {' '.join(w.strip() for w in sol['Raw'].split()): sol for sol in solutions}
-	keys = list(options.keys())
+	matcher = MerchantMatcher(options.keys(), threshold=98)
 
 	itr = iter(todo)
 	pbar = cfg.pull('pbar', True, silent=True)
@@ -344,8 +343,7 @@ def costco_locs(cfg: fig.Configuration):
 			entry['mcc'] = loc['MCC']
 
 		else:
-			best = max(keys, key=lambda k: fuzz.ratio(k, key))
-			score = fuzz.ratio(best, key)
+			best, score = matcher.match(key)
 			if score < 98:
 				failed.append(entry)
 			else:
@@ -1,11 +1,21 @@
 import io
+import queue
+import threading
+from itertools import islice
+from contextlib import nullcontext
 
 from .imports import *
 
 from .misc import get_path, load_db, load_item_file
 from .building import init_db
-from .parsers import Parser
-from .datacls import Record, Asset, Account, Report, Tag, Transaction, Tagged, Linkable, Reportable, Verification
+from .parsers import Parser, load_parser
+from .datacls import (Record, Asset, Account, Report, Tag, Transaction, Tagged, Linkable, Reportable, Verification,
+					  Fingerprinted, Resolver)
+from .errors import UnresolvedConcepts
+from .merchants import MerchantCache
+from .caching import ParsedStatement, create_parse_cache, file_digest, parser_digest
+from .sources import source_state, record_source, find_sources, is_current
+from .fx import HARVESTED, harvest_rates
 from .writing import create_report
 
 @fig.component('sqlite')
@@ -38,6 +48,12 @@ def create_db(cfg: fig.Configuration):
 	init_db(conn)
 	# conn.commit()
 
+	# rows imported before fingerprints were introduced
+	with Resolver().load():
+		filled = sum(kind.fill_fingerprints() for kind in [Transaction, Verification])
+	if filled:
+		cfg.print(f'Computed the missing fingerprints of {filled} records.')
+
 	report = create_report(cfg)
 	cfg.print(f'Using report: {report}.')
 	report.write()
@@ -91,11 +107,36 @@ def add_transactions(cfg: fig.Configuration):
 	path = get_path(cfg, path_key='path', root_key='root')
 
 	cfg.push('parser._type', accountname, silent=True, overwrite=False)
+	# only the selected parser is imported
+	load_parser(cfg.pull('parser._type', silent=True))
 	parser: Parser = cfg.pull('parser')
 
-	items = parser.load_items(path)
-
-	cfg.print(f'Loaded {len(items)} items from {path}')
+	# if set, records are written in batches of this size while parsing, instead of all at the end
+	buffer_size = cfg.pull('buffer', None)
+
+	content_hash, parser_hash = file_digest(path), parser_digest(parser, cfg.peek('parser'))
+
+	# if set, the parsed output of files that were parsed before (with the same parser) is reused
+	cache = create_parse_cache(cfg)
+	key = None if cache is None else cache.key(content_hash, parser_hash, accountname)
+	parsed = None if key is None else cache.load(key)
+
+	if parsed is not None:
+		items = scan = ()
+		cfg.print(f'Loaded {len(parsed.records)} parsed records of {path} from {cache.root}')
+	elif buffer_size is None:
+		items = parser.load_items(path)
+		cfg.print(f'Loaded {len(items)} items from {path}')
+		scan = items
+	elif parser.streams():
+		items = parser.iter_items(path)
+		cfg.print(f'Streaming items from {path} (writing every {buffer_size} records)')
+		scan = parser.iter_items(path) if parser.prescan else ()
+	else:
+		# the parser can't read the file incrementally, so it is loaded once (also for the prescan)
+		items = parser.load_items(path)
+		cfg.print(f'Loaded {len(items)} items from {path} (writing every {buffer_size} records)')
+		scan = items
 
 	skip_commit = cfg.pull('skip-commit', False)
 	skip_confirm = (cfg.pull('skip-confirm', False, silent=True)
@@ -105,74 +146,240 @@ def add_transactions(cfg: fig.Configuration):
 	if skip_commit:
 		cfg.print(f'Will not commit changes to database.')
 
-	concepts = parser.prepare(account, items)
-	for concept in concepts:
-		concept.write_missing(report)
-
 	records: list[Reportable] = []
 	tags: dict[str, list[Tagged]] = {}
 	links: dict[str, list[list[Linkable]]] = {}
+	seen: dict[type, Counter] = {}
+
+	num_records = 0
+	num_written = 0
 
 	pbar = cfg.pull('pbar', True)
-	itr = tqdm(items) if pbar else items
-	for item in itr:
-		record = parser.parse(item, tags, links)
-		if record is not None:
-			# record.write(report)
-			if isinstance(record, (list, tuple)):
-				records.extend(record)
+
+	# when streaming, batches are written on a background thread while the next ones are parsed
+	background = parsed is None and buffer_size is not None and cfg.pull('write-behind', True)
+	# only complete outputs can be cached (not when streaming)
+	caching = parsed is None and cache is not None and buffer_size is None
+	merchants = MerchantCache(conn, report=report, account=account)
+
+	# all concepts are looked up in memory while parsing, unknown ones are collected and reported at the end
+	# (and known merchants fill in missing locations, after caching the output)
+	with Resolver().load() as resolver, (nullcontext() if background or caching else merchants):
+		concepts = parser.prepare(account, scan) if parsed is None else parsed.concepts
+		for concept in concepts:
+			concept.write_missing(report)
+
+		if parsed is not None:
+			records, tags, links = parsed.records, parsed.tags, parsed.links
+			Parser.apply_merchants(records)
+		elif background:
+			try:
+				with RecordWriter(report, seen, resolver, merchants, size=cfg.pull('write-queue', 4)) as writer:
+					itr = iter(tqdm(items) if pbar else items)
+					while len(chunk := list(islice(itr, buffer_size))):
+						writer.submit(parser.parse_all(chunk, tags, links), tags, links)
+						tags, links = {}, {}
+					parser.finish(records, tags, links)
+					writer.submit(records, tags, links, merchants=False)
+			except Exception:
+				# nothing of a failed import is kept
+				if not skip_commit:
+					conn.rollback()
+				raise
+			records, tags, links = [], {}, {}
+			num_records += writer.num_records
+			num_written += writer.num_written
+		else:
+			itr = tqdm(items) if pbar else items
+			if buffer_size is None:
+				records.extend(parser.parse_all(itr, tags, links))
 			else:
-				records.append(record)
+				itr = iter(itr)
+				while len(chunk := list(islice(itr, buffer_size))):
+					records.extend(parser.parse_all(chunk, tags, links))
+					num_records += len(records)
+					num_written += len(write_records(report, records, tags, links, seen, resolver=resolver))
+					records.clear()
+
+			parser.finish(records, tags, links)
+
+			if caching:
+				cache.save(key, ParsedStatement(concepts, records, tags, links))
+				Parser.apply_merchants(records, merchants)
+
+		num_records += len(records)
+		num_written += len(write_records(report, records, tags, links, seen, resolver=resolver))
 
-	parser.finish(records, tags, links)
+	if len(resolver.missing):
+		if not skip_commit:
+			conn.rollback()
+		raise UnresolvedConcepts(resolver.missing)
+
+	# so that unchanged files can be skipped when rebuilding (see `multiple_txn`)
+	if num_written > 0:
+		record_source(path, accountname, content_hash, parser_hash, report, conn=conn)
+
+	if num_written < num_records:
+		cfg.print(f'Skipped {num_records - num_written} records that are already in the database.')
+
+	if not skip_confirm:
+		while True:
+			cfg.print(f'Write {num_written} records? ([y]/n): ')
+			val = input().strip().lower()
+			if val.startswith('y'):
+				break
+			elif val.startswith('n'):
+				cfg.print('Aborted.')
+				return num_written
+
+	cfg.print(f'Writing {num_written} records.')
+
+	if not skip_commit:
+		conn.commit()
+
+	cfg.print(f'{num_written} records saved.')
+	return num_written
+
+
+
+def write_records(report: Report, records: list[Reportable], tags: dict[str, list[Tagged]],
+				  links: dict[str, list[list[Linkable]]], seen: dict[type, Counter] = None,
+				  resolver: Resolver = None) -> list[Reportable]:
+	'''
+	Writes a batch of parsed records in bulk per table, skipping those that were already imported before,
+	and then applies all pending tags and links (which are cleared afterwards).
+
+	`seen` keeps track of the fingerprints per record type across the batches of the same import.
+	If a `resolver` is given, all concepts are resolved first, and once any are missing nothing is written anymore
+	(since the import will fail anyway).
+	'''
+	if seen is None:
+		seen = {}
+
+	if resolver is not None:
+		records = [rec for rec in records if resolver.resolve(rec)]
+		for tag in tags:
+			resolver.find(Tag, tag)
+		if len(resolver.missing):
+			tags.clear()
+			links.clear()
+			return []
 
 	for rec in records:
 		if isinstance(rec, Transaction):
 			assert rec.amount is not None and rec.amount >= 0, f'Amount not set for {rec}'
 			assert rec.received_amount is None or rec.received_amount > 0, f'Received amount not set for {rec}'
 
+	kinds: dict[type, list[Reportable]] = {}
 	for rec in records:
-		rec.write(report)
+		kinds.setdefault(type(rec), []).append(rec)
+	written: list[Reportable] = []
+	for kind, group in kinds.items():
+		if issubclass(kind, Fingerprinted):
+			written.extend(kind.write_all(report, group, seen=seen.setdefault(kind, Counter())))
+		else:
+			written.extend(kind.write_all(report, group))
 
 	for tag, recs in tags.items():
 		for rec in recs:
-			rec.add_tags(report, tag)
+			if rec.exists:
+				rec.add_tags(report, tag)
+	tags.clear()
 
 	for category, groups in links.items():
 		for group in groups:
-			group = [txn for txn in group if isinstance(txn, Transaction)]
+			group = [txn for txn in group if isinstance(txn, Transaction) and txn.exists]
 			if len(group) > 1:
 				link, *others = group
 				link.add_links(report, *others, category=category)
+	links.clear()
 
-	if not skip_confirm:
-		while True:
-			cfg.print(f'Write {len(records)} records? ([y]/n): ')
-			val = input().strip().lower()
-			if val.startswith('y'):
-				break
-			elif val.startswith('n'):
-				cfg.print('Aborted.')
-				return records
+	return written
 
-	cfg.print(f'Writing {len(records)} records.')
 
-	if not skip_commit:
-		conn.commit()
 
-	cfg.print(f'{len(records)} records saved.')
-	return records
 
+class RecordWriter:
+	'''
+	Writes batches of parsed records (see `write_records`) on a background thread, so the parser can continue with the
+	next batch in the meantime. At most `size` batches are waiting at any time (`submit` blocks until there is room).
+
+	While the writer is running, it is the only one using the database: the locations of known merchants are filled
+	in (from `merchants`) right before each batch is written instead of while parsing. If writing a batch fails, the
+	remaining batches are dropped and the error is raised in the parsing thread (by the next `submit` or on exit).
+	'''
+	def __init__(self, report: Report, seen: dict[type, Counter], resolver: Resolver = None,
+				 merchants: MerchantCache = None, *, size: int = 4):
+		self.report = report
+		self.seen = seen
+		self.resolver = resolver
+		self.merchants = merchants
+		self.queue = queue.Queue(maxsize=max(1, size))
+		self.thread = threading.Thread(target=self._run, name='record-writer', daemon=True)
+		self.error: Optional[BaseException] = None
+		self.num_records = 0
+		self.num_written = 0
+
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.queue.put(None)
+		self.thread.join()
+		if exc_type is None:
+			self._check()
+
+
+	def _check(self):
+		if self.error is not None:
+			raise RuntimeError(f'Writing the records failed: {self.error}') from self.error
+
+
+	def submit(self, records: list[Reportable], tags: dict[str, list[Tagged]],
+			   links: dict[str, list[list[Linkable]]], *, merchants: bool = True):
+		'''
+		Queues a batch to be written (after filling in the merchants, unless `merchants` is False). The batch is owned
+		by the writer afterwards, so the caller has to continue with new `tags` and `links`.
+		'''
+		self._check()
+		self.num_records += len(records)
+		self.queue.put((records, tags, links, merchants))
+
+
+	def _run(self):
+		while (batch := self.queue.get()) is not None:
+			if self.error is not None:
+				# keep draining so the parsing thread never blocks on a full queue
+				continue
+			records, tags, links, merchants = batch
+			try:
+				if merchants and self.merchants is not None:
+					Parser.apply_merchants(records, self.merchants)
+				self.num_written += len(write_records(self.report, records, tags, links, self.seen,
+													  resolver=self.resolver))
+			except BaseException as e:
+				self.error = e
 
 
 @fig.script('full-reset')
 def multiple_txn(cfg: fig.Configuration):
-
+	'''
+	Imports all files listed under `txn` (and the manual transactions in `manuals-path`) in one transaction.
+
+	If `incremental` is set, files that were already imported in the same state with the same parser (see the
+	`sources` table) are skipped, and the records of files that changed are removed before they are imported again,
+	so the rest of the database is left untouched. Files imported before sources were recorded are not tracked,
+	so the first incremental rebuild should start from a fresh database.
+	'''
 	create_db(cfg)
 
 	conn = cfg.pull('conn')
 
 	pbar = cfg.pull('multi-pbar', True)
+	incremental = cfg.pull('incremental', False)
 
 	cfg.push('skip-commit', True, silent=True, overwrite=False)
 	cfg.push('skip-confirm', True, silent=True, overwrite=False)
@@ -181,26 +388,46 @@ def multiple_txn(cfg: fig.Configuration):
 
 	itr = tqdm(todo) if pbar else todo
 
+	skipped = 0
 	for item in itr:
 		account = item.pull('account', None, silent=True)
 		if pbar:
 			itr.set_description(f'Account: {account}')
 
+		if incremental:
+			path, content_hash, parser_hash = source_state(item)
+			sources = find_sources(path, account, conn=conn)
+			if is_current(sources, content_hash, parser_hash):
+				skipped += 1
+				continue
+			for source in sources:
+				undo_report(conn, source.report, commit=False)
+
 		with cfg.silence(True):
 			add_transactions(item)
 
+	if incremental:
+		cfg.print(f'Imported {len(todo) - skipped} changed files (skipped {skipped} unchanged files).')
+
 	manuals_path = cfg.pull('manuals-path', None)
 	if manuals_path is not None:
-		report = Report(category='manual', description=f'from {manuals_path}')
+		content_hash = file_digest(manuals_path)
+		sources = find_sources(manuals_path, None, conn=conn) if incremental else []
+		if not is_current(sources, content_hash, 'manual'):
+			for source in sources:
+				undo_report(conn, source.report, commit=False)
 
-		manuals = load_yaml(manuals_path)
-		if len(manuals) > 0:
-			report.write()
+			report = Report(category='manual', description=f'from {manuals_path}')
 
-		for manual in manuals:
-			typ = manual.pop('type', 'txn')
-			txn = Transaction(**manual) if typ == 'txn' else Verification(**manual)
-			txn.write(report)
+			manuals = load_yaml(manuals_path)
+			if len(manuals) > 0:
+				report.write()
+				record_source(manuals_path, None, content_hash, 'manual', report, conn=conn)
+
+			for manual in manuals:
+				typ = manual.pop('type', 'txn')
+				txn = Transaction(**manual) if typ == 'txn' else Verification(**manual)
+				txn.write(report)
 
 	cfg.print(f'Finished writing all transactions, now committing changes to database.')
 	conn.commit()
@@ -208,6 +435,88 @@ def multiple_txn(cfg: fig.Configuration):
 
 
 
+def undo_report(conn: sqlite3.Connection, report: Report | int, *, commit: bool = True) -> dict[str, int]:
+	'''
+	Deletes all transactions, verifications and statements written under `report` together with their
+	links and tags (and any links/tags of other reports that refer to them), as well as the merchants learned
+	while importing them, the exchange rates harvested from its conversions and the record of the imported file.
+	Runs as a single transaction (unless `commit` is False, then it is part of the current one).
+
+	Concepts (assets, accounts, tags) and the report itself are kept, since other records may refer to them.
+	Returns the number of deleted rows per table.
+	'''
+	ID = report.ID if isinstance(report, Report) else report
+	commands = {
+		'transaction_tags': 'DELETE FROM transaction_tags WHERE report = :report '
+							'OR id IN (SELECT id FROM transactions WHERE report = :report)',
+		'verification_tags': 'DELETE FROM verification_tags WHERE report = :report '
+							 'OR id IN (SELECT id FROM verifications WHERE report = :report)',
+		'statement_tags': 'DELETE FROM statement_tags WHERE report = :report '
+						  'OR id IN (SELECT id FROM statements WHERE report = :report)',
+		'account_tags': 'DELETE FROM account_tags WHERE report = :report',
+		'transaction_links': 'DELETE FROM transaction_links WHERE report = :report '
+							 'OR id1 IN (SELECT id FROM transactions WHERE report = :report) '
+							 'OR id2 IN (SELECT id FROM transactions WHERE report = :report)',
+		'statement_links': 'DELETE FROM statement_links WHERE report = :report '
+						   'OR id1 IN (SELECT id FROM statements WHERE report = :report) '
+						   'OR id2 IN (SELECT id FROM statements WHERE report = :report)',
+		'transaction_revisions': 'DELETE FROM transaction_revisions '
+								 'WHERE ref_id IN (SELECT id FROM transactions WHERE report = :report)',
+		'statement_revisions': 'DELETE FROM statement_revisions '
+							   'WHERE ref_id IN (SELECT id FROM statements WHERE report = :report)',
+		'fx_rates': f'DELETE FROM fx_rates WHERE source = {HARVESTED!r} AND (base, quote, day) IN '
+					'(SELECT unit, received_unit, date(dateof) FROM transactions WHERE report = :report)',
+		'verifications': 'DELETE FROM verifications WHERE report = :report',
+		'transactions': 'DELETE FROM transactions WHERE report = :report',
+		'statements': 'DELETE FROM statements WHERE report = :report',
+		'merchants': 'DELETE FROM merchants WHERE report = :report',
+		'sources': 'DELETE FROM sources WHERE report = :report',
+	}
+	counts = {}
+	with conn if commit else nullcontext():
+		# verifications of other reports only lose their match
+		conn.execute('UPDATE verifications SET txn = NULL '
+					 'WHERE txn IN (SELECT id FROM transactions WHERE report = :report)', {'report': ID})
+		for table, cmd in commands.items():
+			counts[table] = conn.execute(cmd, {'report': ID}).rowcount
+		if counts['fx_rates']:
+			# the rates of those days may also be implied by conversions of other reports
+			harvest_rates(conn)
+	return counts
+
+
+
+@fig.script('undo')
+def undo(cfg: fig.Configuration):
+	'''Removes all records written under a given report (e.g. a botched import).'''
+	conn = cfg.pull('conn')
+
+	report = Report.find(cfg.pull('report'))
+	cfg.print(f'Undoing report: {report!r}')
+
+	skip_confirm = (cfg.pull('skip-confirm', False, silent=True)
+					or cfg.pulls('yes', 'y', default=False, silent=True))
+
+	if not skip_confirm:
+		total = sum(conn.execute(f'SELECT COUNT(*) FROM {table} WHERE report = ?', (report.ID,)).fetchone()[0]
+					for table in ['transactions', 'verifications', 'statements'])
+		while True:
+			cfg.print(f'Delete {total} records of {report}? (y/[n]): ')
+			val = input().strip().lower()
+			if val.startswith('y'):
+				break
+			elif val.startswith('n') or not len(val):
+				cfg.print('Aborted.')
+				return
+
+	counts = undo_report(conn, report)
+
+	cfg.print(tabulate([(table, num) for table, num in counts.items() if num], headers=['Table', 'Deleted']))
+	cfg.print(f'Removed {sum(counts.values())} rows.')
+	return counts
+
+
+
 # @fig.script('verify')
 def verify_internal_transactions(cfg: fig.Configuration):
 	conn = cfg.pull('conn')
@@ -231,25 +540,33 @@ def verify_internal_transactions(cfg: fig.Configuration):
 
 	cfg.print(f'Verifying {len(txns)} transactions and {len(vers)} verifications: {len(internals)} internal txns.')
 
-	available = vers.copy()
+	# verifications by their exact amount (in minor units) and accounts, so matching is a lookup
+	unmatched: dict[tuple[int, int, int], list[Verification]] = {}
+	for ver in vers:
+		key = ver.minor_amount(), ver._column_value('sender'), ver._column_value('receiver')
+		unmatched.setdefault(key, []).append(ver)
+
 	matches = []
 	missing = []
 
 	for txn in [txn for txn in internals if txn.date.year == 2023]:
-		candidates = [v for v in available if v.amount == (
-			txn.amount if txn.received_amount is None else txn.received_amount) and v.sender == txn.sender and v.receiver == txn.receiver]
+		key = (txn.minor_amount('amount' if txn.received_amount is None else 'received_amount'),
+			   txn._column_value('sender'), txn._column_value('receiver'))
+		candidates = unmatched.get(key, [])
 		if len(candidates) == 1:
-			match = candidates[0]
-			available.remove(match)
+			match = candidates.pop()
 			matches.append((txn, match))
 		elif len(candidates) > 1:
 			date = txn.date
 			diffs = sorted(candidates, key=lambda v: abs((v.date - date).days))
-			available.remove(diffs[0])
+			candidates.remove(diffs[0])
 			matches.append((txn, diffs[0]))
 		else:
 			missing.append(txn)
 
+	matched = {ver.ID for _, ver in matches}
+	available = [ver for ver in vers if ver.ID not in matched]
+
 	cfg.print(f'Found {len(matches)} matches and {len(missing)} missing transactions, '
 			  f'with {len(available)} verifications left.')
 
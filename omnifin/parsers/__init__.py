@@ -0,0 +1,80 @@
+'''
+Parsers for the exports of each supported institution, registered as components by the name of the account.
+
+Only the base classes are imported here: every parser lives in its own module, which is only imported (and registers
+its component) once that parser is needed (see `load_parser`). Parsers of other packages are found through the
+`omnifin.parsers` entry point group, e.g. in their `setup.cfg`:
+
+	[options.entry_points]
+	omnifin.parsers =
+		mybank = mypackage.parsers:MyBank
+'''
+from importlib import import_module
+from importlib.metadata import entry_points
+
+from ..imports import *
+
+from .base import Parser, MCC_Parser, TableParser
+
+
+ENTRY_POINT_GROUP = 'omnifin.parsers'
+
+# component name -> "module:class" (same format as entry points)
+PARSERS = {
+	'amazon': 'omnifin.parsers.amazon:Amazon',
+	'bank99': 'omnifin.parsers.bank99:Bank99',
+	'becu': 'omnifin.parsers.becu:BECU',
+	'boa': 'omnifin.parsers.boa:BOA',
+	'cap1': 'omnifin.parsers.cap1:CapitalOne',
+	'commerz': 'omnifin.parsers.commerz:Commerzbank',
+	'costco': 'omnifin.parsers.costco:CostcoCredit',
+	'dkb': 'omnifin.parsers.dkb:DKB',
+	'fidelity': 'omnifin.parsers.fidelity:Fidelity',
+	'heritage': 'omnifin.parsers.heritage:Heritage',
+	'ibkr': 'omnifin.parsers.ibkr:IBKR',
+	'paypal': 'omnifin.parsers.paypal:Paypal',
+	'usbank': 'omnifin.parsers.usbank:USBank',
+}
+
+
+
+def register_parser(name: str, target: str):
+	'''Registers the parser `target` ("module:class") as `name` without importing it yet.'''
+	PARSERS[name] = target
+
+
+
+def available_parsers() -> list[str]:
+	'''Names of all known parsers (built-in and from entry points), without importing any of them.'''
+	return sorted({*PARSERS, *(ep.name for ep in entry_points(group=ENTRY_POINT_GROUP))})
+
+
+
+def load_parser(name: str) -> Optional[Type[Parser]]:
+	'''
+	Imports the parser registered as `name` and makes sure it is available as component `name`.
+	If no parser of that name is known, the class of the component `name` is returned (None if there is none).
+	'''
+	project = fig.get_current_project()
+	if name not in PARSERS:
+		for ep in entry_points(group=ENTRY_POINT_GROUP, name=name):
+			PARSERS[name] = ep.value
+			break
+		else:
+			entry = project.find_component(name, None)
+			return None if entry is None else entry.cls
+	module, _, attr = PARSERS[name].partition(':')
+	cls = getattr(import_module(module), attr)
+	if project.find_component(name, None) is None:
+		# third-party parsers don't have to register themselves
+		project.register_component(name, cls)
+	return cls
+
+
+
+def __getattr__(name: str):
+	# parser classes can still be accessed as attributes (e.g. `parsers.DKB`), which imports them
+	for key, target in PARSERS.items():
+		if target.endswith(f':{name}'):
+			return load_parser(key)
+	raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,24 @@
+from ..imports import *
+
+from ..datacls import Account, Tag
+from .base import TableParser
+
+
+
+@fig.component('amazon')
+class Amazon(TableParser):
+	date_key = 'Transaction Date'
+	date_format = '%m/%d/%Y'
+	amount_key = 'Amount'
+	unit = 'usd'
+	description_key = 'Description'
+	reference_key = 'Reference'
+	tag_semicolons = False
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		recs = super().prepare(account, items)
+		recs.extend([
+			Tag(name='amazon', category='amazon', description='orders fulfilled by amazon directly'),
+			Tag(name='marketplace', category='amazon', description='orders fulfilled by 3rd party sellers'),
+		])
+		return recs
@@ -0,0 +1,19 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('bank99')
+class Bank99(TableParser):
+	date_key = 'Buchungsdatum'
+	date_format = '%Y-%m-%d'
+	amount_key = 'Betrag'
+	delimiter = ';'
+	decimal = ','
+	thousands = None
+	unit = 'eur'
+	description_key = 'Notes'
+	reference_key = 'Eigene Referenz'
+	tag_semicolons = False
+	sign_check = 'direction'
@@ -0,0 +1,379 @@
+from __future__ import annotations
+from ..imports import *
+
+from ..misc import (load_item_file, iter_item_file, format_european_amount, MCC, format_regular_amount,
+					format_european_amounts, format_regular_amounts, string_cells, table_rows)
+from ..merchants import MerchantCache
+from ..datacls import (Record, Account, Transaction, Verification, Tag, Tagged, Linkable, Reportable,
+					   Resolver)
+
+
+
+class Parser(fig.Configurable):
+	# whether `prepare` needs to see all items before parsing (e.g. to collect tags or symbols)
+	prescan = False
+	# when streaming, csv files are read in chunks of this many rows
+	chunksize: int = 10000
+
+	def load_items(self, path: Path):
+		return load_item_file(path)
+
+	def streams(self) -> bool:
+		'''
+		Whether `iter_items` reads the file incrementally. Parsers with a custom `load_items` (e.g. IBKR and Fidelity,
+		which need all sections of the statement at once) load the whole file even when streaming, so their items are
+		loaded once and also used for the prescan (only the records are written in batches).
+		'''
+		return type(self).load_items is Parser.load_items
+
+	def iter_items(self, path: Path) -> Iterator[dict]:
+		'''Yields the items one at a time (used when streaming, may be called again for the prescan).'''
+		if self.streams():
+			yield from iter_item_file(path, self.chunksize)
+		else:
+			yield from self.load_items(path)
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		'''
+		Returns all concepts the records will need. When streaming, `items` is a separate single pass over
+		the file if `prescan` is set (and empty otherwise), so it should not be stored.
+		'''
+		self.account = account
+		return []
+
+	def parse(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+		raise NotImplementedError
+
+	def parse_all(self, items: Iterable[dict], tags: dict[str, list[Tagged]],
+				  links: dict[str, list[list[Linkable]]]) -> list[Reportable]:
+		'''Parses a batch of items (subclasses may override this to parse them all at once).'''
+		records = []
+		for item in items:
+			record = self.parse(item, tags, links)
+			if record is not None:
+				if isinstance(record, (list, tuple)):
+					records.extend(record)
+				else:
+					records.append(record)
+		return self.apply_merchants(records)
+
+	@staticmethod
+	def apply_merchants(records: list[Reportable], cache: MerchantCache = None) -> list[Reportable]:
+		'''
+		Fills in the locations of known merchants (and remembers new ones) from `cache`, by default only while a
+		`MerchantCache` is active.
+		'''
+		if cache is None:
+			cache = MerchantCache.active
+		if cache is not None:
+			for record in records:
+				if isinstance(record, (Transaction, Verification)):
+					cache.apply(record)
+		return records
+
+	def finish(self, records: list[Reportable], tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+		'''
+		Called after the last item. When streaming, `records` only contains the records that are not written yet,
+		so parsers that need to link records across the whole file have to keep track of them.
+		'''
+		pass
+
+
+	@staticmethod
+	def find_account(query: str | int, uses: int = 1):
+		'''
+		Finds the account, or if a resolver is set and there is no such account, records the miss (for `uses` records)
+		and returns an unwritten placeholder (so the records using it won't be written).
+		'''
+		resolver: Resolver = Record._resolver
+		if resolver is None:
+			return Account.find(query)
+		account = resolver.find(Account, query, uses)
+		return Account(name=str(query)) if account is None else account
+
+	@staticmethod
+	def create_transaction(source: Account, sender: Account | str = None, receiver: Account | str = None):
+		if sender is None:
+			sender = source
+		if receiver is None:
+			receiver = source
+		if not isinstance(sender, Account):
+			sender = Parser.find_account(sender)
+		if not isinstance(receiver, Account):
+			receiver = Parser.find_account(receiver)
+		return Parser.record_type(source, sender, receiver)(sender=sender, receiver=receiver)
+
+	@staticmethod
+	def record_type(source: Account, sender: Account, receiver: Account) -> Type[Transaction | Verification]:
+		'''Incoming records from other internal accounts only verify the transaction imported from that account.'''
+		if receiver == source and sender != source and sender.name != 'cash' and sender.owner != 'external':
+			return Verification
+		return Transaction
+
+
+
+class MCC_Parser(Parser):
+	prescan = True
+
+	def extract_mcc_tags(self, tags: Iterable[str]):
+		existing = set()
+		mcc = MCC()
+		concepts = []
+		for tag in tags:
+			if tag not in existing and (mcc_tag := mcc.find(tag)) is not None:
+				concepts.append(Tag(name=tag, category='MCC', description=mcc_tag['edited_description']))
+			existing.add(tag)
+		return concepts
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		concepts = super().prepare(account, items)
+		candidates = Counter(tag for item in items if item['Tags'] is not None for tag in
+							(item['Tags'].split(';') if ';' in item['Tags'] else item['Tags'].split(',')))
+		concepts.extend(self.extract_mcc_tags(candidates))
+		return concepts
+
+
+
+class TableParser(MCC_Parser):
+	'''
+	Parser for simple exports where every row is one transaction between `self.account` and the counterparty in the
+	"Sender" (incoming) or "Receiver" (outgoing) column. Subclasses only declare which columns to use, so all rows
+	can be parsed at once with vectorized operations (`parse_table`), while `parse` handles one row at a time.
+	'''
+	date_key: str = None
+	date_format: str = None
+
+	# either a single (signed) amount column, or separate columns for outgoing and incoming amounts
+	amount_key: str = None
+	debit_key: str = None
+	credit_key: str = None
+	decimal: str = '.'
+	thousands: str = ','
+
+	# either a fixed unit, or the column containing it
+	unit: str = None
+	unit_key: str = None
+
+	description_key: str = None
+	location_key: str = 'Location'
+	reference_key: str = None
+
+	# column which may end with " %out-asset <amount> <unit>" (e.g. for currency conversions)
+	out_asset_key: str = None
+
+	tags_key: str = 'Tags'
+	# if set, tags containing any ';' are split on ';' instead of ','
+	tag_semicolons: bool = True
+
+	# None, 'direction' (outgoing amounts must be negative and incoming ones positive) or 'outflow' (only outgoing
+	# amounts may be negative)
+	sign_check: str = None
+
+	# if set, the file is loaded as csv with this delimiter (only reading the columns that are used, all as strings)
+	# and the amount column is converted while loading
+	delimiter: str = None
+
+
+	def columns(self) -> list[str]:
+		'''All columns the parser uses.'''
+		keys = [self.date_key, self.amount_key, self.debit_key, self.credit_key, self.unit_key, self.description_key,
+				self.location_key, self.reference_key, self.out_asset_key, self.tags_key, 'Sender', 'Receiver']
+		return list(dict.fromkeys(key for key in keys if key is not None))
+
+
+	def read_table(self, path: Path, **kwargs) -> pd.DataFrame | Iterator[pd.DataFrame]:
+		'''Reads the csv (see `delimiter`) skipping unused columns and type inference.'''
+		return pd.read_csv(path, delimiter=self.delimiter, usecols=self.columns(), dtype=str, **kwargs)
+
+
+	def table_items(self, frame: pd.DataFrame) -> list[dict]:
+		if self.amount_key is not None:
+			frame[self.amount_key] = self.to_amounts(frame[self.amount_key])
+		return table_rows(frame)
+
+
+	def load_items(self, path: Path):
+		if self.delimiter is None:
+			return super().load_items(path)
+		return self.table_items(self.read_table(path))
+
+
+	def streams(self) -> bool:
+		return type(self).load_items is TableParser.load_items
+
+
+	def iter_items(self, path: Path) -> Iterator[dict]:
+		if self.delimiter is None:
+			yield from super().iter_items(path)
+			return
+		# only one chunk of the file is in memory at a time
+		with self.read_table(path, chunksize=self.chunksize) as chunks:
+			for frame in chunks:
+				yield from self.table_items(frame)
+
+
+	def to_amount(self, val: str | float) -> float:
+		if self.decimal == ',':
+			if self.thousands is not None and isinstance(val, str):
+				val = val.replace(self.thousands, '')
+			return format_european_amount(val)
+		return format_regular_amount(val)
+
+
+	def split_tags(self, tags: str | None) -> list[str]:
+		if tags is None:
+			return []
+		return tags.split(';') if self.tag_semicolons and ';' in tags else tags.split(',')
+
+
+	@staticmethod
+	def split_out_asset(notes: str | None):
+		'''Returns the notes without the out-asset suffix and the received (amount, unit) if there is one.'''
+		if notes is None or '%out-asset' not in notes:
+			return notes, None
+		received = notes.split(' %out-asset ')[-1].strip()
+		notes = notes.split(' %out-asset ')[0].strip()
+		terms = received.split(' ')
+		assert len(terms) == 2
+		num, cur = terms
+		return notes, (abs(float(num)), cur)
+
+
+	def parse(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		amt = self.to_amount(item[self.amount_key or (self.debit_key if item['Sender'] is None else self.credit_key)])
+
+		txn = self.create_transaction(self.account, sender=item['Sender'], receiver=item['Receiver'])
+
+		if self.sign_check == 'direction':
+			assert (item['Sender'] is None and amt <= 0) or (item['Receiver'] is None and amt >= 0), \
+				f'Invalid amount: {item}'
+		elif self.sign_check == 'outflow':
+			assert amt >= 0 or txn.sender == self.account, f'Negative amount: {item}'
+
+		txn.date = datetime.strptime(item[self.date_key], self.date_format).date()
+
+		txn.amount = abs(amt)
+		txn.unit = self.unit if self.unit_key is None else item[self.unit_key]
+
+		description = item[self.description_key]
+		if self.out_asset_key is not None:
+			notes, received = self.split_out_asset(item[self.out_asset_key])
+			if received is not None:
+				txn.received_amount, txn.received_unit = received
+			if self.out_asset_key == self.description_key:
+				description = notes
+
+		txn.description = description
+		txn.location = item[self.location_key]
+		if self.reference_key is not None:
+			txn.reference = item[self.reference_key]
+
+		for tag in self.split_tags(item[self.tags_key]):
+			tags.setdefault(tag, []).append(txn)
+
+		return txn
+
+
+	def parse_all(self, items: Iterable[dict], tags: dict[str, list[Tagged]],
+				  links: dict[str, list[list[Linkable]]]) -> list[Reportable]:
+		items = list(items)
+		if not len(items):
+			return []
+		return self.apply_merchants(self.parse_table(pd.DataFrame.from_records(items), tags, links, items=items))
+
+
+	@staticmethod
+	def _values(col: pd.Series) -> list:
+		return col.astype(object).where(col.notna(), None).tolist()
+
+
+	def to_amounts(self, col: pd.Series, *, errors: str = 'raise') -> pd.Series:
+		'''Vectorized `to_amount`.'''
+		if self.decimal == ',':
+			return format_european_amounts(col, thousands=self.thousands, errors=errors)
+		return format_regular_amounts(col, errors=errors)
+
+
+	def parse_table(self, frame: pd.DataFrame, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]],
+					*, items: list[dict] = None) -> list[Reportable]:
+		'''
+		Parses all rows of `frame` at once. Rows that don't fit the vectorized path (unparsable amounts or dates,
+		unexpected signs, conversions, etc.) are passed to `parse` individually (`items` are the original rows).
+		'''
+		senders, receivers = frame['Sender'], frame['Receiver']
+		outgoing = senders.isna()
+
+		raw = frame[self.amount_key] if self.amount_key is not None \
+			else frame[self.debit_key].where(outgoing, frame[self.credit_key])
+		amounts = self.to_amounts(raw, errors='coerce')
+
+		dates = pd.to_datetime(string_cells(frame[self.date_key]), format=self.date_format, errors='coerce')
+
+		irregular = amounts.isna() | dates.isna()
+		if self.sign_check == 'direction':
+			irregular |= ~((outgoing & (amounts <= 0)) | (receivers.isna() & (amounts >= 0)))
+		elif self.sign_check == 'outflow':
+			irregular |= ~((amounts >= 0) | outgoing)
+
+		raw_tags = frame[self.tags_key]
+		text = string_cells(raw_tags)
+		irregular |= raw_tags.notna() & text.isna()
+		if self.tag_semicolons:
+			semicolons = text.str.contains(';', regex=False).fillna(False).astype(bool)
+			tag_lists = text.str.split(',').where(~semicolons, text.str.split(';'))
+		else:
+			tag_lists = text.str.split(',')
+
+		if self.out_asset_key is not None:
+			raw_notes = frame[self.out_asset_key]
+			notes = string_cells(raw_notes)
+			irregular |= (raw_notes.notna() & notes.isna()) \
+						 | notes.str.contains('%out-asset', regex=False).fillna(False).astype(bool)
+
+		columns = {
+			'date': self._values(dates.dt.date),
+			'amount': self._values(amounts.abs()),
+			'description': self._values(frame[self.description_key]),
+			'location': self._values(frame[self.location_key]),
+		}
+		if self.unit_key is not None:
+			columns['unit'] = self._values(frame[self.unit_key])
+		if self.reference_key is not None:
+			columns['reference'] = self._values(frame[self.reference_key])
+
+		counterparties = {name: self.find_account(name, uses)
+						  for name, uses in pd.concat([senders, receivers]).value_counts(sort=False).items()}
+		kinds = {}
+
+		if items is None:
+			items = table_rows(frame)
+
+		records = []
+		for i, (sender, receiver, skip, row_tags) in enumerate(zip(self._values(senders), self._values(receivers),
+																	irregular.tolist(), tag_lists.tolist())):
+			if skip:
+				record = self.parse(items[i], tags, links)
+				if record is not None:
+					records.append(record)
+				continue
+
+			key = sender, receiver
+			sender = self.account if sender is None else counterparties[sender]
+			receiver = self.account if receiver is None else counterparties[receiver]
+			if key not in kinds:
+				kinds[key] = self.record_type(self.account, sender, receiver)
+			txn = kinds[key](sender=sender, receiver=receiver)
+
+			for attr, values in columns.items():
+				setattr(txn, attr, values[i])
+			if self.unit_key is None:
+				txn.unit = self.unit
+
+			if isinstance(row_tags, list):
+				for tag in row_tags:
+					tags.setdefault(tag, []).append(txn)
+
+			records.append(txn)
+
+		return records
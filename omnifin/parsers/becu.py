@@ -0,0 +1,15 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('becu')
+class BECU(TableParser):
+	date_key = 'Date'
+	date_format = '%m/%d/%Y'
+	debit_key = 'Debit'
+	credit_key = 'Credit'
+	unit = 'usd'
+	description_key = 'Notes'
+	tag_semicolons = False
@@ -0,0 +1,14 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('boa')
+class BOA(TableParser):
+	date_key = 'Date'
+	date_format = '%m/%d/%Y'
+	amount_key = 'Amount'
+	unit = 'usd'
+	description_key = 'Notes'
+	tag_semicolons = False
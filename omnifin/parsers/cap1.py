@@ -0,0 +1,15 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('cap1')
+class CapitalOne(TableParser):
+	date_key = 'Transaction Date'
+	date_format = '%Y-%m-%d'
+	debit_key = 'Debit'
+	credit_key = 'Credit'
+	unit = 'usd'
+	description_key = 'Description'
+	out_asset_key = 'Description'
@@ -0,0 +1,18 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('commerz')
+class Commerzbank(TableParser):
+	date_key = 'Buchungstag'
+	date_format = '%d.%m.%Y'
+	amount_key = 'Betrag'
+	delimiter = ';'
+	decimal = ','
+	thousands = None
+	unit_key = 'Währung'
+	description_key = 'Notes'
+	reference_key = 'Reference'
+	sign_check = 'outflow'
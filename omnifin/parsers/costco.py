@@ -0,0 +1,14 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('costco')
+class CostcoCredit(TableParser):
+	date_key = 'Date'
+	date_format = '%m/%d/%Y'
+	debit_key = 'Debit'
+	credit_key = 'Credit'
+	unit = 'usd'
+	description_key = 'Description'
@@ -0,0 +1,18 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('dkb')
+class DKB(TableParser):
+	date_key = 'Buchungsdatum'
+	date_format = '%d.%m.%y'
+	amount_key = 'Betrag (€)'
+	delimiter = ';'
+	decimal = ','
+	thousands = '.'
+	unit = 'eur'
+	description_key = 'Notes'
+	reference_key = 'Kundenreferenz'
+	sign_check = 'outflow'
@@ -0,0 +1,206 @@
+from ..imports import *
+
+from ..misc import format_regular_amount, map_file, line_spans, LineSpans
+from ..datacls import Asset, Account, Transaction, Tagged, Linkable
+from .base import Parser
+
+
+
+@fig.component('fidelity')
+class Fidelity(Parser):
+	prescan = True
+
+	def load_items(self, path: Path):
+		# the csv is parsed straight from the mapped file, skipping the title and the disclaimer at the end
+		with map_file(path) as buffer:
+			spans = [(start, end) for start, end in line_spans(buffer) if end > start
+					 and (end - start != len(b'Brokerage') or buffer[start:end] != b'Brokerage')
+					 and buffer[start:start + 1] != b'"'
+					 and buffer[start:start + 15] != b'Date downloaded']
+			with LineSpans(buffer, spans) as lines:
+				return [self.normalize_item(item) for item in load_csv_rows(lines)]
+
+	@staticmethod
+	def normalize_item(item: dict):
+		# some exports include the currency in the column names and call the security "Description"
+		if 'Price ($)' in item:
+			keys = [key for key in item if key.endswith(' ($)')]
+			item['Currency'] = 'USD'
+			for key in keys:
+				item[key[:-4]] = item[key]
+				del item[key]
+
+		if 'Security Description' not in item:
+			item['Security Description'] = item['Description']
+			del item['Description']
+		return item
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		recs = super().prepare(account, items)
+
+		currency = 'USD'
+		currencies = set()
+		symbols = {}
+		for item in items:
+			currencies.add(item['Currency'])
+			if item['Symbol'] is not None and len(item['Symbol'].strip()):
+				symbols[item['Symbol'].strip()] = item['Security Description'].strip()
+		assert not len(currencies - {currency}), f'Unknown currency: {currencies}'
+
+		recs.extend([Asset(name=symbol, category='stock', description=f'{desc}')
+					 for symbol, desc in symbols.items()])
+
+		return recs
+
+	def parse(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		action = item['Action'].strip().lower()
+
+		assert item['Commission'] is None, f'{item["Commission"]}'
+		assert item['Accrued Interest'] is None, f'{item["Accrued Interest"]}'
+
+		if (action.startswith('you ') or action.startswith('reinvestment ') or action.startswith('redemption ')):
+			return self.parse_trade(item, tags, links)
+		elif any(action.startswith(key) for key in ['transferred to vs ', 'electronic funds transfer ',
+			'direct debit ',
+													'cash contribution', 'debit card purchase ',
+													'partic contr current', 'co contr current yr',
+													'transferred from mfst ', 'normal distr partial ',
+													'transferred from microsoft', 'direct deposit ',
+													'transferred from vs ',]):
+			return self.parse_transfer(item, tags, links)
+		elif (action.startswith('dividend received ') or action.startswith('short-term cap gain ')
+			  or action.startswith('long-term cap gain ') or action.startswith('distribution ')):
+			return self.parse_gain(item, tags, links, source='dividend')
+		elif action.startswith('interest earned '):
+			return self.parse_gain(item, tags, links, source='interest')
+		elif action.startswith('fee charged ') or action.startswith('adjust fee charged '):
+			return self.parse_fee(item, tags, links, target='institution')
+		elif action.startswith('foreign tax paid '):
+			return self.parse_fee(item, tags, links, target='tax')
+		elif (action.startswith('reverse split ') or action.startswith('exchanged to fzfxx ')
+			  or action.startswith('transferred to fzfxx ') or action.startswith('transferred to fcash ')
+			  or action.startswith('transferred from fcash ')):
+			return # skip
+		else:
+			raise ValueError(f'{action}')
+
+
+	def parse_transfer(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		other = item['Security Description'].strip()
+		assert other != 'No Description', f'Missing other account'
+		other = self.find_account(other)
+
+		amt = format_regular_amount(item['Amount'])
+		currency = item['Currency'].strip()
+
+		txn = self.create_transaction(self.account,
+									  sender=self.account if amt < 0 else other,
+									  receiver=other if amt < 0 else self.account)
+
+		txn.date = datetime.strptime(item['Run Date'].strip(), '%m/%d/%Y').date()
+
+		txn.amount = abs(amt)
+		txn.unit = currency
+
+		txn.description = item['Action'].strip()
+
+		if 'hsa' in self.account.description and any(txn.description.lower().startswith(key) for key in
+			   ['debit card purchase', 'normal distr partial']):
+			tags.setdefault('medical', []).append(txn)
+
+		return txn
+
+
+	def parse_fee(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]], *,
+				  target='institution'):
+
+		assert item['Fees'] is None, f'{item["Fees"]}'
+
+		quantity = format_regular_amount(item['Quantity'])
+		assert quantity == 0, f'{quantity}'
+
+		amt = format_regular_amount(item['Amount'])
+		currency = item['Currency'].strip()
+
+		txn = self.create_transaction(self.account,
+									  sender=self.account if amt < 0 else target,
+									  receiver=target if amt < 0 else self.account)
+
+		# assert amt < 0, f'{amt}'
+
+		txn.amount = abs(amt)
+		txn.unit = currency
+
+		action = item['Action'].strip()
+		txn.description = action
+
+		txn.date = datetime.strptime(item['Run Date'], ' %m/%d/%Y').date()
+
+		return txn
+
+
+	def parse_gain(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]], *,
+				   source='dividend'):
+
+		assert item['Fees'] is None, f'{item["Fees"]}'
+
+		amt = format_regular_amount(item['Amount'])
+		currency = item['Currency'].strip()
+
+		quantity = format_regular_amount(item['Quantity'])
+		symbol = item['Symbol'].strip()
+
+		assert amt == 0 or quantity == 0, f'{amt} vs {quantity}'
+
+		txn = self.create_transaction(self.account, sender=source, receiver=self.account)
+
+		txn.amount = amt if amt != 0 else quantity
+		txn.unit = currency if amt != 0 else symbol
+
+		assert txn.amount > 0, f'{txn.amount}'
+
+		txn.description = item['Action'].strip()
+		txn.date = datetime.strptime(item['Run Date'], ' %m/%d/%Y').date()
+
+		return txn
+
+
+	def parse_trade(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		txn = Transaction(sender=self.account, receiver=self.account)
+
+		amt = format_regular_amount(item['Amount'])
+		currency = item['Currency'].strip()
+
+		quantity = format_regular_amount(item['Quantity'])
+		symbol = item['Symbol'].strip()
+
+		txn.amount, txn.unit = (abs(amt), currency) if amt < 0 else (abs(quantity), symbol)
+		txn.received_amount, txn.received_unit = (abs(quantity), symbol) if amt < 0 else (abs(amt), currency)
+
+		action = item['Action'].strip()
+		txn.description = action
+
+		txn.date = datetime.strptime(item['Run Date'], ' %m/%d/%Y').date()
+
+		if item['Fees'] is not None:
+			cost = format_regular_amount(item['Fees'])
+			if cost != 0:
+				fee = Transaction()
+
+				fee.amount = abs(cost)
+				fee.unit = currency
+
+				fee.sender = self.account
+				fee.receiver = 'institution'
+
+				fee.date = txn.date
+				fee.description = f'fee for {action}'
+
+				links.setdefault('fee', []).append([txn, fee])
+
+				return [txn, fee]
+
+		return txn
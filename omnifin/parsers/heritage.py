@@ -0,0 +1,13 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('heritage')
+class Heritage(TableParser):
+	date_key = 'Date'
+	date_format = '%m-%d-%Y'
+	amount_key = 'Amount'
+	unit = 'usd'
+	description_key = 'Description'
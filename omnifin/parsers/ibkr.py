@@ -0,0 +1,308 @@
+from ..imports import *
+
+from ..misc import format_regular_amount, map_file, line_spans, line_head, LineSpans
+from ..datacls import Asset, Account, Transaction, Tagged, Linkable
+from .base import Parser
+
+
+
+@fig.component('ibkr')
+class IBKR(Parser):
+	prescan = True
+
+	def __init__(self, symbols_path: Path = None, symbol_map: dict | Path = None, **kwargs):
+		if symbols_path is not None and isinstance(symbols_path, str):
+			symbols_path = Path(symbols_path)
+		if symbol_map is not None and isinstance(symbol_map, str):
+			symbol_map = Path(symbol_map)
+			symbol_map = load_yaml(symbol_map)
+		super().__init__(**kwargs)
+		symbols = None
+		if symbols_path is not None and symbols_path.exists():
+			raw = load_yaml(symbols_path)
+			symbols = {(data['ibkr-contract']['symbol'], data['ibkr-contract']['currency']): k
+					   for k, data in raw.items()}
+			assert len(raw) == len(symbols)
+		if symbol_map is not None:
+			symbol_map = {tuple(ibkrticker_currency.split('_')): yf_symbol
+						  for ibkrticker_currency, yf_symbol in symbol_map.items()}
+			if symbols is not None:
+				symbols.update(symbol_map)
+			else:
+				symbols = symbol_map
+		self.symbols = symbols
+		self.symbols_path = symbols_path
+
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		recs = super().prepare(account, items)
+
+		trades = [item for item in items if 'Trades' in item and item['Asset Category'] == 'Stocks']
+
+		symbols = {self.sanitize_symbol(item['Symbol'], item['Currency']): (item['Symbol'], item['Currency'])
+				   for item in trades}
+
+		recs.extend([Asset(name=symbol, category='stock', description=f'{ibkr} {curr}')
+					 for symbol, (ibkr, curr) in symbols.items()])
+
+		return recs
+
+
+	# sections of the statement: (prefix of their lines ignoring quotes, header if the lines don't include it)
+	sections = {
+		'transfers': ('Deposits & Withdrawals', None),
+		'trades': ('Trades,Data,Order,Stocks', 'Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,'
+											   'Date/Time,Quantity,T. Price,C. Price,Proceeds,Comm/Fee,Basis,'
+											   'Realized P/L,MTM P/L,Code'),
+		'forex': ('Trades,Data,Order,Forex,', 'Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,'
+											  'Date/Time,Quantity,T. Price,,Proceeds,Comm in EUR,,,MTM in EUR,Code'),
+		'dividends': ('Dividends', None),
+		'interest': ('Interest,', None),
+		'fees': ('Transaction Fees,', None),
+		'withholding': ('Withholding Tax,', None),
+	}
+
+	def load_items(self, path: Path):
+		# input file should be the exported "Activity Statement" from IBKR in "csv format"
+		prefixes = {name: prefix.encode('utf-8') for name, (prefix, _) in self.sections.items()}
+		totals = {name: prefix.rstrip(b',') + b',Data,Total' for name, prefix in prefixes.items()}
+		size = max(map(len, totals.values()))
+
+		# the sections are found in a single pass over the mapped file and parsed straight from it
+		spans = {name: [] for name in self.sections}
+		with map_file(path) as buffer:
+			for start, end in line_spans(buffer):
+				head = line_head(buffer, start, end, size)
+				for name, prefix in prefixes.items():
+					if head.startswith(prefix):
+						if not head.startswith(totals[name]):
+							spans[name].append((start, end))
+						break
+
+			sections = {}
+			for name, (_, header) in self.sections.items():
+				with LineSpans(buffer, spans[name], header=header) as lines:
+					sections[name] = list(load_csv_rows(lines)) if len(spans[name]) else []
+
+		transfers, trades, forex = sections['transfers'], sections['trades'], sections['forex']
+		dividends, interest, fees = sections['dividends'], sections['interest'], sections['fees']
+		withholding = sections['withholding']
+
+		missing = [item for item in trades if self.sanitize_symbol(item['Symbol'], item['Currency']) is None]
+
+		if len(missing):
+			symbols = {item['Symbol'] for item in missing}
+			raise ValueError(f"Missing symbols: {symbols}")
+
+		return transfers + trades + dividends + forex + interest + fees + withholding
+
+	@staticmethod
+	def to_number(val: str | int | float):
+		return format_regular_amount(val)
+
+	def parse(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+		if 'Deposits & Withdrawals' in item:
+			return self.parse_transfer(item, tags, links)
+		elif 'Trades' in item and item['Asset Category'] == 'Stocks':
+			return self.parse_trade(item, tags, links)
+		elif 'Trades' in item and item['Asset Category'] == 'Forex':
+			return self.parse_forex(item, tags, links)
+		elif 'Dividends' in item:
+			return self.parse_dividend(item, tags, links)
+		elif 'Interest' in item:
+			return self.parse_interest(item, tags, links)
+		elif 'Transaction Fees' in item:
+			return self.parse_transaction_tax(item, tags, links)
+		elif 'Withholding Tax' in item:
+			return self.parse_withholding(item, tags, links)
+		raise ValueError(f"Unknown item type: {item}")
+
+	def sanitize_symbol(self, symbol: str, currency: str):
+		if (symbol, currency) in self.symbols:
+			return self.symbols[symbol, currency]
+		if symbol.endswith('d') or symbol.endswith('e') or symbol.endswith('b'):
+			return self.sanitize_symbol(symbol[:-1], currency)
+
+	def parse_withholding(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		amt = self.to_number(item['Amount'])
+
+		txn = self.create_transaction(self.account,
+									  sender=self.account if amt < 0 else 'tax',
+									  receiver='tax' if amt < 0 else self.account)
+
+		txn.date = datetime.strptime(item['Date'], '%Y-%m-%d').date()
+
+		txn.amount = abs(amt)
+		txn.unit = item['Currency']
+
+		txn.description = item['Description']
+
+		return txn
+
+	def parse_transaction_tax(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		txn = self.create_transaction(self.account, sender=self.account, receiver='tax')
+
+		date = datetime.strptime(item['Date/Time'], '%Y-%m-%d, %H:%M:%S')#.date()
+		txn.date = date
+
+		txn.amount = abs(self.to_number(item['Amount']))
+		assert txn.amount >= 0, f'Negative fee: {item}'
+		txn.unit = item['Currency']
+
+		symbol = self.sanitize_symbol(item['Symbol'], item['Currency'])
+		assert symbol is not None, f'Unknown symbol: {item}'
+
+		assert 'tax' in item['Description'].lower(), f'No tax in description: {item}'
+
+		txn.description = (f'{item["Description"]} for {item["Quantity"]} {symbol} '
+						   f'@ {item["Trade Price"]} {item["Currency"]}')
+
+		return txn
+
+	def parse_interest(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		amt = self.to_number(item['Amount'])
+
+		assert amt != 0, f'Zero interest: {item}'
+
+		txn = self.create_transaction(self.account,
+									  sender='interest' if amt > 0 else self.account,
+									  receiver=self.account if amt > 0 else 'institution')
+
+		txn.date = datetime.strptime(item['Date'], '%Y-%m-%d').date()
+
+		txn.amount = abs(self.to_number(item['Amount']))
+		txn.unit = item['Currency']
+
+		txn.description = item['Description']
+
+		return txn
+
+	def parse_forex(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		proceeds = self.to_number(item['Proceeds'])
+		currency = item['Currency']
+		quantity = self.to_number(item['Quantity'])
+
+		target, src = item['Symbol'].split('.')
+		assert src == currency, f'{src} != {currency} ({target})'
+
+		date = datetime.strptime(item['Date/Time'], '%Y-%m-%d, %H:%M:%S')#.date()
+
+		txn = Transaction(sender=self.account, receiver=self.account)
+		txn.date = date
+
+		txn.description = f'rate: {item["T. Price"]} {target}/{src}'
+
+		assert (proceeds > 0) != (quantity > 0), f'{proceeds} {quantity}'
+
+		if proceeds > 0:
+			txn.amount, txn.unit = abs(quantity), target
+			txn.received_amount, txn.received_unit = abs(proceeds), src
+		else:
+			txn.amount, txn.unit = abs(proceeds), src
+			txn.received_amount, txn.received_unit = abs(quantity), target
+
+		if any(k.startswith('Comm in') for k in item):
+			raw = [k for k in item if k.startswith('Comm in')]
+			assert len(raw) == 1
+			raw = raw[0]
+
+			cost = abs(item[raw])
+			if cost != 0:
+				fee = Transaction()
+
+				fee.sender = self.account
+				fee.receiver = 'institution'
+
+				fee.date = date
+
+				fee.description = f'commission fee'
+
+				fee.amount = abs(self.to_number(item[raw]))
+				fee.unit = raw.split('Comm in ')[-1]
+
+				links.setdefault('fee', []).append([txn, fee])
+
+				return [txn, fee]
+		return txn
+
+	def parse_dividend(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		txn = self.create_transaction(self.account, sender='dividend', receiver=self.account)
+
+		txn.date = datetime.strptime(item['Date'], '%Y-%m-%d').date()
+
+		txn.amount = abs(format_regular_amount(item['Amount']))
+		txn.unit = item['Currency']
+
+		txn.description = item['Description']
+
+		return txn
+
+	def parse_transfer(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		amt = item['Amount']
+		currency = item['Currency']
+
+		assert 'Sender' in item and 'Receiver' in item
+		assert item['Sender'] is None or amt > 0
+
+		txn = self.create_transaction(self.account, sender=item['Sender'], receiver=item['Receiver'])
+
+		txn.amount = abs(amt)
+		txn.unit = currency
+
+		txn.date = datetime.strptime(item['Settle Date'], '%Y-%m-%d').date()
+
+		txn.description = item['Description']
+		# txn.location = ',online'
+
+		return txn
+
+	def parse_trade(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		txn = Transaction(sender=self.account, receiver=self.account)
+
+		proceeds = self.to_number(item['Proceeds'])
+		currency = item['Currency']
+
+		quantity = self.to_number(item['Quantity'])
+		raw_symbol = item['Symbol']
+		symbol = self.sanitize_symbol(raw_symbol, currency)
+		assert symbol is not None, f'Unknown symbol: {raw_symbol} ({currency})'
+
+		txn.date = datetime.strptime(item['Date/Time'], '%Y-%m-%d, %H:%M:%S')#.date()
+
+		gains = self.to_number(item['Realized P/L'])
+		gain_info = f' (P/L: {gains} {currency})' if gains != 0 else ''
+		txn.description = f'{self.to_number(item["T. Price"])} {currency}/{symbol}{gain_info}'
+
+		if proceeds > 0:
+			txn.amount, txn.unit = abs(quantity), symbol
+			txn.received_amount, txn.received_unit = abs(proceeds), currency
+		else:
+			txn.amount, txn.unit = abs(proceeds), currency
+			txn.received_amount, txn.received_unit = abs(quantity), symbol
+
+		# cash.description = f'{"bought" if amt < 0 else "sold"} {quantity} share/s of {symbol}'
+
+		cost = self.to_number(item['Comm/Fee'])
+		if cost != 0:
+			fee = Transaction()
+
+			fee.amount = abs(cost)
+			fee.unit = currency
+
+			fee.sender = self.account
+			fee.receiver = 'institution'
+
+			fee.date = txn.date
+			fee.description = 'commission/fee'
+
+			links.setdefault('fee', []).append([txn, fee])
+
+			return [txn, fee]
+		return txn
@@ -0,0 +1,182 @@
+from ..imports import *
+
+from ..misc import format_regular_amount
+from ..datacls import Account, Transaction, Tagged, Linkable, Reportable
+from .base import MCC_Parser
+
+
+
+@fig.component('paypal')
+class Paypal(MCC_Parser):
+	@staticmethod
+	def classify(item: dict) -> Optional[str]:
+		'''Kind of record an item is parsed into (None if it is skipped).'''
+		action = item['Type'].lower()
+		if (action in {'general authorization', 'payment hold'}
+				or item['Status'].lower() != 'completed' or item['Link'] == 'X'):
+			return
+		if action in {'payment release', 'payment hold'}:
+			return 'hold'
+		if action == 'general currency conversion':
+			return 'conversion'
+		return 'payment'
+
+
+	def prepare(self, account: Account, items: Iterable[dict]):
+		'''
+		Collects both parts of every currency conversion and the number of transactions sharing each "Link", so that
+		every item can be parsed on its own (e.g. when the file is streamed in chunks).
+		'''
+		self.conversions: dict[str, list[dict]] = {}
+		self.sizes = Counter()
+		self.groups: dict[str, list[Transaction]] = {}
+
+		def collect(items: Iterable[dict]):
+			for item in items:
+				kind = self.classify(item)
+				if kind == 'conversion':
+					assert item['Link'] is not None
+					parts = self.conversions.setdefault(item['Link'], [])
+					parts.append(item)
+					# each pair of parts is parsed into a single transaction
+					if len(parts) == 2:
+						self.sizes[item['Link']] += 1
+				elif kind == 'payment' and item['Link'] is not None:
+					self.sizes[item['Link']] += 1
+				yield item
+
+		concepts = super().prepare(account, collect(items))
+		incomplete = [link for link, parts in self.conversions.items() if len(parts) != 2]
+		assert not len(incomplete), f'incomplete {len(incomplete)}'
+		return concepts
+
+
+	def add_to_group(self, txn: Transaction, link: str, links: dict[str, list[list[Linkable]]]):
+		'''Links all transactions with the same "Link" as soon as the last of them is parsed.'''
+		if self.sizes[link] < 2:
+			return
+		group = self.groups.setdefault(link, [])
+		group.append(txn)
+		if len(group) == self.sizes[link]:
+			links.setdefault(None, []).append(self.groups.pop(link))
+
+
+	def parse_conversion(self, part1, part2):
+		assert part1['Link'] == part2['Link']
+
+		conversion = Transaction(sender=self.account, receiver=self.account)
+
+		assert part1['Date'] == part2['Date']
+		conversion.date = datetime.strptime(part1['Date'], '%m/%d/%Y').date()
+
+		amt1 = format_regular_amount(part1['Gross'])
+		amt2 = format_regular_amount(part2['Gross'])
+
+		assert amt1 != 0
+		assert (amt1 > 0) != (amt2 > 0), f'{amt1} {amt2}'
+
+		frm, to = (part1, part2) if amt1 < 0 else (part2, part1)
+		famt, tamt = (abs(amt1), abs(amt2)) if amt1 < 0 else (abs(amt2), abs(amt1))
+
+		conversion.amount = famt
+		conversion.unit = frm['Currency']
+
+		conversion.received_amount = tamt
+		conversion.received_unit = to['Currency']
+
+		assert part1['Tags'] is None and part2['Tags'] is None
+
+		return conversion
+
+
+	def parse_hold(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		action = item['Type'].lower()
+
+		amt = format_regular_amount(item['Gross'])
+
+		assert ('release' in action and amt > 0) or ('hold' in action and amt < 0), f'{action} {amt}'
+
+		txn = self.create_transaction(self.account,
+									  sender=self.account if amt < 0 else 'institution',
+									  receiver='institution' if amt < 0 else self.account)
+
+		txn.date = datetime.strptime(item['Date'], '%m/%d/%Y').date()
+
+		txn.amount = abs(amt)
+		txn.unit = item['Currency']
+
+		txn.description = item['Type']
+		txn.location = item['Location']
+
+		return txn
+
+
+	def parse(self, item: dict, tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+
+		kind = self.classify(item)
+		if kind is None:
+			return
+		if kind == 'hold':
+			return self.parse_hold(item, tags, links)
+		if kind == 'conversion':
+			part1, part2 = self.conversions[item['Link']]
+			# the conversion is parsed with its second part
+			if item != part2:
+				return
+			conversion = self.parse_conversion(part1, part2)
+			self.add_to_group(conversion, item['Link'], links)
+			return conversion
+
+		assert item['Sender'] is not None or item['Receiver'] is not None, f'{item}'
+
+		currency = item['Currency'].strip()
+
+		amt = format_regular_amount(item['Gross'])
+
+		txn = self.create_transaction(self.account, sender=item['Sender'], receiver=item['Receiver'])
+
+		assert (txn.sender == self.account) != (txn.receiver == self.account), f'{txn.sender} {txn.receiver}'
+
+		txn.date = datetime.strptime(item['Date'], '%m/%d/%Y').date()
+
+		txn.amount = abs(amt)
+		txn.unit = currency
+
+		txn.description = item['Name']
+		txn.location = item['Location']
+
+		if item['Tags'] is not None:
+			for tag in item['Tags'].split(';') if ';' in item['Tags'] else item['Tags'].split(','):
+				tags.setdefault(tag, []).append(txn)
+
+		if item['Link'] is not None:
+			self.add_to_group(txn, item['Link'], links)
+
+		fee = format_regular_amount(item['Fee'])
+
+		if fee != 0:
+			assert fee < 0
+
+			fee_txn = Transaction()
+
+			fee_txn.sender = self.account
+			fee_txn.receiver = 'institution'
+
+			fee_txn.date = txn.date
+
+			fee_txn.amount = abs(fee)
+			fee_txn.unit = currency
+
+			fee_txn.description = f'fee for {txn.description}'
+			fee_txn.location = txn.location
+
+			links.setdefault('fee', []).append([txn, fee_txn])
+
+			return [txn, fee_txn]
+
+		return txn
+
+
+	def finish(self, records: list[Reportable], tags: dict[str, list[Tagged]], links: dict[str, list[list[Linkable]]]):
+		assert not len(self.groups), f'incomplete {len(self.groups)} groups'
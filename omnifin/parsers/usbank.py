@@ -0,0 +1,15 @@
+from ..imports import *
+
+from .base import TableParser
+
+
+
+@fig.component('usbank')
+class USBank(TableParser):
+	date_key = 'Date'
+	date_format = '%Y-%m-%d'
+	amount_key = 'Amount'
+	unit = 'usd'
+	description_key = 'Name'
+	reference_key = 'Reference'
+	out_asset_key = 'Notes'
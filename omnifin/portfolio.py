@@ -0,0 +1,413 @@
+from __future__ import annotations
+from collections import deque
+
+from .imports import *
+
+from .datacls import Record
+from .money import DEFAULT_SCALE
+
+
+# quantities smaller than this are considered zero (to absorb floating point residue of fractional shares)
+EPSILON = 1e-9
+
+
+# trades are conversions within one account between a stock and anything else (e.g. cash), along with the total
+# of any fees linked to them
+TRADES = '''
+WITH fees AS (
+	SELECT trade, SUM(fee_minor) AS fee_minor FROM (
+		SELECT links.id1 AS trade, fees.amount_minor AS fee_minor
+		FROM transaction_links AS links JOIN transactions AS fees ON fees.id = links.id2
+		WHERE links.link_type = 'fee' AND fees.sender != fees.receiver
+		UNION ALL
+		SELECT links.id2 AS trade, fees.amount_minor AS fee_minor
+		FROM transaction_links AS links JOIN transactions AS fees ON fees.id = links.id1
+		WHERE links.link_type = 'fee' AND fees.sender != fees.receiver
+	) GROUP BY trade
+)
+SELECT t.id AS id, date(t.dateof) AS day, t.sender AS account, t.unit AS unit, t.amount AS amount,
+	t.amount_minor AS amount_minor, sent.asset_type = 'stock' AS sold, t.received_unit AS received_unit,
+	t.received_amount AS received_amount, t.received_minor AS received_minor, COALESCE(fees.fee_minor, 0) AS fee
+FROM transactions AS t
+JOIN assets AS sent ON sent.id = t.unit
+JOIN assets AS received ON received.id = t.received_unit
+LEFT JOIN fees ON fees.trade = t.id
+WHERE t.sender = t.receiver AND (sent.asset_type = 'stock') != (received.asset_type = 'stock')
+'''
+
+
+
+@dataclass
+class Trade:
+	'''Change of the position of an account in an asset (negative quantities are sales).'''
+	ID: int
+	date: str
+	account: int
+	asset: int
+	quantity: float
+	currency: int
+	value: int # minor units of the currency paid (for purchases) or received (for sales) including fees
+
+
+
+@dataclass
+class Lot:
+	'''Open part of a trade (negative quantities are short positions).'''
+	ID: int
+	date: str
+	quantity: float
+	cost: int # minor units of the currency paid (for long lots) or received (for short lots)
+
+
+
+@dataclass
+class Match:
+	'''Part of an open lot closed by a later trade.'''
+	lot: Lot
+	trade: Trade
+	quantity: float
+	basis: int # share of the cost of the lot
+	value: int # share of the value of the closing trade
+
+
+	@property
+	def gain(self) -> int:
+		'''Realized gain in minor units (closing a short lot gains if it is bought back for less).'''
+		return self.value - self.basis if self.lot.quantity > 0 else self.basis - self.value
+
+
+
+def load_trades(conn: sqlite3.Connection = None, *, assets: Iterable[int] = None) -> Iterator[Trade]:
+	'''Streams all trades (optionally only of some assets) in chronological order.'''
+	if conn is None:
+		conn = Record._conn
+	query, params = TRADES, []
+	if assets is not None:
+		params = list(assets)
+		marks = ', '.join('?' * len(params))
+		query += f' AND (t.unit IN ({marks}) OR t.received_unit IN ({marks}))'
+		params = params + params
+	query += ' ORDER BY t.dateof, t.id'
+
+	cursor = conn.execute(query, params)
+	for ID, day, account, unit, amount, amount_minor, sold, received_unit, received, received_minor, fee \
+			in cursor:
+		if sold:
+			yield Trade(ID, day, account, unit, -amount, received_unit, received_minor - fee)
+		else:
+			yield Trade(ID, day, account, received_unit, received, unit, amount_minor + fee)
+
+
+
+class Positions:
+	'''
+	Open lots of every (account, asset) pair, where later trades close the oldest open lots first (FIFO).
+	'''
+	def __init__(self):
+		self.lots: dict[tuple[int, int], deque[Lot]] = {}
+		self.currencies: dict[tuple[int, int], int] = {}
+
+
+	def _next_lot(self, lots: deque[Lot], trade: Trade) -> Lot:
+		'''Open lot to be closed (next) by the trade.'''
+		return lots[0]
+
+
+	def _close_lot(self, lots: deque[Lot], lot: Lot):
+		lots.popleft()
+
+
+	def apply(self, trade: Trade) -> list[Match]:
+		'''Updates the position with the trade and returns the parts of the lots that were closed by it.'''
+		key = trade.account, trade.asset
+		lots = self.lots.setdefault(key, deque())
+		currency = self.currencies.setdefault(key, trade.currency)
+		if currency != trade.currency:
+			raise ValueError(f'Trade {trade.ID} is in asset {trade.currency}, but the position of account '
+							 f'{trade.account} in asset {trade.asset} is in {currency}')
+
+		matches = []
+		remaining, value = trade.quantity, trade.value
+		while len(lots) and abs(remaining) > EPSILON and (lots[0].quantity > 0) != (remaining > 0):
+			lot = self._next_lot(lots, trade)
+			quantity = min(abs(lot.quantity), abs(remaining))
+			# the last part takes the rest, so the costs always add up exactly
+			basis = lot.cost if abs(lot.quantity) - quantity < EPSILON \
+				else round(lot.cost * quantity / abs(lot.quantity))
+			share = value if abs(remaining) - quantity < EPSILON else round(value * quantity / abs(remaining))
+			sign = 1 if lot.quantity > 0 else -1
+			matches.append(Match(Lot(lot.ID, lot.date, sign * quantity, basis), trade, quantity, basis, share))
+
+			lot.quantity -= sign * quantity
+			lot.cost -= basis
+			if abs(lot.quantity) < EPSILON:
+				self._close_lot(lots, lot)
+			remaining += sign * quantity
+			value -= share
+
+		if abs(remaining) > EPSILON:
+			lots.append(Lot(trade.ID, trade.date, remaining, value))
+		return matches
+
+
+	def quantity(self, account: int, asset: int) -> float:
+		return sum(lot.quantity for lot in self.lots.get((account, asset), ()))
+
+
+	def cost(self, account: int, asset: int) -> int:
+		return sum(lot.cost for lot in self.lots.get((account, asset), ()))
+
+
+	def state(self, account: int, asset: int) -> tuple[float, int, Optional[int], int]:
+		'''Quantity, cost basis, currency and number of open lots of a position.'''
+		key = account, asset
+		return (self.quantity(account, asset), self.cost(account, asset), self.currencies.get(key),
+				len(self.lots.get(key, ())))
+
+
+
+class LIFOPositions(Positions):
+	'''Positions where trades close the most recently opened lots first (LIFO).'''
+	def _next_lot(self, lots: deque[Lot], trade: Trade) -> Lot:
+		return lots[-1]
+
+
+	def _close_lot(self, lots: deque[Lot], lot: Lot):
+		lots.pop()
+
+
+
+class SpecificPositions(Positions):
+	'''
+	Positions where trades close specifically identified lots (`selections` maps the ID of a closing trade to the IDs
+	of the trades which opened the lots, in the order they should be closed). Anything else is closed FIFO.
+	'''
+	def __init__(self, selections: Mapping[int, Sequence[int]] = None):
+		super().__init__()
+		self.selections = {} if selections is None else selections
+
+
+	def _next_lot(self, lots: deque[Lot], trade: Trade) -> Lot:
+		for ID in self.selections.get(trade.ID, ()):
+			for lot in lots:
+				if lot.ID == ID:
+					return lot
+		return lots[0]
+
+
+	def _close_lot(self, lots: deque[Lot], lot: Lot):
+		lots.remove(lot)
+
+
+
+def load_selections(conn: sqlite3.Connection = None) -> dict[int, list[int]]:
+	'''
+	Specifically identified lots from the transaction links with the category "lot", which link a closing trade to
+	the trade that opened the lot (the later of the two is the closing one).
+	'''
+	if conn is None:
+		conn = Record._conn
+	selections = {}
+	for closing, opening in conn.execute('''
+	SELECT CASE WHEN first.dateof > second.dateof OR (first.dateof = second.dateof AND first.id > second.id)
+			THEN first.id ELSE second.id END AS closing,
+		CASE WHEN first.dateof > second.dateof OR (first.dateof = second.dateof AND first.id > second.id)
+			THEN second.id ELSE first.id END AS opening
+	FROM transaction_links AS links
+	JOIN transactions AS first ON first.id = links.id1
+	JOIN transactions AS second ON second.id = links.id2
+	WHERE links.link_type = 'lot'
+	ORDER BY closing, opening
+	'''):
+		selections.setdefault(closing, []).append(opening)
+	return selections
+
+
+
+# lot matching method -> positions type
+METHODS = {
+	'fifo': Positions,
+	'lifo': LIFOPositions,
+	'specific': SpecificPositions,
+}
+
+
+
+def create_positions(method: str = 'fifo', conn: sqlite3.Connection = None) -> Positions:
+	if method not in METHODS:
+		raise ValueError(f'Unknown lot matching method: {method!r} (expected one of {list(METHODS)})')
+	if method == 'specific':
+		return SpecificPositions(load_selections(conn))
+	return METHODS[method]()
+
+
+
+def update_positions(conn: sqlite3.Connection = None, *, assets: Iterable[int] = None,
+					 method: str = 'fifo') -> Positions:
+	'''
+	Replays all trades (optionally only of some assets) in a single pass and stores the resulting position of each
+	account after every day with trades in the `positions` table.
+	'''
+	if conn is None:
+		conn = Record._conn
+	if assets is None:
+		conn.execute('DELETE FROM positions')
+	else:
+		assets = list(assets)
+		conn.execute(f'DELETE FROM positions WHERE asset IN ({", ".join("?" * len(assets))})', assets)
+
+	positions = create_positions(method, conn)
+	snapshots = {}
+	for trade in load_trades(conn, assets=assets):
+		positions.apply(trade)
+		snapshots[trade.account, trade.asset, trade.date] = positions.state(trade.account, trade.asset)
+
+	conn.executemany('INSERT INTO positions (account, asset, day, quantity, cost_minor, currency, lots) '
+					 'VALUES (?, ?, ?, ?, ?, ?, ?)', [(*key, *state) for key, state in snapshots.items()])
+	return positions
+
+
+
+def holdings(date: datelike = None, *, conn: sqlite3.Connection = None, exact: bool = False,
+			 include_closed: bool = False) -> pd.DataFrame:
+	'''
+	Positions of all accounts at the end of `date` (or the latest ones) from the snapshots in the `positions` table
+	(see `update_positions`). Costs are converted from minor units unless `exact` is set.
+	'''
+	if conn is None:
+		conn = Record._conn
+	day = '9999-12-31' if date is None else date.strftime('%Y-%m-%d')
+	frame = pd.read_sql_query(f'''
+	SELECT accounts.account_name AS account, assets.asset_name AS asset, positions.quantity AS quantity,
+		positions.cost_minor AS cost, currencies.asset_name AS currency, currencies.scale AS _scale,
+		positions.lots AS lots, positions.day AS updated
+	FROM positions
+	JOIN accounts ON accounts.id = positions.account
+	JOIN assets ON assets.id = positions.asset
+	LEFT JOIN assets AS currencies ON currencies.id = positions.currency
+	WHERE positions.day = (
+		SELECT MAX(latest.day) FROM positions AS latest
+		WHERE latest.account = positions.account AND latest.asset = positions.asset AND latest.day <= :day)
+	{"" if include_closed else f"AND ABS(positions.quantity) > {EPSILON}"}
+	ORDER BY account, asset
+	''', conn, params={'day': day})
+
+	scales = frame.pop('_scale').fillna(DEFAULT_SCALE).astype(int)
+	if not exact:
+		frame['cost'] = frame['cost'] / 10.0 ** scales
+	return frame
+
+
+
+# summary of the trades of each asset (so any new, removed or edited trade changes it)
+TRADE_SIGNATURES = f'''
+SELECT CASE WHEN trades.sold THEN trades.unit ELSE trades.received_unit END AS asset,
+	COUNT(*) || ':' || SUM(trades.id) || ':' || TOTAL(julianday(trades.day)) || ':'
+	|| TOTAL(trades.amount_minor) || ':' || TOTAL(trades.received_minor) || ':' || TOTAL(trades.fee) || ':'
+	|| TOTAL(trades.amount) || ':' || TOTAL(trades.received_amount) AS signature
+FROM ({TRADES}) AS trades
+GROUP BY 1
+'''
+
+
+
+def update_gains(conn: sqlite3.Connection = None, *, method: str = 'fifo') -> list[int]:
+	'''
+	Updates the realized gains (stored in `realized_gains`) of all assets whose trades changed since the gains were
+	last computed with the lot matching `method`, replaying only the trades of those assets.
+
+	Returns the IDs of the updated assets.
+	'''
+	if conn is None:
+		conn = Record._conn
+	current = dict(conn.execute(TRADE_SIGNATURES).fetchall())
+	cached = dict(conn.execute('SELECT asset, signature FROM realized_gains_state WHERE method = ?',
+							   (method,)).fetchall())
+	stale = [asset for asset in set(current) | set(cached) if current.get(asset) != cached.get(asset)]
+	if method == 'specific':
+		# lot selections may have changed as well
+		stale = list(set(current) | set(cached))
+	if not len(stale):
+		return []
+
+	for asset in stale:
+		conn.execute('DELETE FROM realized_gains WHERE method = ? AND asset = ?', (method, asset))
+		conn.execute('DELETE FROM realized_gains_state WHERE method = ? AND asset = ?', (method, asset))
+
+	positions = create_positions(method, conn)
+	rows = []
+	for trade in load_trades(conn, assets=[asset for asset in stale if asset in current]):
+		for match in positions.apply(trade):
+			rows.append((method, trade.ID, match.lot.ID, trade.account, trade.asset, trade.currency,
+						 match.lot.date, trade.date, int(trade.date[:4]), match.lot.quantity, match.basis,
+						 match.value, match.gain))
+	conn.executemany('INSERT INTO realized_gains (method, trade, lot, account, asset, currency, opened, closed, '
+					 'tax_year, quantity, basis_minor, proceeds_minor, gain_minor) '
+					 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+	conn.executemany('INSERT INTO realized_gains_state (method, asset, signature) VALUES (?, ?, ?)',
+					 [(method, asset, current[asset]) for asset in stale if asset in current])
+	return stale
+
+
+
+def realized_gains(year: int = None, *, method: str = 'fifo', conn: sqlite3.Connection = None,
+				   update: bool = True, exact: bool = False) -> pd.DataFrame:
+	'''
+	Realized gains of every closed (part of a) lot (optionally only in one tax year, i.e. the year it was closed),
+	matching lots with the given `method` (any of `METHODS`). Amounts are converted from minor units unless `exact`.
+	'''
+	if conn is None:
+		conn = Record._conn
+	if update:
+		update_gains(conn, method=method)
+	frame = pd.read_sql_query(f'''
+	SELECT accounts.account_name AS account, assets.asset_name AS asset, gains.opened AS opened,
+		gains.closed AS closed, gains.quantity AS quantity, gains.basis_minor AS basis,
+		gains.proceeds_minor AS proceeds, gains.gain_minor AS gain, currencies.asset_name AS currency,
+		currencies.scale AS _scale, gains.trade AS trade, gains.lot AS lot
+	FROM realized_gains AS gains
+	JOIN accounts ON accounts.id = gains.account
+	JOIN assets ON assets.id = gains.asset
+	LEFT JOIN assets AS currencies ON currencies.id = gains.currency
+	WHERE gains.method = :method {"" if year is None else "AND gains.tax_year = :year"}
+	ORDER BY gains.closed, gains.trade, gains.opened
+	''', conn, params={'method': method, 'year': year})
+
+	scales = frame.pop('_scale').fillna(DEFAULT_SCALE).astype(int)
+	if not exact:
+		for key in ['basis', 'proceeds', 'gain']:
+			frame[key] = frame[key] / 10.0 ** scales
+	return frame
+
+
+
+@fig.script('gains')
+def gains_script(cfg: fig.Configuration):
+	conn = cfg.pull('conn')
+
+	method = cfg.pull('method', 'fifo')
+	year = cfg.pull('year', None)
+
+	updated = update_gains(conn, method=method)
+	conn.commit()
+	cfg.print(f'Updated the realized gains of {len(updated)} assets.')
+
+	frame = realized_gains(None if year is None else int(year), method=method, conn=conn, update=False)
+	summary = frame.groupby(['account', 'asset', 'currency'], as_index=False)[['proceeds', 'basis', 'gain']].sum()
+	cfg.print(tabulate(summary, headers='keys', showindex=False, floatfmt='.2f'))
+	return frame
+
+
+
+@fig.script('positions')
+def positions_script(cfg: fig.Configuration):
+	conn = cfg.pull('conn')
+
+	if cfg.pull('update', True):
+		update_positions(conn)
+		conn.commit()
+
+	date = cfg.pull('date', None)
+	frame = holdings(None if date is None else parser.parse(date), conn=conn)
+	cfg.print(tabulate(frame, headers='keys', showindex=False, floatfmt='.2f'))
+	return frame
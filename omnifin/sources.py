@@ -0,0 +1,69 @@
+from .imports import *
+
+from .misc import get_path
+from .parsers import load_parser
+from .caching import file_digest, parser_digest
+from .datacls import Record, Report
+
+
+
+@dataclass
+class Source:
+	'''One import of a file: which file, in what state and with which parser, and the report it was written under.'''
+	report: int
+	path: str
+	account: Optional[str]
+	content_hash: str
+	parser_hash: str
+
+
+
+def source_path(path: Path | str) -> str:
+	return str(Path(path).resolve())
+
+
+
+def source_state(cfg: fig.Configuration) -> tuple[Path, str, str]:
+	'''
+	The file that `cfg` would import (see `add_transactions`) with the hash of its contents and of its parser,
+	without parsing (or even loading) it.
+	'''
+	path = get_path(cfg, path_key='path', root_key='root')
+	cfg.push('parser._type', cfg.pull('account', None, silent=True), silent=True, overwrite=False)
+	parser = load_parser(cfg.pull('parser._type', silent=True))
+	return path, file_digest(path), parser_digest(parser, cfg.peek('parser'))
+
+
+
+def record_source(path: Path | str, account: Optional[str], content_hash: str, parser_hash: str,
+				  report: Report | int, *, conn: sqlite3.Connection = None):
+	'''
+	Records an import of a file for an account under the report it was written with. Earlier imports of the same
+	file keep their rows, since the records they wrote stay in the database (and are undone with the new ones).
+	'''
+	if conn is None:
+		conn = Record._conn
+	path = source_path(path)
+	conn.execute('INSERT OR REPLACE INTO sources (report, path, account, content_hash, parser_hash) '
+				 'VALUES (?, ?, ?, ?, ?)', (report.ID if isinstance(report, Report) else report,
+											path, account, content_hash, parser_hash))
+
+
+
+def find_sources(path: Path | str, account: Optional[str], *, conn: sqlite3.Connection = None) -> list[Source]:
+	'''All recorded imports of the file for the account, oldest first (see `record_source`).'''
+	if conn is None:
+		conn = Record._conn
+	rows = conn.execute('SELECT report, path, account, content_hash, parser_hash FROM sources '
+						'WHERE path = ? AND account IS ? ORDER BY report', (source_path(path), account)).fetchall()
+	return [Source(*row) for row in rows]
+
+
+
+def is_current(sources: list[Source], content_hash: str, parser_hash: str) -> bool:
+	'''
+	Whether the file was imported with the same contents and parser by a single import. If several imports
+	contributed to it (e.g. as the file grew), it has to be imported again, since rows that were removed from the file
+	in the meantime would otherwise remain.
+	'''
+	return len(sources) == 1 and (sources[0].content_hash, sources[0].parser_hash) == (content_hash, parser_hash)
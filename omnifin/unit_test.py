@@ -0,0 +1,417 @@
+import sys
+import pytest
+
+from .imports import *
+
+from .building import init_db
+from .datacls import Record, Report, Asset, Account, Tag, Transaction, Verification
+
+
+
+@pytest.fixture
+def conn():
+	'''Fresh in-memory database with a few assets and accounts.'''
+	conn = sqlite3.connect(':memory:')
+	init_db(conn)
+	Record.set_conn(conn)
+	report = Report(category='test')
+	report.write()
+	for name, category in [('usd', 'currency'), ('eur', 'currency'), ('aapl', 'stock')]:
+		Asset(name, category=category).write(report)
+	for name, category, owner in [('checking', 'bank', 'internal'), ('savings', 'bank', 'internal'),
+								  ('broker', 'broker', 'internal'), ('shop', 'expense', 'external'),
+								  ('employer', 'income', 'external')]:
+		Account(name, category=category, owner=owner).write(report)
+	conn.commit()
+	yield conn
+	Record.set_conn(None)
+	conn.close()
+
+
+
+def make_txn(date: str, sender: str, receiver: str, amount: float, unit: str = 'usd', **kwargs) -> Transaction:
+	return Transaction(date=datetime.strptime(date, '%Y-%m-%d'), sender=Account.find(sender),
+					   receiver=Account.find(receiver), amount=amount, unit=Asset.find(unit), **kwargs)
+
+
+
+def count_updates(conn: sqlite3.Connection, fn: Callable, *args, **kwargs):
+	'''Calls `fn` and returns its output and the number of UPDATE statements it executed.'''
+	statements = []
+	conn.set_trace_callback(statements.append)
+	try:
+		out = fn(*args, **kwargs)
+	finally:
+		conn.set_trace_callback(None)
+	return out, sum(statement.lstrip().upper().startswith('UPDATE') for statement in statements)
+
+
+
+def test_update_writes_only_changes(conn):
+	from .validation import apply_updates
+	report = Report(category='test')
+	report.write()
+	txns = [make_txn('2024-01-0' + str(i), 'checking', 'shop', 10. * i, description=f'shop {i}')
+			for i in range(1, 4)]
+	Transaction.write_all(report, txns)
+
+	rows = [{'id': str(txn.ID), 'description': txn.description, 'receiver': 'shop'} for txn in txns]
+	changed, updates = count_updates(conn, apply_updates, report, rows)
+	assert changed == [] and updates == 0
+
+	rows[1]['description'] = 'groceries'
+	changed, updates = count_updates(conn, apply_updates, report, rows)
+	assert [txn.ID for txn in changed] == [txns[1].ID] and updates == 1
+	assert changed[0].last_changes == {'description': ('shop 2', 'groceries')}
+	assert conn.execute('SELECT description FROM transactions WHERE id = ?', (txns[1].ID,)).fetchone() == ('groceries',)
+	assert conn.execute('SELECT property, previous_value, new_value FROM transaction_revisions').fetchall() \
+		   == [('description', 'shop 2', 'groceries')]
+
+	changed, updates = count_updates(conn, apply_updates, report, rows)
+	assert changed == [] and updates == 0
+
+
+
+def test_to_minor_rounding():
+	from decimal import Decimal
+	from .money import to_minor, from_minor, Money
+	assert to_minor(0.1) == 10 and to_minor(0.29) == 29 and to_minor(1.005) == 101
+	assert to_minor(2.675) == 268 and to_minor(-2.675) == -268 and to_minor(-0.004) == 0
+	assert to_minor('12.345') == 1235 and to_minor(Decimal('0.125'), 2) == 13 and to_minor(None) is None
+	assert to_minor(0.123456789, 8) == 12345679 and to_minor(1234, 0) == 1234
+	assert to_minor(np.int64(5)) == 500 and to_minor(np.float32(1.5)) == 150 and to_minor(np.float64(0.1)) == 10
+	assert from_minor(to_minor(19.99)) == Decimal('19.99')
+	assert sum([Money.from_amount(0.1, 'usd')] * 3) == Money(30, 'usd')
+
+
+
+def test_rates_follow_conversions(conn):
+	from .fx import harvest_rates, load_rates, convert
+	from .ops import undo_report
+	reports = [Report(category='test') for _ in range(2)]
+	for report in reports:
+		report.write()
+	Transaction.write_all(reports[0], [make_txn('2024-01-02', 'checking', 'checking', 100., 'usd',
+												received_amount=90., received_unit=Asset.find('eur'))])
+	Transaction.write_all(reports[1], [make_txn('2024-01-02', 'checking', 'checking', 300., 'usd',
+												received_amount=282., received_unit=Asset.find('eur')),
+									   make_txn('2024-01-03', 'checking', 'broker', 100., 'usd',
+												received_amount=0.5, received_unit=Asset.find('aapl'))])
+	assert harvest_rates(conn) == 1
+	assert load_rates(conn, inverse=False)['rate'].tolist() == [0.93]
+
+	frame = pd.DataFrame({'date': ['2024-01-01', '2024-01-05', '2024-01-05'], 'unit': ['USD', 'EUR', 'usd'],
+						  'amount': [1., 93., 2.]})
+	assert convert(frame, 'USD')['amount_USD'].tolist() == pytest.approx([1., 100., 2.])
+	assert np.isnan(convert(frame, 'eur')['amount_eur'][0])
+
+	# stale rates are replaced when undoing a report (and when harvesting again)
+	undo_report(conn, reports[1])
+	assert load_rates(conn, inverse=False)['rate'].tolist() == [0.9]
+	undo_report(conn, reports[0])
+	assert not len(load_rates(conn))
+	assert harvest_rates(conn) == 0
+
+
+
+def test_conditions_sql_match_masks(conn):
+	from .validation import (Compare, Contains, IsIn, IsNull, Not, JOINS, parse_condition, load_frame)
+	report = Report(category='test')
+	report.write()
+	Tag(name='food', category='test').write(report)
+	txns = [make_txn('2024-01-05', 'checking', 'shop', 12.5, description='Grocery STORE', location='Berlin'),
+			make_txn('2024-02-01', 'employer', 'checking', 1000., description='salary'),
+			make_txn('2024-02-10', 'checking', 'savings', 250., 'eur'),
+			make_txn('2024-03-01', 'savings', 'broker', 99.99, description='Ärger store', reference='x1')]
+	Transaction.write_all(report, txns)
+	txns[0].add_tags(report, 'food')
+
+	conditions = [
+		Compare('amount', '>', 100), Compare('date', '<', '2024-02-05'), Compare('unit', '==', 'usd'),
+		Compare('description', '!=', 'salary'), Contains('description', 'store'), IsNull('location'),
+		IsIn('sender', ['checking', 'savings']), Contains('tags', 'food'), Not(Contains('description', 'store')),
+		Not(Compare('reference', '==', 'x1')),
+		parse_condition({'any': [{'receiver': 'shop'}, {'amount': {'<=': 99.99, '>': 50}}], 'location': None}),
+		parse_condition({'not': {'sender': ['employer'], 'description': {'contains': 'SAL'}}}),
+	]
+	frame = load_frame(conn)
+	for condition in conditions:
+		clause, params = condition.sql()
+		selected = {ID for ID, in conn.execute(f'SELECT t.id FROM transactions AS t {JOINS} WHERE {clause}', params)}
+		masked = set(frame['id'][condition.mask(frame)].tolist())
+		assert selected == masked, str(condition)
+		assert load_frame(conn, where=condition)['id'].tolist() == sorted(selected), str(condition)
+
+
+
+def test_evaluate_rules_sees_uncommitted(tmp_path):
+	from .validation import ConditionRule, Rule, evaluate_rules
+
+	class Large(Rule):
+		def judge(self, txn):
+			if txn.amount > 100 and txn.sender.name == 'checking':
+				return 'large', 'more than 100'
+
+	conn = sqlite3.connect(tmp_path / 'test.db')
+	init_db(conn)
+	Record.set_conn(conn)
+	try:
+		conn.commit()
+		# the workers wouldn't find any of these
+		report = Report(category='test')
+		report.write()
+		Asset('usd', category='currency').write(report)
+		for name in ['checking', 'shop']:
+			Account(name, category='bank', owner='internal').write(report)
+		Transaction.write_all(report, [make_txn(f'2024-01-{day:02}', 'checking', 'shop', 50. * day)
+									   for day in range(1, 5)])
+		assert conn.in_transaction
+		rules = [ConditionRule({'amount': {'<': 100}}, category='small'), Large()]
+		verdicts = evaluate_rules(rules, conn, workers=2, chunksize=1)
+		assert sorted((cat, amount) for ID, cat, _ in verdicts for amount, in
+					  conn.execute('SELECT amount FROM transactions WHERE id = ?', (ID,))) \
+			   == [('large', 150.), ('large', 200.), ('small', 50.)]
+	finally:
+		Record.set_conn(None)
+		conn.close()
+
+
+
+def test_merchant_locations(conn):
+	from .merchants import Merchant, MerchantCache
+	report = Report(category='test')
+	report.write()
+	cache = MerchantCache(conn, report=report)
+	cache.store('PIZZA PLACE  WASHINGTON DC', Merchant('Pizza Place', 'Washington, D.C.', 'District of Columbia'))
+	assert cache.lookup('PIZZA PLACE WASHINGTON DC').location == 'Washington D.C.,District of Columbia,'
+	assert Merchant.from_location('Berlin,,').location == 'Berlin,,'
+
+	txns = [make_txn('2024-01-05', 'checking', 'shop', 12.5, description='PIZZA PLACE WASHINGTON DC'),
+			make_txn('2024-01-06', 'checking', 'shop', 30., description='Rent', location='Berlin')]
+	for txn in txns:
+		cache.apply(txn)
+	assert txns[0].location == 'Washington D.C.,District of Columbia,'
+	# only imports (with an account) remember the locations in their statements
+	assert MerchantCache(conn).lookup('Rent') is None
+
+	checking = MerchantCache(conn, report=report, account=Account.find('checking'))
+	checking.apply(txns[1])
+	assert MerchantCache(conn, account=Account.find('checking')).lookup('Rent').location == 'Berlin'
+	assert MerchantCache(conn, account=Account.find('savings')).lookup('Rent') is None
+
+
+
+def test_extract_merchants(conn):
+	from .extraction import ExtractionBackend, StubBackend, extract_merchants
+	from .merchants import Merchant, MerchantCache
+
+	class Counting(StubBackend):
+		def __init__(self):
+			super().__init__()
+			self.asked = []
+
+		def complete(self, prompt, descriptors):
+			self.asked.extend(descriptors)
+			return super().complete(prompt, descriptors)
+
+	report = Report(category='test')
+	report.write()
+	cache = MerchantCache(conn, report=report)
+	cache.store('KNOWN SHOP SEATTLE WA', Merchant('Known Shop'))
+	backend = Counting()
+	descriptors = ['QFC #5860 REDMOND WA', 'QFC #5860  REDMOND WA', 'WWW.1AND1.COM CHESTERBROOK PA',
+				   'KNOWN SHOP SEATTLE WA', 'LATE FEE', '  ']
+	results, pending = extract_merchants(descriptors, backend, cache, batch_size=2, concurrency=2)
+	assert sorted(backend.asked) == ['LATE FEE', 'QFC #5860 REDMOND WA', 'WWW.1AND1.COM CHESTERBROOK PA']
+	assert pending == [] and set(results) == set(backend.asked)
+	assert results['QFC #5860 REDMOND WA'] == Merchant('QFC #5860', 'Redmond', 'WA', online=False)
+	assert results['WWW.1AND1.COM CHESTERBROOK PA'].online
+
+	# resolved descriptors are stored, so they are never sent again
+	fresh = MerchantCache(conn)
+	assert fresh.lookup('QFC #5860 REDMOND WA').location == 'Redmond,WA,'
+	assert fresh.lookup('WWW.1AND1.COM CHESTERBROOK PA').location == 'Chesterbrook,PA,online'
+	backend.asked.clear()
+	assert extract_merchants(descriptors, backend, fresh) == ({}, []) and backend.asked == []
+
+	response = ('"QFC #5860 REDMOND WA","5411","QFC #5860","Redmond","Washington","inperson"\n'
+				'"NOT ASKED","5411","x","","",""\n'
+				'"Netflix 1 8445052993 CA","4899","Netflix","","California","online"')
+	parsed = ExtractionBackend.parse_response(response, ['QFC #5860  REDMOND WA', 'Netflix 1 8445052993 CA'])
+	assert parsed == {'QFC #5860  REDMOND WA': Merchant('QFC #5860', 'Redmond', 'Washington', mcc='5411', online=False),
+					  'Netflix 1 8445052993 CA': Merchant('Netflix', None, 'California', mcc='4899', online=True)}
+	cache.store('Netflix 1 8445052993 CA', parsed['Netflix 1 8445052993 CA'])
+	assert MerchantCache(conn).lookup('Netflix 1 8445052993 CA') == parsed['Netflix 1 8445052993 CA']
+
+
+
+def test_parser_digest_covers_helpers(monkeypatch):
+	from . import caching
+	from .parsers import load_parser
+	parser = load_parser('boa')
+	assert {'omnifin.misc', 'omnifin.merchants', 'omnifin.datacls'} \
+		   <= set(caching._used_modules(sys.modules['omnifin.parsers.base']))
+	digest = caching.parser_digest(parser)
+	assert caching.parser_digest(parser) == digest
+	monkeypatch.setattr(caching, 'CACHE_VERSION', caching.CACHE_VERSION + 1)
+	assert caching.parser_digest(parser) != digest
+
+
+
+def test_fingerprints_skip_reimports(conn):
+	def statement():
+		# two identical coffees on the same day are separate transactions
+		return [make_txn('2024-01-05', 'checking', 'shop', 3.5, description='coffee'),
+				make_txn('2024-01-05', 'checking', 'shop', 3.5, description='coffee'),
+				make_txn('2024-01-06', 'checking', 'shop', 20., reference='A1'),
+				make_txn('2024-01-06', 'checking', 'shop', 20., reference='A2')]
+
+	first, second = Report(category='test'), Report(category='test')
+	first.write()
+	second.write()
+	assert len(Transaction.write_all(first, statement())) == 4
+	assert Transaction.write_all(second, statement()) == []
+
+	# an overlapping export (written in two batches) only adds the new rows
+	seen = Counter()
+	overlap = [*statement(), make_txn('2024-01-05', 'checking', 'shop', 3.5, description='coffee')]
+	assert Transaction.write_all(second, overlap[:3], seen=seen) == []
+	written = Transaction.write_all(second, overlap[3:], seen=seen)
+	assert [txn.date.day for txn in written] == [5] and written[0].exists
+	assert conn.execute('SELECT report, COUNT(*) FROM transactions GROUP BY report').fetchall() \
+		   == [(first.ID, 4), (second.ID, 1)]
+
+	# rows written before fingerprints existed get the same ones
+	expected = conn.execute('SELECT id, fingerprint FROM transactions ORDER BY id').fetchall()
+	conn.execute('UPDATE transactions SET fingerprint = NULL')
+	assert Transaction.fill_fingerprints() == 5
+	assert conn.execute('SELECT id, fingerprint FROM transactions ORDER BY id').fetchall() == expected
+	assert Transaction.fill_fingerprints() == 0
+
+
+
+def test_balances_follow_transactions(conn):
+	from .balances import balance_at, refresh_balances
+	from .building import rebuild_balances
+
+	report = Report(category='test')
+	report.write()
+	Transaction.write_all(report, [make_txn('2024-01-01', 'employer', 'checking', 1000.),
+								   make_txn('2024-01-03', 'checking', 'shop', 12.34),
+								   make_txn('2024-01-03', 'checking', 'savings', 100.),
+								   make_txn('2024-01-10', 'checking', 'savings', 50., received_amount=45.,
+											received_unit=Asset.find('eur'))])
+	checking = Account.find('checking')
+	assert balance_at(checking, 'usd', datetime(2023, 12, 31)) is None
+	assert balance_at(checking, 'usd', datetime(2024, 1, 2)) == 100000
+	assert balance_at(checking, 'usd', datetime(2024, 1, 5)) == 88766
+	assert balance_at('savings', 'usd', datetime(2024, 1, 5)) == 10000
+	assert balance_at(checking, 'usd', datetime(2024, 2, 1)) == 83766
+	assert balance_at('savings', 'eur', datetime(2024, 2, 1)) == 4500
+
+	# edits and deletions (even of earlier days) only mark the affected pairs for a refresh
+	conn.execute('UPDATE transactions SET amount_minor = 2000 WHERE amount_minor = 1234')
+	conn.execute('DELETE FROM transactions WHERE dateof < "2024-01-02"')
+	assert conn.execute('SELECT COUNT(*) FROM balance_updates').fetchone()[0] == 3
+	assert refresh_balances(conn) == 3
+	assert refresh_balances(conn) == 0
+	assert balance_at(checking, 'usd', datetime(2024, 1, 2)) is None
+	assert balance_at(checking, 'usd', datetime(2024, 2, 1)) == -17000
+
+	# the incrementally maintained balances match a full rebuild
+	incremental = conn.execute('SELECT * FROM balances ORDER BY account, unit, day').fetchall()
+	rebuild_balances(conn.cursor())
+	refresh_balances(conn)
+	assert conn.execute('SELECT * FROM balances ORDER BY account, unit, day').fetchall() == incremental
+
+
+
+@pytest.mark.parametrize('method, closed, remaining', [
+	('fifo', [(1, 10, 100000, 200000), (2, 5, 75000, 100000)], [(2, 5, 75000), (3, 10, 120000)]),
+	('lifo', [(3, 10, 120000, 200000), (2, 5, 75000, 100000)], [(1, 10, 100000), (2, 5, 75000)]),
+	('specific', [(2, 10, 150000, 200000), (1, 5, 50000, 100000)], [(1, 5, 50000), (3, 10, 120000)]),
+])
+def test_lot_matching(method, closed, remaining):
+	from .portfolio import Trade, SpecificPositions, METHODS
+
+	positions = SpecificPositions({4: [2]}) if method == 'specific' else METHODS[method]()
+	for trade in [Trade(1, '2024-01-01', 1, 10, 10, 1, 100000), Trade(2, '2024-02-01', 1, 10, 10, 1, 150000),
+				  Trade(3, '2024-03-01', 1, 10, 10, 1, 120000)]:
+		assert positions.apply(trade) == []
+	matches = positions.apply(Trade(4, '2024-04-01', 1, 10, -15, 1, 300000))
+	assert [(m.lot.ID, m.quantity, m.basis, m.value) for m in matches] == closed
+	assert sum(m.gain for m in matches) == 300000 - sum(basis for _, _, basis, _ in closed)
+	assert sorted((lot.ID, lot.quantity, lot.cost) for lot in positions.lots[1, 10]) == remaining
+	assert positions.state(1, 10) == (15, sum(cost for *_, cost in remaining), 1, 2)
+
+
+
+def test_lot_matching_splits():
+	from .portfolio import Trade, Positions
+
+	# partial sales split the cost so that the parts add up exactly
+	positions = Positions()
+	positions.apply(Trade(1, '2024-01-01', 1, 10, 3, 1, 100))
+	bases = [match.basis for ID in [2, 3, 4] for match in positions.apply(Trade(ID, '2024-02-01', 1, 10, -1, 1, 50))]
+	assert bases == [33, 34, 33]
+	assert positions.state(1, 10) == (0, 0, 1, 0)
+
+	# short lots gain when they are bought back for less, and a sale past the position opens one
+	positions.apply(Trade(5, '2024-03-01', 1, 10, -5, 1, 5000))
+	matches = positions.apply(Trade(6, '2024-03-02', 1, 10, 7, 1, 5600))
+	assert [(m.quantity, m.basis, m.value, m.gain) for m in matches] == [(5, 5000, 4000, 1000)]
+	assert positions.state(1, 10) == (2, 1600, 1, 1)
+
+	with pytest.raises(ValueError):
+		positions.apply(Trade(7, '2024-03-03', 1, 10, 1, 2, 800))
+
+
+
+@pytest.mark.parametrize('name, lines', [
+	('dkb', ['Buchungsdatum;Betrag (€);Notes;Location;Kundenreferenz;Sender;Receiver;Tags',
+			 '01.01.23;2.292,77;salary;Berlin,DE,;;employer;;5411,food',
+			 '02.01.23;-427,07;laden;Berlin,DE,;K1;;Shop;5411',
+			 '03.01.23;-2.731,17;;;;;savings;']),
+	('becu', ['Date,Debit,Credit,Notes,Location,Sender,Receiver,Tags',
+			  '01/01/2023,,454.94,,"Seattle,WA,",employer,,food',
+			  '01/02/2023,709.99,,note,"Seattle,WA,",,savings,"5411,food"',
+			  '01/03/2023,"1,421.27",,,,,shop,']),
+	('usbank', ['Date,Amount,Name,Notes,Location,Reference,Sender,Receiver,Tags',
+				'2023-01-01,1853.17,salary,,"Seattle,WA,",ref0,employer,,food',
+				'2023-01-02,-2331.45,shop,lunch %out-asset 2100.5 eur,"Seattle,WA,",ref1,,shop,"5411,food"',
+				'2023-01-03,"-2,546.47",shop,,,ref2,,shop,5812;x']),
+])
+def test_table_parser_matches_rows(conn, tmp_path, name, lines):
+	from .parsers import load_parser, Parser
+
+	path = tmp_path / f'{name}.csv'
+	path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+	parser = load_parser(name)()
+	items = list(parser.load_items(path))
+	parser.prepare(Account.find('checking'), items)
+
+	def parse(parse_all):
+		tags = {}
+		records = parse_all(parser, items, tags, {})
+		fields = [(type(record).__name__, record.date, record.sender.name, record.receiver.name, record.amount,
+				   str(record.unit), record.received_amount, record.received_unit, record.description,
+				   record.location, record.reference) for record in records]
+		return fields, {tag: [records.index(record) for record in tagged] for tag, tagged in tags.items()}
+
+	assert parse(type(parser).parse_all) == parse(Parser.parse_all)
+
+
+
+def test_table_parser_keeps_errors(conn, tmp_path):
+	from .parsers import load_parser, Parser
+
+	# a negative incoming amount is passed to the per-row parse, which rejects it
+	path = tmp_path / 'dkb.csv'
+	path.write_text('Buchungsdatum;Betrag (€);Notes;Location;Kundenreferenz;Sender;Receiver;Tags\n'
+					'01.01.23;-5,00;refund;;;shop;;food\n', encoding='utf-8')
+	parser = load_parser('dkb')()
+	items = list(parser.load_items(path))
+	parser.prepare(Account.find('checking'), items)
+	for parse_all in [type(parser).parse_all, Parser.parse_all]:
+		with pytest.raises(AssertionError, match='Negative amount'):
+			parse_all(parser, items, {}, {})
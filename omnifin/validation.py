@@ -1,12 +1,17 @@
+from __future__ import annotations
+import operator
+from concurrent.futures import ProcessPoolExecutor
+import os
+
 from .imports import *
 
 from .misc import get_path, load_csv_rows
 from .parsers import Parser
-from .datacls import Record, Transaction
+from .datacls import Record, Report, Transaction, Resolver
 from .writing import create_report
 
 
-class Rule:
+class Rule(fig.Configurable):
 	def select(self, txn: Transaction) -> bool:
 		return True
 
@@ -16,16 +21,381 @@ class Rule:
 	def judge(self, txn: Transaction) -> tuple[str, str] | None:
 		pass
 
+	def __getstate__(self):
+		# the config can't be pickled (rules are sent to worker processes)
+		state = self.__dict__.copy()
+		state.pop('_my_config', None)
+		return state
+
+
+
+# key -> SQL expression (over the transactions `t` and the joins below) that conditions can refer to
+COLUMNS = {
+	'id': 't.id',
+	'date': 'date(t.dateof)',
+	'sender': 'senders.account_name',
+	'receiver': 'receivers.account_name',
+	'amount': 't.amount',
+	'unit': 'units.asset_name',
+	'received_amount': 't.received_amount',
+	'received_unit': 'received_units.asset_name',
+	'description': 't.description',
+	'location': 't.location',
+	'reference': 't.reference',
+	'report': 't.report',
+	'tags': '(SELECT GROUP_CONCAT(tags.tag_name, \',\') FROM transaction_tags '
+			'JOIN tags ON tags.id = transaction_tags.tag_id WHERE transaction_tags.id = t.id)',
+}
+
+JOINS = '''
+JOIN accounts AS senders ON senders.id = t.sender
+JOIN accounts AS receivers ON receivers.id = t.receiver
+JOIN assets AS units ON units.id = t.unit
+LEFT JOIN assets AS received_units ON received_units.id = t.received_unit
+'''
+
+
+
+class Condition:
+	'''
+	Declarative predicate over transactions, which can be compiled to an SQL expression (to be evaluated by the
+	database) or a boolean mask of a frame (see `load_frame`) and combined with `&`, `|` and `~`.
+	'''
+	def sql(self) -> tuple[str, list]:
+		raise NotImplementedError
+
+	def mask(self, frame: pd.DataFrame) -> pd.Series:
+		raise NotImplementedError
+
+	def __and__(self, other: 'Condition'):
+		return AllOf(self, other)
+
+	def __or__(self, other: 'Condition'):
+		return AnyOf(self, other)
+
+	def __invert__(self):
+		return Not(self)
+
+
+
+class Compare(Condition):
+	_ops = {'==': ('=', operator.eq), '!=': ('!=', operator.ne), '<': ('<', operator.lt),
+			'<=': ('<=', operator.le), '>': ('>', operator.gt), '>=': ('>=', operator.ge)}
+
+	def __init__(self, key: str, op: str, value: Any):
+		if key not in COLUMNS:
+			raise ValueError(f'Unknown column: {key!r} (expected one of {list(COLUMNS)})')
+		if op not in self._ops:
+			raise ValueError(f'Unknown comparison: {op!r} (expected one of {list(self._ops)})')
+		self.key, self.op, self.value = key, op, value
+
+	def sql(self):
+		return f'{COLUMNS[self.key]} {self._ops[self.op][0]} ?', [self.value]
+
+	def mask(self, frame):
+		# same as in SQL, comparisons with missing values are false
+		col = frame[self.key]
+		return col.notna() & self._ops[self.op][1](col, self.value)
+
+	def __str__(self):
+		return f'{self.key} {self.op} {self.value!r}'
+
+
+
+class IsIn(Condition):
+	def __init__(self, key: str, values: Iterable[Any]):
+		if key not in COLUMNS:
+			raise ValueError(f'Unknown column: {key!r} (expected one of {list(COLUMNS)})')
+		self.key, self.values = key, list(values)
+
+	def sql(self):
+		return f'{COLUMNS[self.key]} IN ({", ".join("?" * len(self.values))})', self.values
+
+	def mask(self, frame):
+		return frame[self.key].isin(self.values)
+
+	def __str__(self):
+		return f'{self.key} in {self.values!r}'
+
+
+
+class Contains(Condition):
+	'''Case-insensitive (ASCII only, same as SQLite) substring match.'''
+	def __init__(self, key: str, text: str):
+		if key not in COLUMNS:
+			raise ValueError(f'Unknown column: {key!r} (expected one of {list(COLUMNS)})')
+		self.key, self.text = key, text
+
+	def sql(self):
+		return f'instr(lower({COLUMNS[self.key]}), lower(?)) > 0', [self.text]
+
+	def mask(self, frame):
+		lowered = frame[self.key].str.translate(_ASCII_LOWER)
+		return lowered.str.contains(self.text.translate(_ASCII_LOWER), regex=False).fillna(False).astype(bool)
+
+	def __str__(self):
+		return f'{self.key} contains {self.text!r}'
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+
+class IsNull(Condition):
+	def __init__(self, key: str):
+		if key not in COLUMNS:
+			raise ValueError(f'Unknown column: {key!r} (expected one of {list(COLUMNS)})')
+		self.key = key
 
+	def sql(self):
+		return f'{COLUMNS[self.key]} IS NULL', []
 
-def select_txns(cfg: fig.Configuration) -> list[Transaction] | None:
+	def mask(self, frame):
+		return frame[self.key].isna()
+
+	def __str__(self):
+		return f'{self.key} is missing'
+
+
+
+class AllOf(Condition):
+	def __init__(self, *conditions: Condition):
+		self.conditions = conditions
+
+	def sql(self):
+		if not len(self.conditions):
+			return '1', []
+		parts = [condition.sql() for condition in self.conditions]
+		return ' AND '.join(f'({clause})' for clause, _ in parts), [p for _, params in parts for p in params]
+
+	def mask(self, frame):
+		mask = pd.Series(True, index=frame.index)
+		for condition in self.conditions:
+			mask &= condition.mask(frame)
+		return mask
+
+	def __str__(self):
+		return ' and '.join(f'({condition})' for condition in self.conditions)
+
+
+
+class AnyOf(Condition):
+	def __init__(self, *conditions: Condition):
+		self.conditions = conditions
+
+	def sql(self):
+		if not len(self.conditions):
+			return '0', []
+		parts = [condition.sql() for condition in self.conditions]
+		return ' OR '.join(f'({clause})' for clause, _ in parts), [p for _, params in parts for p in params]
+
+	def mask(self, frame):
+		mask = pd.Series(False, index=frame.index)
+		for condition in self.conditions:
+			mask |= condition.mask(frame)
+		return mask
+
+	def __str__(self):
+		return ' or '.join(f'({condition})' for condition in self.conditions)
+
+
+
+class Not(Condition):
+	def __init__(self, condition: Condition):
+		self.condition = condition
+
+	def sql(self):
+		clause, params = self.condition.sql()
+		# conditions are never NULL in SQL (so that NOT is the complement, same as for masks)
+		return f'NOT COALESCE(({clause}), 0)', params
+
+	def mask(self, frame):
+		return ~self.condition.mask(frame)
+
+	def __str__(self):
+		return f'not ({self.condition})'
+
+
+
+def parse_condition(spec: Mapping | Condition) -> Condition:
+	'''
+	Builds a condition from a (config) spec which maps columns to values, where a list means any of the values,
+	None means missing and a mapping compares with operators (any of `==`, `!=`, `<`, `<=`, `>`, `>=`, `in`,
+	`contains`). The special keys `all`, `any` (each a list of specs) and `not` (a spec) combine conditions.
+	All entries of a spec have to hold.
+
+	For example: `{'unit': 'usd', 'amount': {'>': 1000}, 'any': [{'sender': 'boa'}, {'receiver': 'boa'}]}`
+	'''
+	if isinstance(spec, Condition):
+		return spec
+	conditions = []
+	for key, value in spec.items():
+		if key == 'all':
+			conditions.append(AllOf(*map(parse_condition, value)))
+		elif key == 'any':
+			conditions.append(AnyOf(*map(parse_condition, value)))
+		elif key == 'not':
+			conditions.append(Not(parse_condition(value)))
+		elif value is None:
+			conditions.append(IsNull(key))
+		elif isinstance(value, Mapping):
+			for op, arg in value.items():
+				if op == 'in':
+					conditions.append(IsIn(key, arg))
+				elif op == 'contains':
+					conditions.append(Contains(key, arg))
+				else:
+					conditions.append(Compare(key, op, arg))
+		elif isinstance(value, (list, tuple)):
+			conditions.append(IsIn(key, value))
+		else:
+			conditions.append(Compare(key, '==', value))
+	return conditions[0] if len(conditions) == 1 else AllOf(*conditions)
+
+
+
+@fig.component('condition')
+class ConditionRule(Rule):
+	'''
+	Flags all transactions matching a declarative condition. Instead of being judged one transaction at a time,
+	the conditions of all such rules are evaluated by the database in a single query (see `evaluate_rules`).
+	'''
+	def __init__(self, where: Mapping | Condition, category: str = 'flagged', description: str = None):
+		self.condition = parse_condition(where)
+		self.category = category
+		self.description = str(self.condition) if description is None else description
+
+
+
+def load_frame(conn: sqlite3.Connection = None, *, where: Condition = None) -> pd.DataFrame:
+	'''All (selected) transactions with the columns of `COLUMNS` (e.g. to evaluate condition masks on).'''
+	if conn is None:
+		conn = Record._conn
+	clause, params = ('1', []) if where is None else where.sql()
+	return pd.read_sql_query(f'SELECT {", ".join(f"{expr} AS {key}" for key, expr in COLUMNS.items())} '
+							 f'FROM transactions AS t {JOINS} WHERE {clause}', conn, params=params)
+
+
+
+_worker_rules: list[Rule] = None
+
+def _start_worker(path: str, rules: list[Rule]):
+	global _worker_rules
+	Record.set_conn(sqlite3.connect(f'file:{path}?mode=ro', uri=True))
+	Resolver().load().__enter__()
+	_worker_rules = rules
+
+
+def _judge_rows(rows: list[tuple], rules: list[Rule] = None) -> list[tuple[int, str, str]]:
+	verdicts = []
+	for row in rows:
+		txn = Transaction._load_row(row)
+		for rule in _worker_rules if rules is None else rules:
+			if rule.select(txn):
+				verdict = rule.judge(txn)
+				if verdict is not None:
+					verdicts.append((txn.ID, *verdict))
+	return verdicts
+
+
+
+def evaluate_rules(rules: Iterable[Rule], conn: sqlite3.Connection = None, *, where: Condition = None,
+				   workers: int = None, chunksize: int = 2000, pbar: bool = False) -> list[tuple[int, str, str]]:
+	'''
+	Evaluates all rules over all (selected) transactions in a single scan and returns the verdicts
+	(transaction ID, category, description).
+
+	The conditions of all declarative rules are compiled into one query (flagging each row for each rule), so any
+	number of them costs (about) as much as one. The transactions are only loaded as records if there are rules
+	that have to be judged in python, in which case they are judged in chunks across `workers` processes
+	(by default, one per CPU, or in this process for a single chunk, an in-memory database, or `workers=0`).
+
+	The workers open their own (read-only) connections, so if `conn` has uncommitted changes (which they couldn't
+	see), all rules are judged in this process instead.
+	'''
+	if conn is None:
+		conn = Record._conn
+	rules = list(rules)
+	declarative = [rule for rule in rules if isinstance(rule, ConditionRule)]
+	python = [rule for rule in rules if not isinstance(rule, ConditionRule)]
+
+	flags, params = [], []
+	for rule in declarative:
+		clause, args = rule.condition.sql()
+		flags.append(f'CASE WHEN {clause} THEN 1 ELSE 0 END')
+		params.extend(args)
+	selection, args = ('1', []) if where is None else where.sql()
+	conditions, params = [f'({selection})'], params + args
+	if not len(python):
+		# only flagged rows are needed
+		clause, args = AnyOf(*[rule.condition for rule in declarative]).sql()
+		conditions.append(f'({clause})')
+		params.extend(args)
+	cursor = conn.execute(f'SELECT t.*{"".join(", " + flag for flag in flags)} FROM transactions AS t {JOINS} '
+						  f'WHERE {" AND ".join(conditions)}', params)
+
+	verdicts = []
+	chunks = []
+	width = len(flags)
+	while True:
+		rows = cursor.fetchmany(chunksize)
+		if not len(rows):
+			break
+		for row in rows:
+			for rule, flag in zip(declarative, row[len(row) - width:]):
+				if flag:
+					verdicts.append((row[0], rule.category, rule.description))
+		if len(python):
+			chunks.append([row[:len(row) - width] for row in rows])
+
+	if not len(chunks):
+		return verdicts
+
+	path = conn.execute('PRAGMA database_list').fetchone()[2]
+	if workers is None:
+		workers = os.cpu_count() or 1
+	if workers <= 1 or len(chunks) == 1 or not path or conn.in_transaction:
+		with Resolver().load():
+			for chunk in tqdm(chunks, disable=not pbar):
+				verdicts.extend(_judge_rows(chunk, python))
+		return verdicts
+
+	with ProcessPoolExecutor(min(workers, len(chunks)), initializer=_start_worker,
+							 initargs=(path, python)) as pool:
+		for result in tqdm(pool.map(_judge_rows, chunks), total=len(chunks), disable=not pbar):
+			verdicts.extend(result)
+	return verdicts
+
+
+
+# columns of transactions that can be edited with an update file (which also has to have an "id" column)
+EDITABLE = 'location', 'sender', 'receiver', 'description', 'reference'
+
+
+
+def apply_updates(report: Report, rows: Iterable[Mapping[str, Any]]) -> list[Transaction]:
+	'''
+	Sets the editable columns given for each transaction (empty cells clear it), and writes only the columns that
+	actually changed (so applying the same update again doesn't write anything). Returns the changed transactions.
+	'''
+	txns = []
+	for row in rows:
+		txn = Transaction.find(int(row['id']))
+		for key in EDITABLE:
+			if key in row:
+				setattr(txn, key, row[key] or None)
+		txns.append(txn)
+	return Transaction.update_all(report, txns)
+
+
+
+def select_condition(cfg: fig.Configuration) -> Condition | None:
 
 	quarter = cfg.pull('quarter', None)
 
 	year = cfg.pull('year', None)
 	if year is not None:
 		if year == 'all':
-			return list(Transaction.find_all())
+			return None
 
 		try:
 			year = int(year)
@@ -38,9 +408,11 @@ def select_txns(cfg: fig.Configuration) -> list[Transaction] | None:
 			except ValueError:
 				raise ValueError(f'Invalid quarter: {quarter}')
 
-		def filter_txn(txn: Transaction):
-			return txn.date.year == year and (quarter is None or (txn.date.month-1) // 3 + 1 == quarter)
-		return list(filter(filter_txn, Transaction.find_all()))
+		if quarter is None:
+			return Compare('date', '>=', f'{year}-01-01') & Compare('date', '<', f'{year + 1}-01-01')
+		start = f'{year}-{3 * quarter - 2:02}-01'
+		end = f'{year}-{3 * quarter + 1:02}-01' if quarter < 4 else f'{year + 1}-01-01'
+		return Compare('date', '>=', start) & Compare('date', '<', end)
 
 
 
@@ -50,50 +422,34 @@ def validate(cfg: fig.Configuration):
 	conn = cfg.pull('conn')
 	Record.set_conn(conn)
 
-	rule: Rule = cfg.pull('rule')
+	rules: list[Rule] = cfg.pull('rule')
+	if isinstance(rules, Rule):
+		rules = [rules]
 
-	txns = select_txns(cfg)
-	if txns is None:
-		txns = list(Transaction.find_all())
-
-	txns = [txn for txn in txns if rule.select(txn)]
-	cfg.print(f'Validating {len(txns)} transactions.')
+	where = select_condition(cfg)
+	cfg.print(f'Validating with {len(rules)} rules.')
 
 	# Load Update
 	path = get_path(cfg, path_key='update', root_key='root')
 	update = []
 	if path is not None:
 		# load csv file with pandas
-		update = load_csv_rows(path)
-
-	selected = []
-	verdicts = Counter()
-
-	pbar = tqdm(txns)
-	for txn in pbar:
-		verdict = rule.judge(txn)
-		if verdict is not None:
-			cat, desc = verdict
-			verdicts[cat] += 1
-			selected.append((txn, cat, desc))
-		viz = ', '.join(f'{k}: {v}' for k, v in verdicts.items())
-		if not len(viz):
-			viz = '(No verdicts)'
-		pbar.set_description(viz)
+		update = list(load_csv_rows(path, dtype=str))
+
+	selected = evaluate_rules(rules, conn, where=where, workers=cfg.pull('workers', None),
+							  pbar=cfg.pull('pbar', True))
+	verdicts = Counter(cat for _, cat, _ in selected)
+	viz = ', '.join(f'{k}: {v}' for k, v in verdicts.items())
+	cfg.print(viz if len(viz) else '(No verdicts)')
 
 	report = create_report(cfg)
+	if len(update):
+		report.write()
+		changed = apply_updates(report, update)
+		cfg.print(f'Updated {len(changed)} of {len(update)} transactions.')
 
 	# Commit the changes
 	conn.commit()
 
 	cfg.print('Validation complete.')
-
-
-
-
-
-
-
-
-
-
+	return selected